@@ -22,6 +22,9 @@ if __name__ == "__main__":
     if not utils.string_validate(username, max_len = 512):
         print("Invalid username! Expected string with length: 1 to 512")
         exit(1)
+    if not utils.username_validate(username):
+        print("Invalid username! Usernames can't contain an @")
+        exit(1)
     if not utils.string_validate(password, max_len = 512):
         print("Invalid password! Expected string with length: 1 to 512")
         exit(1)
@@ -2,87 +2,384 @@ import flask
 import flask_limiter
 import psycopg2
 import datetime
+import time
 import hashlib
 import secrets
 import jwt
 import dotenv
 import os
 import functools
+import math
+import atexit
+import socket
+import cache
+import ingest
+import spool
+import ratelimit # Registers the shm:// rate limit storage
+import asyncdb
+import invalidation
+import statements
 import utils
 import werkzeug # werkzeug.exceptions.HTTPException is raised when flask.abort() is called
 
+# Load environment variables before any module level configuration reads them
+dotenv.load_dotenv()
+
 # Define app name
 app = flask.Flask(__name__)
-# Create rate limiter
-limiter = flask_limiter.Limiter(flask_limiter.util.get_remote_address, app = app, default_limits = ["500/hour","3/second"])
+# Create rate limiter, the counters are shared by every worker process on the host unless another storage is configured
+limiter = flask_limiter.Limiter(flask_limiter.util.get_remote_address, app = app, default_limits = ["500/hour","3/second"],
+                                storage_uri = os.environ.get("RATELIMIT_STORAGE_URI", "shm://"),
+                                strategy = os.environ.get("RATELIMIT_STRATEGY", "sliding-window-counter"))
+# Release the request connection even if the endpoint raised, anything not committed is rolled back
+app.teardown_request(utils.db_request_teardown)
+
+@app.after_request
+def finish_request_transaction(response):
+    # Only successful requests commit, aborting with an error status rolls back everything the request did
+    try:
+        utils.db_request_finish(commit = response.status_code < 400)
+    except psycopg2.DatabaseError:
+        return flask.make_response(flask.jsonify({"errors": "Database failed to commit transaction!"}), utils.StatusCodes["internal_error"])
+    # Successful writes pin the user to the primary, the following reads of the user can't miss them on a lagging replica
+    if response.status_code < 400 and flask.request.method != "GET" and "user_id" in flask.g:
+        pin_to_primary(flask.g.user_id)
+    # Tokens carrying role claims are reissued when the role changes
+    if response.status_code < 400 and "refreshed_token" in flask.g:
+        response.headers["X-Refreshed-Token"] = flask.g.refreshed_token
+    return response
+
+# Optionally carry the role in the token itself so most requests are authorized without the database
+app.config["AUTH_ROLE_CLAIMS"] = utils.env_flag("AUTH_ROLE_CLAIMS")
+app.config["TOKEN_MINUTES"] = int(os.environ.get("TOKEN_MINUTES", 30))
+# Number of results per page of the list endpoints, clients can ask for fewer or more up to the maximum
+app.config["PAGE_LIMIT"] = int(os.environ.get("PAGE_LIMIT", 50))
+app.config["PAGE_MAX_LIMIT"] = int(os.environ.get("PAGE_MAX_LIMIT", 200))
+# Keyword searches only page through this many of the closest matches, every later page walks all the closer ones again
+app.config["SEARCH_MAX_DEPTH"] = int(os.environ.get("SEARCH_MAX_DEPTH", 1000))
+# Transactions failing because of deadlocks or serialization conflicts with concurrent requests are run again
+transaction_runner = utils.TransactionRunner(
+    max_attempts = int(os.environ.get("DB_RETRY_ATTEMPTS", 4)),
+    base_delay = float(os.environ.get("DB_RETRY_BASE_DELAY", 0.01)),
+    max_delay = float(os.environ.get("DB_RETRY_MAX_DELAY", 0.2)),
+    budget = float(os.environ.get("DB_RETRY_BUDGET", 10)),
+    budget_refill = float(os.environ.get("DB_RETRY_BUDGET_REFILL", 0.1))
+)
+# Users are served by the primary for a while after their own writes, so they see them even if the replica lags behind
+app.config["DB_REPLICA_PIN_SECONDS"] = float(os.environ.get("DB_REPLICA_PIN_SECONDS", 5))
+# Active bans are kept in memory and every authenticated request is checked against them instead of querying the bans table
+banned_users = cache.RevocationList(refresh_interval = float(os.environ.get("BAN_LIST_REFRESH", 5)))
+# How far the time watermark of the ban list trails behind, bans written by transactions running longer than this rely on the invalidation bus
+app.config["BAN_LIST_OVERLAP"] = float(os.environ.get("BAN_LIST_OVERLAP", 60))
+
+# Opt-in on-disk spool that keeps stream plays while the database is degraded and replays them once it recovers
+stream_spool = None
+if os.environ.get("SPOOL_DIR"):
+    stream_spool = spool.Spool(
+        directory = os.environ.get("SPOOL_DIR"),
+        name = os.environ.get("SPOOL_NAME", socket.gethostname()),
+        segment_bytes = int(os.environ.get("SPOOL_SEGMENT_BYTES", 16777216)),
+        fsync_interval = float(os.environ.get("SPOOL_FSYNC_INTERVAL", 0.002)),
+        replay_interval = float(os.environ.get("SPOOL_REPLAY_INTERVAL", 1)),
+        replay_batch = int(os.environ.get("SPOOL_REPLAY_BATCH", 1000))
+    )
+
+    # Plays spooled by a previous run are replayed without waiting for the next one to be spooled
+    @app.before_request
+    def start_spool_replayer():
+        stream_spool.ensure_started()
+
+# Opt-in batched ingestion for the stream endpoint, plays are buffered in memory and flushed in multi-row inserts
+stream_buffer = None
+if utils.env_flag("STREAM_BUFFER"):
+    stream_buffer = ingest.StreamBuffer(
+        max_batch = int(os.environ.get("STREAM_BUFFER_BATCH", 500)),
+        flush_interval = float(os.environ.get("STREAM_BUFFER_INTERVAL", 0.5)),
+        max_size = int(os.environ.get("STREAM_BUFFER_SIZE", 10000)),
+        put_timeout = float(os.environ.get("STREAM_BUFFER_TIMEOUT", 1)),
+        spool = stream_spool
+    )
+    # Flush whatever is still buffered when the process exits
+    atexit.register(stream_buffer.stop)
+
+# Roles rarely change, so they are cached per user until a subscription purchase evicts them
+role_cache = cache.LRUCache(max_size = int(os.environ.get("ROLE_CACHE_SIZE", 10000)), ttl = float(os.environ.get("ROLE_CACHE_TTL", 60)))
+# The song, artist and playlist info responses are cached until a write to the catalog evicts them
+response_cache = cache.ResponseCache(max_size = int(os.environ.get("RESPONSE_CACHE_SIZE", 10000)), ttl = float(os.environ.get("RESPONSE_CACHE_TTL", 30)))
+
+# Writes tell the other worker processes what to evict from their caches through NOTIFY, unless the bus is turned off
+invalidation_bus = invalidation.InvalidationBus(
+    channel = os.environ.get("INVALIDATION_CHANNEL", "dbproj_invalidation") if utils.env_flag("INVALIDATION_BUS", True) else None,
+    connect_kwargs = utils.db_settings(),
+    ping_interval = float(os.environ.get("INVALIDATION_PING_INTERVAL", 5)),
+    reconnect_delay = float(os.environ.get("INVALIDATION_RECONNECT_DELAY", 1))
+)
+invalidation_bus.register("role", role_cache.invalidate)
+invalidation_bus.register("ban", lambda ban: banned_users.add(*ban))
+invalidation_bus.register("unban", banned_users.discard)
+invalidation_bus.register("response", lambda resource: response_cache.invalidate_resource(tuple(resource)))
+invalidation_bus.register_flush(role_cache.clear)
+invalidation_bus.register_flush(response_cache.clear)
+invalidation_bus.register_flush(banned_users.expire)
+
+@app.before_request
+def start_invalidation_listener():
+    invalidation_bus.ensure_started()
+
+def encode_token(user_id, user_role = None, role_until = None):
+    claims = {
+                "user_id": user_id,
+                "exp": datetime.datetime.utcnow() + datetime.timedelta(minutes=app.config["TOKEN_MINUTES"])
+             }
+    if app.config["AUTH_ROLE_CLAIMS"]:
+        claims["role"] = user_role
+        claims["premium_until"] = role_until if user_role == "premium consumer" else None
+    return jwt.encode(claims, app.config["SECRET_KEY"], algorithm="HS256")
+
+def banned_users_query(watermark):
+    # The first load reads all the active bans, the next ones only the users whose bans changed since the watermarks
+    if watermark is None:
+        values = (app.config["BAN_LIST_OVERLAP"],)
+        return "active_bans", values
+    ban_id, ban_time = watermark
+    values = (ban_id, ban_time, ban_time, app.config["BAN_LIST_OVERLAP"])
+    return "ban_changes", values
+
+def banned_users_changes(rows):
+    # Every row carries the new watermarks, the user columns are null when no ban changed
+    now = time.time()
+    banned = {}
+    unbanned = []
+    for _, _, user_id, user_banned, ban_expires_in in rows:
+        if user_id is None:
+            continue
+        if user_banned:
+            banned[user_id] = now + float(ban_expires_in) if ban_expires_in is not None else None
+        else:
+            unbanned.append(user_id)
+    return (rows[0][0], rows[0][1]), banned, unbanned
+
+def fetch_banned_users(cur, watermark):
+    statements.execute(cur, *banned_users_query(watermark))
+    return banned_users_changes(cur.fetchall())
+
+def load_banned_users(watermark):
+    return fetch_banned_users(utils.get_request_cursor(abort_unavailable = False), watermark)
+
+def refresh_banned_users():
+    if banned_users.needs_refresh():
+        try:
+            banned_users.refresh(load_banned_users)
+        except (utils.PoolTimeoutError, psycopg2.Error):
+            # Keep authorizing with the last known bans while the database is unavailable
+            utils.db_request_discard()
+    # Without the bans there is no telling who is banned, so nobody is let in
+    if not banned_users.loaded():
+        flask.abort(utils.StatusCodes["service_unavailable"], "Database is unavailable, please try again later!")
+
+def preload_banned_users():
+    # Loaded before serving so the first requests don't wait for it, if the database isn't up yet the requests load it later
+    try:
+        conn, cur = utils.db_connect(abort_unavailable = False)
+    except (utils.PoolTimeoutError, psycopg2.Error):
+        return
+    try:
+        banned_users.refresh(functools.partial(fetch_banned_users, cur))
+    except psycopg2.Error:
+        pass
+    finally:
+        utils.db_disconnect(conn, cur)
+
+def pin_to_primary(user_id):
+    # Pins live in the rate limit storage, so every worker process sharing it sees them
+    key = f"primary-pin/{user_id}"
+    try:
+        limiter.storage.clear(key)
+        limiter.storage.incr(key, math.ceil(app.config["DB_REPLICA_PIN_SECONDS"]))
+    except limiter.storage.base_exceptions:
+        pass
+
+def pinned_to_primary(user_id):
+    try:
+        return limiter.storage.get(f"primary-pin/{user_id}") > 0
+    except limiter.storage.base_exceptions:
+        # Reading from the primary is always safe
+        return True
+
+def get_user_role(user_id, unavailable_role = None):
+    # Returns the role and until when it is valid as a unix timestamp, or None if only an unban or purchase changes it
+    cached = role_cache.get(user_id)
+    if cached is not None:
+        return cached
+    return fetch_user_role(user_id, unavailable_role)
+
+def user_role_query(user_id):
+    # Besides the role, get how many seconds it stays valid so a ban or subscription ending can't be served from the cache
+    values = (user_id,)
+    return "user_role", values
+
+def cache_user_role(user_id, user_role, role_expires_in, generation):
+    if role_expires_in is not None:
+        role_expires_in = float(role_expires_in)
+        role_until = time.time() + role_expires_in
+    else:
+        role_until = None
+    role_cache.set(user_id, (user_role, role_until), ttl = role_expires_in, generation = generation)
+    return user_role, role_until
+
+def fetch_user_role(user_id, unavailable_role = None):
+    # Endpoints that can work without the database pass the role to assume when it can't be reached, it is not cached
+    generation = role_cache.generation()
+    try:
+        cur = utils.get_request_cursor(abort_unavailable = unavailable_role is None)
+        statements.execute(cur, *user_role_query(user_id))
+
+        user_role, role_expires_in = cur.fetchone()
+        if not user_role:
+            raise Exception
+
+    except werkzeug.exceptions.HTTPException:
+        raise
+    except (utils.PoolTimeoutError, psycopg2.OperationalError, psycopg2.InterfaceError):
+        if unavailable_role is None:
+            flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+        utils.db_request_discard()
+        return unavailable_role, None
+    except Exception:
+        flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+
+    return cache_user_role(user_id, user_role, role_expires_in, generation)
 
-def requires_authentication(restrict = None):
+def run_endpoint(function, *args, **kwargs):
+    # Endpoints let transient errors through so the whole request transaction is retried
+    try:
+        return transaction_runner.run(function, utils.db_request_rollback, *args, **kwargs)
+    except utils.TransientErrors:
+        flask.abort(utils.StatusCodes["service_unavailable"], "Database is busy with conflicting changes, please try again later!")
+
+def decode_request_token():
+    auth = flask.request.headers.get("Authorization")
+
+    # Check if the "Authorization" header exists and starts with "Bearer" as sent by the postman collection
+    if not auth or not auth.startswith("Bearer "):
+        flask.abort(utils.StatusCodes["unauthorized"], "You must be authenticated to perform this action!")
+    try:
+        # Get the token after the "Bearer " part
+        token = auth.split(" ")[1]
+        return jwt.decode(token, app.config["SECRET_KEY"], algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        flask.abort(utils.StatusCodes["unauthorized"], "Your session has expired, please authenticate again!")
+    except jwt.InvalidTokenError:
+        flask.abort(utils.StatusCodes["unauthorized"], "Your session is invalid, please authenticate again!")
+
+def check_user_role(user_role, restrict):
+    if user_role == "banned":
+        flask.abort(utils.StatusCodes["forbidden"], "You are banned, contact support for more details!")
+
+    # If no restrict list is passed as argument, just check if the token is valid
+    if restrict:
+        if not utils.list_validate(restrict) or not (utils.string_validate(role) for role in restrict):
+            flask.abort(utils.StatusCodes["internal_error"], "Invalid restrict list in this endpoint!")
+        # If the user role is in the restrict list, allow entry to the endpoint (premium consumers can access regular consumer endpoints)
+        if not any(user_role == role or (user_role == "premium consumer" and role == "consumer") for role in restrict):
+            flask.abort(utils.StatusCodes["unauthorized"], "You do not have permission to perform this action!")
+
+def requires_authentication(restrict = None, read_only = False, unavailable_role = None):
+    # Endpoints marked read-only are served by the replica, including the role lookup and ban list refresh, unless the user is pinned to the primary
+    # With an unavailable role, users whose role isn't cached are let in with it while the database can't be reached, the endpoint must check it later
     def decorator(function):
         @functools.wraps(function)
         def wrapper(*args, **kwargs):
-            auth = flask.request.headers.get("Authorization")
-
-            # Check if the "Authorization" header exists and starts with "Bearer" as sent by the postman collection
-            if not auth or not auth.startswith("Bearer "):
-                flask.abort(utils.StatusCodes["unauthorized"], "You must be authenticated to perform this action!")
-            try:
-                # Get the token after the "Bearer " part
-                token = auth.split(" ")[1]
-                token_info = jwt.decode(token, app.config["SECRET_KEY"], algorithms=["HS256"])
-            except jwt.ExpiredSignatureError:
-                flask.abort(utils.StatusCodes["unauthorized"], "Your session has expired, please authenticate again!")
-            except jwt.InvalidTokenError:
-                flask.abort(utils.StatusCodes["unauthorized"], "Your session is invalid, please authenticate again!")
-
+            token_info = decode_request_token()
             user_id = token_info["user_id"]
+            flask.g.user_id = user_id
+            if read_only:
+                utils.set_request_read_only(not pinned_to_primary(user_id))
+
+            refresh_banned_users()
+            if user_id in banned_users:
+                user_role = "banned"
+            elif app.config["AUTH_ROLE_CLAIMS"] and "role" in token_info:
+                # Fast path, the role comes from the token
+                user_role = token_info["role"]
+                premium_until = token_info.get("premium_until")
+                if user_role == "premium consumer" and premium_until is not None and premium_until <= time.time():
+                    # The premium in the token ended, check if it was extended and give the client a token with the current role
+                    user_role, role_until = get_user_role(user_id)
+                    flask.g.refreshed_token = encode_token(user_id, user_role, role_until)
+            else:
+                user_role, _ = get_user_role(user_id, unavailable_role)
 
-            try:
-                conn, cur = utils.db_connect()
-
-                statement = """
-                            SELECT CASE
-                                WHEN EXISTS (SELECT 1 FROM bans WHERE bans.users_id = users.id
-                                    AND (bans.end_time IS NULL or bans.end_time > CURRENT_TIMESTAMP)) THEN 'banned'
-                                WHEN EXISTS (SELECT 1 FROM consumers WHERE consumers.users_id = users.id)
-                                    AND EXISTS (SELECT 1 FROM subscriptions WHERE subscriptions.consumers_users_id = users.id
-                                        AND subscriptions.end_time + INTERVAL '1 minute' > CURRENT_TIMESTAMP) THEN 'premium consumer'
-                                WHEN EXISTS (SELECT 1 FROM consumers WHERE consumers.users_id = users.id) THEN 'consumer'
-                                WHEN EXISTS (SELECT 1 FROM artists WHERE artists.users_id = users.id) THEN 'artist'
-                                WHEN EXISTS (SELECT 1 FROM administrators WHERE administrators.users_id = users.id) THEN 'administrator'
-                            END AS user_role
-                            FROM users
-                            WHERE id = %s;
-                            """
-                values = (user_id,)
-                cur.execute(statement, values)
-
-                user_role = cur.fetchone()[0]
-                if not user_role:
-                    raise Exception
-                if user_role == "banned":
-                    flask.abort(utils.StatusCodes["forbidden"], "You are banned, contact support for more details!")
-
-            except werkzeug.exceptions.HTTPException:
-                raise
-            except Exception:
-                flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-            finally:
-                utils.db_disconnect(conn, cur)
-
-            # If no restrict list is passed as argument, just check if the token is valid
-            if restrict:
-                if not utils.list_validate(restrict) or not (utils.string_validate(role) for role in restrict):
-                    flask.abort(utils.StatusCodes["internal_error"], "Invalid restrict list in this endpoint!")
-                for role in restrict:
-                    # If the user role is in the restrict list, allow entry to the endpoint (premium consumers can access regular consumer endpoints)
-                    if user_role == role or (user_role == "premium consumer" and role == "consumer"):
-                        return function(user_id, user_role, *args, **kwargs)
-                flask.abort(utils.StatusCodes["unauthorized"], "You do not have permission to perform this action!")
-
-            return function(user_id, user_role, *args, **kwargs)
+            check_user_role(user_role, restrict)
+            return run_endpoint(function, user_id, user_role, *args, **kwargs)
         return wrapper
     return decorator
 
+def page_arguments(converters):
+    # Reads the page size and the sort key the previous page ended at from the query string
+    limit = utils.string_to_int(flask.request.args.get("limit", app.config["PAGE_LIMIT"]))
+    if not utils.integer_validate(limit, min_val = 1, max_val = app.config["PAGE_MAX_LIMIT"]):
+        flask.abort(utils.StatusCodes["bad_request"], f"Invalid limit! Expected integer in range: 1 to {app.config['PAGE_MAX_LIMIT']}")
+
+    cursor = flask.request.args.get("next")
+    if cursor is None:
+        return limit, None
+    after = utils.decode_page_cursor(cursor, converters)
+    if after is None:
+        flask.abort(utils.StatusCodes["bad_request"], "Invalid next cursor!")
+    return limit, after
+
+def page_rows(rows, limit, sort_key):
+    # Queries fetch one row more than the limit to know if there is a next page
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, utils.encode_page_cursor(sort_key(rows[-1]))
+
+def search_page_rows(rows, limit, after, sort_key):
+    # Search cursors also count the rows served so far, there is no next page once the search depth is reached
+    depth = (after[2] if after is not None else 0) + min(len(rows), limit)
+    rows, next_cursor = page_rows(rows, limit, lambda row: sort_key(row) + (depth,))
+    if depth >= app.config["SEARCH_MAX_DEPTH"]:
+        next_cursor = None
+    return rows, next_cursor
+
+def cached_response(resource, variant):
+    # Users pinned to the primary after a write skip the cache, it may hold what another user read from a lagging replica
+    if not flask.g.get("db_read_only", False):
+        return None
+    return response_cache.get((resource, variant))
+
+def cache_response(resource, variant, response, generation):
+    # The body is rendered once, its hash is the ETag clients send back in If-None-Match
+    body = flask.jsonify(response).get_data()
+    entry = (body, hashlib.blake2b(body, digest_size = 16).hexdigest())
+    response_cache.set((resource, variant), entry, generation = generation)
+    return entry
+
+def conditional_response(entry):
+    body, etag = entry
+    response = app.response_class(body, status = utils.StatusCodes["success"], mimetype = "application/json")
+    response.set_etag(etag)
+    # Responses depend on who is asking, so only the client may keep them and it has to revalidate them every time
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(flask.request)
+
+def invalidate(kind, *keys):
+    # Applied here only once the write commits, so a request reading before it can't cache what it read afterwards
+    # The other workers get the events on commit too, they are published in the request transaction
+    handler = invalidation_bus.handler(kind)
+    for key in keys:
+        utils.on_request_commit(functools.partial(handler, key))
+    if keys:
+        invalidation_bus.publish(utils.get_request_cursor(), [(kind, key) for key in keys])
+
+def playlist_info_variant(user_id, user_role):
+    # Premium consumers also see their own private playlists, everyone else sees the same public ones
+    if user_role == "premium consumer":
+        return ("premium", user_id)
+    return "public"
+
 @app.route("/")
 @limiter.exempt
 def landing_page():
@@ -110,6 +407,8 @@ def register_consumer():
     # Verify fields
     if not utils.string_validate(username, max_len = 512):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid username! Expected string with length: 1 to 512")
+    if not utils.username_validate(username):
+        flask.abort(utils.StatusCodes["bad_request"], "Invalid username! Usernames can't contain an @")
     if not utils.string_validate(password, max_len = 512):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid password! Expected string with length: 1 to 512")
     if not utils.string_validate(email, max_len = 512):
@@ -132,38 +431,20 @@ def register_consumer():
     password_pepper = app.config["SECRET_KEY"]
     password_hash  = hashlib.sha512((password + password_salt + password_pepper).encode("utf-8")).hexdigest()
 
-    conn, cur = utils.db_connect()
-
-    statement = """
-                WITH inserted_user AS
-                (
-                    INSERT INTO users (username, password_hash, password_salt, email)
-                    VALUES (%s, %s, %s, %s)
-                    RETURNING id
-                )
-                INSERT INTO consumers (users_id, birthday, display_name, register_date)
-                SELECT inserted_user.id, %s, %s, CURRENT_DATE
-                FROM inserted_user
-                RETURNING users_id
-                """
+    cur = utils.get_request_cursor()
+
     values = (username, password_hash, password_salt, email, birthday, display_name)
 
     try:
-        cur.execute(statement, values)
-        conn.commit()
+        statements.execute(cur, "register_consumer", values)
         user_id = cur.fetchone()[0]
         response = {"results": f"Consumer added with ID {user_id}!"}
     except psycopg2.errors.UniqueViolation:
-        conn.rollback()
         flask.abort(utils.StatusCodes["bad_request"], "Username or email already in use!")
     except psycopg2.DatabaseError as e:
         print(e)
-        conn.rollback()
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/artist", methods=["POST"])
@@ -184,6 +465,8 @@ def register_artist(user_id, user_role):
     # Verify fields
     if not utils.string_validate(username, max_len = 512):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid username! Expected string with length: 1 to 512")
+    if not utils.username_validate(username):
+        flask.abort(utils.StatusCodes["bad_request"], "Invalid username! Usernames can't contain an @")
     if not utils.string_validate(password, max_len = 512):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid password! Expected string with length: 1 to 512")
     if not utils.string_validate(email, max_len = 512):
@@ -206,40 +489,23 @@ def register_artist(user_id, user_role):
     password_pepper = app.config["SECRET_KEY"]
     password_hash  = hashlib.sha512((password + password_salt + password_pepper).encode("utf-8")).hexdigest()
 
-    conn, cur = utils.db_connect()
-
-    statement = """
-                WITH inserted_user AS
-                (
-                    INSERT INTO users (username, password_hash, password_salt, email)
-                    VALUES (%s, %s, %s, %s)
-                    RETURNING id
-                )
-                INSERT INTO artists (users_id, stage_name, publishers_id, administrators_users_id)
-                SELECT id, %s, %s, %s
-                FROM inserted_user
-                RETURNING users_id
-                """
+    cur = utils.get_request_cursor()
+
     values = (username, password_hash, password_salt, email, stage_name, publisher, admin_id)
 
     try:
-        cur.execute(statement, values)
-        conn.commit()
+        statements.execute(cur, "register_artist", values)
         user_id = cur.fetchone()[0]
         response = {"results": f"Artist added with ID {user_id}!"}
+    except utils.TransientErrors:
+        raise
     except psycopg2.errors.UniqueViolation:
-        conn.rollback()
         flask.abort(utils.StatusCodes["bad_request"], "Email or username already in use!")
     except psycopg2.errors.ForeignKeyViolation:
-        conn.rollback()
         flask.abort(utils.StatusCodes["bad_request"], f"No publisher found with ID {publisher}!")
     except psycopg2.DatabaseError:
-        conn.rollback()
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/user", methods = ["PUT"])
@@ -267,36 +533,28 @@ def authenticate_user():
         flask.abort(utils.StatusCodes["unauthorized"], "Wrong password!")
 
     try:
-        conn, cur = utils.db_connect()
-
-        statement = """
-                    SELECT password_hash, password_salt, id,
-                        CASE
-                            WHEN EXISTS (SELECT 1 FROM bans WHERE bans.users_id = users.id
-                                AND (bans.end_time IS NULL or bans.end_time > CURRENT_TIMESTAMP)) THEN true
-                        END AS banned
-                    FROM users
-                    WHERE username = %s OR email ILIKE %s
-                    """
-        values = (username_or_email, username_or_email)
-        cur.execute(statement, values)
+        refresh_banned_users()
+        cur = utils.get_request_cursor()
+
+        values = (username_or_email,)
+        statements.execute(cur, "login_user_email" if "@" in username_or_email else "login_user", values)
 
         user_data = cur.fetchone()
         if user_data:
             stored_password_hash = user_data[0]
             stored_passwrod_salt = user_data[1]
             user_id = user_data[2]
-            banned = user_data[3]
-            if banned:
+            if user_id in banned_users:
                 flask.abort(utils.StatusCodes["forbidden"], "You are banned, contact support for more details!")
             # Encrypt password to match the one in the database
             password_pepper = app.config["SECRET_KEY"]
             password_hash  = hashlib.sha512((password + stored_passwrod_salt + password_pepper).encode("utf-8")).hexdigest()
             if password_hash == stored_password_hash:
-                token = jwt.encode({
-                                    "user_id": user_id,
-                                    "exp": datetime.datetime.utcnow() + datetime.timedelta(minutes=30)
-                                    }, app.config["SECRET_KEY"], algorithm="HS256")
+                if app.config["AUTH_ROLE_CLAIMS"]:
+                    user_role, role_until = get_user_role(user_id)
+                    token = encode_token(user_id, user_role, role_until)
+                else:
+                    token = encode_token(user_id)
                 response = {"results": str(token)}
             else:
                 flask.abort(utils.StatusCodes["unauthorized"], "Wrong password!")
@@ -304,26 +562,17 @@ def authenticate_user():
             flask.abort(utils.StatusCodes["unauthorized"], f"No user found with username or email {username_or_email}!")
 
         # Can implement a notification system here to notify the user that there was a login for any first time ip
-        statement = """
-                    INSERT INTO logins (users_id, login_time, ip)
-                    VALUES (%s, CURRENT_TIMESTAMP, %s)
-                    RETURNING id
-                    """
         values = (user_id, utils.get_request_ip())
-        cur.execute(statement, values)
+        statements.execute(cur, "add_login", values)
 
         login_id = cur.fetchone()[0]
         if not login_id:
             raise psycopg2.DatabaseError
 
-        conn.commit()
-
     except werkzeug.exceptions.HTTPException:
         raise
     except Exception:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-    finally:
-        utils.db_disconnect(conn, cur)
 
     return flask.make_response(flask.jsonify(response)), utils.StatusCodes["success"]
 
@@ -366,44 +615,25 @@ def add_song(user_id, user_role):
         if collaborator_id == artist_id:
             flask.abort(utils.StatusCodes["bad_request"], "Cannot add yourself as a collaborator!")
 
-    conn, cur = utils.db_connect()
-
-    statement = """
-                WITH inserted_song AS
-                (
-                    INSERT INTO songs (ismn, title, genre, duration, release_date, explicit, artists_users_id, publishers_id)
-                    SELECT %s, %s, %s, %s, %s, %s, %s, publishers_id
-                    FROM artists WHERE users_id = %s
-                    RETURNING id
-                ),
-                inserted_collab AS
-                (
-                    INSERT INTO collaborations (artists_users_id, songs_id)
-                    SELECT collaborator_id, inserted_song.id
-                    FROM inserted_song, UNNEST(%s::int[]) AS collaborator_id
-                )
-                SELECT id FROM inserted_song;
-                """
+    cur = utils.get_request_cursor()
+
     values = (ismn, title, genre, duration, release_date, explicit, artist_id, artist_id, collaborator_list)
 
     try:
-        cur.execute(statement, values)
-        conn.commit()
+        statements.execute(cur, "add_song", values)
         song_id = cur.fetchone()[0]
+        # Also listed in the info of the artist and of every collaborator
+        invalidate("response", ("song", song_id), ("artist", artist_id), *(("artist", collaborator_id) for collaborator_id in collaborator_list))
         response = {"results": f"Song added with ID {song_id}!"}
+    except utils.TransientErrors:
+        raise
     except psycopg2.errors.UniqueViolation:
-        conn.rollback()
         flask.abort(utils.StatusCodes["bad_request"], "Song with this ISMN already added or you already have a song with this exact title!")
     except psycopg2.errors.ForeignKeyViolation:
-        conn.rollback()
         flask.abort(utils.StatusCodes["bad_request"], "No artist found with one of the IDs in the collaborator list!")
     except psycopg2.DatabaseError:
-        conn.rollback()
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response)), utils.StatusCodes["success"]
 
 @app.route("/dbproj/album", methods=["POST"])
@@ -433,32 +663,27 @@ def add_album(user_id, user_role):
     for song_id in existing_song_list:
         if not utils.integer_validate(song_id, min_val = 1, max_val = 9223372036854775807):
             flask.abort(utils.StatusCodes["bad_request"], "Invalid song ID in the song list! Expected integers in range: 1 to 9223372036854775807")
-    if not utils.list_validate(new_song_list, max_len = 10000, no_duplicates = True):
+    # Songs are lists, which can't be compared as a set, so duplicates are checked by their unique fields below
+    if not utils.list_validate(new_song_list, max_len = 10000):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid new song list! Expected array with no duplicates, empty or with max length: 10000")
     for song in new_song_list:
-        if not len(song) == 7:
+        if not utils.list_validate(song, min_len = 7, max_len = 7):
             flask.abort(utils.StatusCodes["bad_request"],
             "Invalid new song info! Expected arrays with length: 7 (ismn, title, genre, duration, release_date, explicit, collaborator_list)")
 
-        ismn = song[0]
-        title = song[1]
-        genre = song[2]
-        duration = song[3]
-        release_date = song[4]
-        explicit = song[5]
-        collaborator_list = song[6]
+        song_ismn, song_title, song_genre, song_duration, song_release_date, song_explicit, collaborator_list = song
 
-        if not utils.string_validate(ismn, min_len = 13, max_len = 13, only_digits = True):
+        if not utils.string_validate(song_ismn, min_len = 13, max_len = 13, only_digits = True):
             flask.abort(utils.StatusCodes["bad_request"], "Invalid new song ISMN! Expected string of digits with length: 13")
-        if not utils.string_validate(title, max_len = 512):
+        if not utils.string_validate(song_title, max_len = 512):
             flask.abort(utils.StatusCodes["bad_request"], "Invalid new song title! Expected string with length: 1 to 512")
-        if not utils.string_validate(genre, max_len = 512):
+        if not utils.string_validate(song_genre, max_len = 512):
             flask.abort(utils.StatusCodes["bad_request"], "Invalid new song genre! Expected string with length: 1 to 512")
-        if not utils.integer_validate(duration, min_val = 1, max_val = 3600):
+        if not utils.integer_validate(song_duration, min_val = 1, max_val = 3600):
             flask.abort(utils.StatusCodes["bad_request"], "Invalid new song duration! Expected integer in range: 1 to 3600")
-        if not utils.datetime_validate(release_date, "%Y-%m-%d", past = True):
+        if not utils.datetime_validate(song_release_date, "%Y-%m-%d", past = True):
             flask.abort(utils.StatusCodes["bad_request"], "Invalid new song release date! Expected past date string in ISO 8601 format: YYYY-MM-DD")
-        if not utils.boolean_validate(explicit):
+        if not utils.boolean_validate(song_explicit):
             flask.abort(utils.StatusCodes["bad_request"], "Invalid new song explicit value! Expected boolean with value: true or false!")
         if not utils.list_validate(collaborator_list, max_len = 10, no_duplicates = True):
             flask.abort(utils.StatusCodes["bad_request"],
@@ -469,82 +694,75 @@ def add_album(user_id, user_role):
                 "Invalid new song collaborator ID in list! Expected integers in range: 1 to 9223372036854775807")
             if collaborator_id == artist_id:
                 flask.abort(utils.StatusCodes["bad_request"], "Cannot add yourself as a collaborator in one of the new songs!")
+    if not utils.list_validate([song[0] for song in new_song_list], no_duplicates = True):
+        flask.abort(utils.StatusCodes["bad_request"], "Invalid new song list! Two or more new songs have the same ISMN")
+    if not utils.list_validate([song[1] for song in new_song_list], no_duplicates = True):
+        flask.abort(utils.StatusCodes["bad_request"], "Invalid new song list! Two or more new songs have the same title")
 
     try:
-        conn, cur = utils.db_connect()
+        cur = utils.get_request_cursor()
 
         if len(existing_song_list) > 0:
             # Check if existing songs given are of the artist's authorship
-            statement = """
-                        SELECT songs.id
-                        FROM songs
-                        WHERE songs.id = ANY(%s::int[]) AND songs.artists_users_id != %s;
-                        """
             values = (existing_song_list, artist_id)
-            cur.execute(statement, values)
+            statements.execute(cur, "album_foreign_songs", values)
 
             if cur.fetchone():
                 flask.abort(utils.StatusCodes["bad_request"], "Cannot create album with one or more existing songs that are not of your authorship!")
 
+        album_song_list = list(existing_song_list)
+
         if len(new_song_list) > 0:
-            # Insert new songs
-            for song in new_song_list:
-                statement = """
-                            WITH inserted_song AS
-                            (
-                                INSERT INTO songs (ismn, title, genre, duration, release_date, explicit, artists_users_id, publishers_id)
-                                SELECT %s, %s, %s, %s, %s, %s, %s, publishers_id
-                                FROM artists WHERE users_id = %s
-                                RETURNING id
-                            ),
-                            inserted_collab AS
-                            (
-                                INSERT INTO collaborations (artists_users_id, songs_id)
-                                SELECT collaborator_id, inserted_song.id
-                                FROM inserted_song, UNNEST(%s::int[]) AS collaborator_id
-                            )
-                            SELECT id FROM inserted_song;
-                            """
-                values = (song[0], song[1], song[2], song[3], song[4], song[5], artist_id, artist_id, song[6])
-                cur.execute(statement, values)
-
-                inserted_song_id = cur.fetchone()[0]
-                existing_song_list.append(inserted_song_id)
-
-        # Use ordinality to preserve the song order given by the user in the array
-        statement = """
-                    WITH inserted_album AS
-                    (
-                        INSERT INTO albums (title, release_date, artists_users_id)
-                        VALUES (%s, %s, %s)
-                        RETURNING id
-                    ),
-                    inserted_album_song AS
-                    (
-                        INSERT INTO albums_songs (albums_id, songs_id, ordinality)
-                        SELECT songs.ordinality, songs.id, inserted_album.id
-                        FROM inserted_album, UNNEST(%s::int[]) WITH ORDINALITY AS songs(id, ordinality)
-                    )
-                    SELECT id FROM inserted_album;
-                    """
-        values = (title, release_date, artist_id, existing_song_list)
-        cur.execute(statement, values)
+            values = tuple([song[field] for song in new_song_list] for field in range(6)) + (artist_id,)
+            statements.execute(cur, "album_add_songs", values)
+            inserted_songs = dict((ismn, song_id) for song_id, ismn in cur.fetchall())
+
+            if len(inserted_songs) < len(new_song_list):
+                values = ([song[0] for song in new_song_list], [song[1] for song in new_song_list], artist_id, list(inserted_songs.values()))
+                statements.execute(cur, "album_song_conflicts", values)
+                existing_songs = cur.fetchall()
+                existing_ismns = set(song[0] for song in existing_songs)
+                existing_titles = set(song[1] for song in existing_songs if song[2] == artist_id)
+
+                conflicts = []
+                for position, song in enumerate(new_song_list, start = 1):
+                    if song[0] in existing_ismns:
+                        conflicts.append(f"song {position} (ISMN {song[0]} already exists)")
+                    elif song[1] in existing_titles:
+                        conflicts.append(f"song {position} (you already have a song titled {song[1]})")
+                flask.abort(utils.StatusCodes["bad_request"], f"Conflicts in the new song list: {', '.join(conflicts)}")
+
+            album_song_list += [inserted_songs[song[0]] for song in new_song_list]
+
+            # Pair every new song with each of its collaborators
+            collaborations = [(inserted_songs[song[0]], collaborator_id) for song in new_song_list for collaborator_id in song[6]]
+            if collaborations:
+                values = ([collaboration[0] for collaboration in collaborations], [collaboration[1] for collaboration in collaborations])
+                statements.execute(cur, "album_add_collaborations", values)
+
+        values = (title, release_date, artist_id, album_song_list)
+        statements.execute(cur, "add_album", values)
 
         album_id = cur.fetchone()[0]
+        # The info of every song in the album shows the album, the new songs are also listed for their collaborators
+        collaborator_ids = set(collaborator_id for song in new_song_list for collaborator_id in song[6])
+        invalidate("response", ("artist", artist_id), *(("song", song_id) for song_id in album_song_list),
+                   *(("artist", collaborator_id) for collaborator_id in collaborator_ids))
 
-        conn.commit()
         response = {"results": f"Album added with ID {album_id}!"}
 
+    except utils.TransientErrors:
+        raise
     except werkzeug.exceptions.HTTPException:
         raise
-    except psycopg2.errors.ForeignKeyViolation:
+    except psycopg2.errors.ForeignKeyViolation as error:
+        if error.diag.constraint_name == "collaborations_fk2":
+            flask.abort(utils.StatusCodes["bad_request"], "No artist found with one of the IDs in a new song's collaborator list!")
         flask.abort(utils.StatusCodes["bad_request"], "No song was found with one of the IDs in the existing song list!")
     except psycopg2.errors.UniqueViolation:
-        flask.abort(utils.StatusCodes["bad_request"], "You already have an album/song with this exact title or one of the new song's ISMN already exists!")
+        flask.abort(utils.StatusCodes["bad_request"], "You already have an album with this exact title!")
     except Exception:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-    finally:
-        utils.db_disconnect(conn, cur)
 
     return flask.make_response(flask.jsonify(response)), utils.StatusCodes["success"]
 
@@ -573,44 +791,27 @@ def add_playlist(user_id, user_role):
         if not utils.integer_validate(song_id, min_val = 1, max_val = 9223372036854775807):
             flask.abort(utils.StatusCodes["bad_request"], "Invalid song ID in the song list! Expected integer in range: 1 to 9223372036854775807")
 
-    conn, cur = utils.db_connect()
-
-    # Use ordinality to preserve the song order given by the user in the array
-    statement = """
-                WITH inserted_playlist AS
-                (
-                    INSERT INTO playlists (name, private, consumers_users_id)
-                    VALUES (%s, %s, %s)
-                    RETURNING id
-                ),
-                inserted_playlist_song AS
-                (
-                    INSERT INTO playlist_orders (position, songs_id, playlists_id)
-                    SELECT songs.ordinality, songs.id, inserted_playlist.id
-                    FROM inserted_playlist, UNNEST(%s::int[]) WITH ORDINALITY AS songs(id, ordinality)
-                )
-                SELECT id FROM inserted_playlist;
-                """
-    values = (name, private, consumer_id, song_list)
+    cur = utils.get_request_cursor()
+
+    values = (name, private, consumer_id, song_list, song_list)
 
     try:
-        cur.execute(statement, values)
-        conn.commit()
-        playlist_id = cur.fetchone()[0]
+        statements.execute(cur, "add_playlist", values)
+        playlist_id, artist_ids = cur.fetchone()
+        invalidate("response", ("playlist", playlist_id))
+        if not private:
+            # Public playlists are listed in the info of the artists of their songs
+            invalidate("response", *(("artist", song_artist_id) for song_artist_id in artist_ids))
         response = {"results": f"Playlist added with ID {playlist_id}!"}
+    except utils.TransientErrors:
+        raise
     except psycopg2.errors.ForeignKeyViolation:
-        conn.rollback()
         flask.abort(utils.StatusCodes["bad_request"], "No song was found with one of the IDs in the song list!")
     except psycopg2.errors.UniqueViolation:
-        conn.rollback()
         flask.abort(utils.StatusCodes["bad_request"], "You already have a playlist with this exact name!")
     except psycopg2.DatabaseError:
-        conn.rollback()
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response)), utils.StatusCodes["success"]
 
 @app.route("/dbproj/subscription", methods=["POST"])
@@ -642,87 +843,29 @@ def add_subscription(user_id, user_role):
     elif period == "semester":
         price = 42
         interval = "6 months"
-    remaining_price = price
 
     try:
-        conn, cur = utils.db_connect()
-
-        if user_role == "consumer":
-            statement = """
-                        INSERT INTO subscriptions (start_time, end_time, price, consumers_users_id)
-                        VALUES (CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + INTERVAL %s, %s, %s)
-                        RETURNING id
-                        """
-            values = (interval, price, consumer_id)
-        elif user_role == "premium consumer":
-            # Get end of current subscription
-            statement = """
-                        SELECT end_time
-                        FROM subscriptions
-                        WHERE consumers_users_id = %s
-                        AND end_time = (SELECT MAX(end_time) FROM subscriptions WHERE consumers_users_id = %s AND end_time > CURRENT_TIMESTAMP)
-                        """
-            values = (consumer_id,consumer_id)
-
-            cur.execute(statement, values)
-            previous_end_time = cur.fetchone()[0]
-            if not previous_end_time:
-                raise Exception
-
-            statement = """
-                        INSERT INTO subscriptions (start_time, end_time, price, consumers_users_id)
-                        VALUES (%s, %s + INTERVAL %s, %s, %s)
-                        RETURNING id
-                        """
-            values = (previous_end_time, previous_end_time, interval, price, consumer_id)
-
-        cur.execute(statement, values)
-        subscription_id = cur.fetchone()[0]
-        if not subscription_id:
-            raise psycopg2.DatabaseError
-
-        statement = """
-                    SELECT id, number, credit FROM prepaid_cards
-                    WHERE number = ANY (ARRAY[%s]::text[])
-                    FOR UPDATE
-                    """
-        values = (cards,)
-
-        cur.execute(statement, values)
-        rows = cur.fetchall()
-        if len(rows) != len(cards):
-            raise psycopg2.errors.ForeignKeyViolation
-
-        for row in rows:
-            card_id = row[0]
-            card_number = row[1]
-            credit = row[2]
-            amount_used = min(credit, remaining_price)
-            remaining_price -= amount_used
-
-            statement = """
-                        INSERT INTO card_payments (amount_used, payment_time, prepaid_cards_id, subscriptions_id)
-                        VALUES (%s, CURRENT_TIMESTAMP, %s, %s)
-                        """
-            values = (amount_used, card_id, subscription_id)
+        cur = utils.get_request_cursor()
 
-            cur.execute(statement, values)
+        values = (consumer_id, interval, price, cards)
+        statements.execute(cur, "purchase_subscription", values)
+        subscription_id, chained, shortfall, premium_expires_in = cur.fetchone()
 
-            statement = "UPDATE prepaid_cards SET credit = credit - %s WHERE number = %s"
-            values = (amount_used, card_number)
-
-            cur.execute(statement, values)
-
-        if remaining_price > 0:
+        if shortfall > 0:
             flask.abort(utils.StatusCodes["bad_request"],
-            f"Missing {remaining_price:.2f} in the prepaid cards provided to pay {price:.2f} for {period} subscription!")
+            f"Missing {shortfall:.2f} in the prepaid cards provided to pay {price:.2f} for {period} subscription!")
 
-        conn.commit()
-        if user_role == "premium consumer":
+        invalidate("role", consumer_id)
+        if app.config["AUTH_ROLE_CLAIMS"]:
+            flask.g.refreshed_token = encode_token(consumer_id, "premium consumer", time.time() + float(premium_expires_in))
+
+        if chained:
             response = {"results": f"Subscription added to the end of your existing subscription with ID {subscription_id}!"}
         else:
             response = {"results": f"Subscription added with ID {subscription_id}!"}
 
+    except utils.TransientErrors:
+        raise
     except werkzeug.exceptions.HTTPException:
         raise
     except psycopg2.errors.ForeignKeyViolation:
@@ -730,156 +873,137 @@ def add_subscription(user_id, user_role):
     except Exception as e:
         print(e)
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-    finally:
-        utils.db_disconnect(conn, cur)
 
     return flask.make_response(flask.jsonify(response)), utils.StatusCodes["success"]
 
+def song_search_query(keyword, limit, after):
+    # The trigram index on the title serves the substring match and hands out the closest titles first
+    if after is None:
+        return "song_search", (keyword, f"%{keyword}%", keyword, limit + 1)
+    # Start after the last row of the previous page among the closest matches up to the search depth, whatever the cursor says
+    values = (keyword, f"%{keyword}%", app.config["SEARCH_MAX_DEPTH"], after[0], after[1], limit + 1)
+    return "song_search_after", values
+
+def song_search_response(keyword, rows, limit, after):
+    rows, next_cursor = search_page_rows(rows, limit, after, lambda row: (row[3], row[0]))
+    if not rows:
+        return {"results": f"No songs found with keyword {keyword}!"}
+    results = []
+    for row in rows:
+        results.append({"id": row[0], "title": row[1], "artist": row[2]})
+    return {"results": results, "next": next_cursor}
+
 @app.route("/dbproj/song/<keyword>", methods=["GET"])
-@requires_authentication(restrict = ["consumer", "administrator"])
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
 def get_song(user_id, user_role, keyword):
     keyword = keyword.replace("+", " ")
-    keyword = f"%{keyword}%"
+    limit, after = page_arguments((float, int, int))
 
-    conn, cur = utils.db_connect()
-
-    statement = """
-                SELECT songs.id, songs.title, artists.stage_name
-                FROM songs
-                LEFT JOIN artists ON artists.users_id = songs.artists_users_id
-                WHERE songs.title ILIKE %s
-                """
-    values = (keyword,)
-
-    keyword = keyword.replace("%", "")
+    cur = utils.get_request_cursor()
 
     try:
-        cur.execute(statement, values)
-        rows = cur.fetchall()
-        if not rows:
-            response = {"results": f"No songs found with keyword {keyword}!"}
-        else:
-            results = []
-            for row in rows:
-                results.append({"id": row[0], "title": row[1], "artist": row[2]})
-            response = {"results": results}
+        statements.execute(cur, *song_search_query(keyword, limit, after))
+        response = song_search_response(keyword, cur.fetchall(), limit, after)
     except psycopg2.DatabaseError:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response)), utils.StatusCodes["success"]
 
+def song_info_query(song_id):
+    values = (song_id,)
+    return "song_info", values
+
+def song_info_response(song_id, song):
+    if not song:
+        return {"results": f"No song found with ID {song_id}!"}
+    title, artist_name, genre, duration, explicit, release_date, album_name = song[0:7]
+    minutes = duration // 60
+    seconds = duration % 60
+    duration = f"{minutes}:{seconds}"
+    release_date = release_date.strftime("%Y-%m-%d")
+    collab_names = [collab_name for collab_name in song[7] if collab_name]
+    return {"results":
+                {
+                    "title": title,
+                    "artist_name": artist_name,
+                    "collaborators_name": collab_names if collab_names else None,
+                    "album_name": album_name if album_name else None,
+                    "genre": genre,
+                    "duration": duration,
+                    "explicit": explicit,
+                    "release_date": release_date,
+                }
+            }
+
 @app.route("/dbproj/song_info/<song_id>", methods=["GET"])
-@requires_authentication(restrict = ["consumer", "administrator"])
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
 def get_song_info(user_id, user_role, song_id):
     if not utils.integer_validate(utils.string_to_int(song_id), min_val = 1, max_val = 9223372036854775807):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid song ID! Expected integer in range: 1 to 9223372036854775807")
 
-    conn, cur = utils.db_connect()
-
-    statement = """
-                SELECT songs.title, artists.stage_name, songs.genre, songs.duration,
-                songs.explicit, songs.release_date, albums.title, ARRAY_AGG(collaborators.stage_name)
-                FROM songs
-                LEFT JOIN artists ON songs.artists_users_id = artists.users_id
-                LEFT JOIN album_orders ON album_orders.songs_id = songs.id
-                LEFT JOIN albums ON album_orders.albums_id = albums.id
-                LEFT JOIN collaborations ON songs.id = collaborations.songs_id
-                LEFT JOIN artists AS collaborators ON collaborations.artists_users_id = collaborators.users_id
-                WHERE songs.id = %s
-                GROUP BY songs.title, artists.stage_name, songs.genre, songs.duration, songs.explicit, songs.release_date, albums.title
-                """
-    values = (song_id,)
+    song_id = int(song_id)
 
-    try:
-        cur.execute(statement, values)
-        song = cur.fetchone()
-        if not song:
-            response = {"results": f"No song found with ID {song_id}!"}
-        else:
-            title, artist_name, genre, duration, explicit, release_date, album_name = song[0:7]
-            minutes = duration // 60
-            seconds = duration % 60
-            duration = f"{minutes}:{seconds}"
-            release_date = release_date.strftime("%Y-%m-%d")
-            collab_names = [collab_name for collab_name in song[7] if collab_name]
-            response = {"results":
-                            {
-                                "title": title,
-                                "artist_name": artist_name,
-                                "collaborators_name": collab_names if collab_names else None,
-                                "album_name": album_name if album_name else None,
-                                "genre": genre,
-                                "duration": duration,
-                                "explicit": explicit,
-                                "release_date": release_date,
-                            }
-                        }
-    except psycopg2.DatabaseError:
-        flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+    entry = cached_response(("song", song_id), None)
+    if entry is None:
+        generation = response_cache.generation()
+        cur = utils.get_request_cursor()
 
-    finally:
-        utils.db_disconnect(conn, cur)
+        try:
+            statements.execute(cur, *song_info_query(song_id))
+            entry = cache_response(("song", song_id), None, song_info_response(song_id, cur.fetchone()), generation)
+        except psycopg2.DatabaseError:
+            flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
+    return conditional_response(entry)
+
+def artist_info_query(artist_id):
+    values = (artist_id,)
+    return "artist_info", values
+
+def artist_info_response(artist_id, row):
+    if not row:
+        return {"results": f"No artist found with ID {artist_id}!"}
+    stage_name = row[0]
+    songs = [song for song in row[1] if song]
+    collabs = [collab for collab in row[2] if collab]
+    albums = [album for album in row[3] if album]
+    playlists = [{"playlist": playlist, "author": author} for playlist, author in zip(row[4], row[5]) if playlist and author]
+    return {"results":
+                {
+                    "stage_name": stage_name,
+                    "released_songs": songs if songs else None,
+                    "featured_songs": collabs if collabs else None,
+                    "albums": albums if albums else None,
+                    "is_in_public_playlists": playlists if playlists else None,
+                }
+            }
 
 @app.route("/dbproj/artist_info/<artist_id>", methods=["GET"])
-@requires_authentication(restrict = ["consumer", "administrator"])
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
 def get_artist_info(user_id, user_role, artist_id):
     if not utils.integer_validate(utils.string_to_int(artist_id), min_val = 1, max_val = 9223372036854775807):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid artist ID! Expected integer in range: 1 to 9223372036854775807")
 
-    conn, cur = utils.db_connect()
-
-    statement = """
-                SELECT artists.stage_name, ARRAY_AGG(DISTINCT songs.title), ARRAY_AGG(DISTINCT collabs.title), ARRAY_AGG(DISTINCT albums.title), ARRAY_AGG(DISTINCT playlists.name), ARRAY_AGG(DISTINCT playlists_author.display_name)
-                FROM artists
-                JOIN users ON artists.users_id = users.id
-                LEFT JOIN collaborations ON artists.users_id = collaborations.artists_users_id
-                LEFT JOIN songs AS collabs ON collaborations.songs_id = collabs.id
-                LEFT JOIN songs ON artists.users_id = songs.artists_users_id
-                LEFT JOIN albums ON albums.artists_users_id = artists.users_id
-                LEFT JOIN playlist_orders ON songs.id = playlist_orders.songs_id
-                LEFT JOIN playlists ON playlist_orders.playlists_id = playlists.id AND playlists.private = FALSE
-                LEFT JOIN consumers AS playlists_author ON playlists.consumers_users_id = playlists_author.users_id
-                WHERE artists.users_id = %s
-				GROUP BY artists.stage_name
-                """
-    values = (artist_id,)
+    artist_id = int(artist_id)
 
-    try:
-        cur.execute(statement, values)
-        row = cur.fetchone()
-        if not row:
-            response = {"results": f"No artist found with ID {artist_id}!"}
-        else:
-            stage_name = row[0]
-            songs = [song for song in row[1] if song]
-            collabs = [collab for collab in row[2] if collab]
-            albums = [album for album in row[3] if album]
-            playlists = [{"playlist": playlist, "author": author} for playlist, author in zip(row[4], row[5]) if playlist and author]
-            response = {"results":
-                            {
-                                "stage_name": stage_name,
-                                "released_songs": songs if songs else None,
-                                "featured_songs": collabs if collabs else None,
-                                "albums": albums if albums else None,
-                                "is_in_public_playlists": playlists if playlists else None,
-                            }
-                        }
-    except psycopg2.DatabaseError as e:
-        print(e)
-        flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+    entry = cached_response(("artist", artist_id), None)
+    if entry is None:
+        generation = response_cache.generation()
+        cur = utils.get_request_cursor()
 
-    finally:
-        utils.db_disconnect(conn, cur)
+        try:
+            statements.execute(cur, *artist_info_query(artist_id))
+            entry = cache_response(("artist", artist_id), None, artist_info_response(artist_id, cur.fetchone()), generation)
+        except psycopg2.DatabaseError as e:
+            print(e)
+            flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
+    return conditional_response(entry)
 
+# With a spool, plays are kept while the database is down even for users whose role isn't cached,
+# spooled plays of users that aren't consumers fail the foreign key to consumers on replay and are dropped there
 @app.route("/dbproj/<song_id>", methods=["PUT"])
-@requires_authentication(restrict = ["consumer"])
+@requires_authentication(restrict = ["consumer"], unavailable_role = "consumer" if stream_spool is not None else None)
 def stream_song(user_id, user_role, song_id):
     # Verify that the song id is valid
     try:
@@ -890,31 +1014,54 @@ def stream_song(user_id, user_role, song_id):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid song ID!")
 
     consumer_id = user_id
+    play = (song_id, consumer_id, time.time())
 
-    conn, cur = utils.db_connect()
+    try:
+        # With a spool there is a fallback for an unavailable database, so don't abort when the connection fails
+        cur = utils.get_request_cursor(abort_unavailable = stream_spool is None)
 
-    statement = """
-                INSERT INTO streams (songs_id, consumers_users_id, stream_time)
-                VALUES (%s, %s, CURRENT_TIMESTAMP)
-                RETURNING id
-                """
-    values = (song_id, consumer_id)
+        if stream_buffer is not None:
+            # Buffered ingestion only checks that the song exists, the play is written later in a batch
+            values = (song_id,)
+            statements.execute(cur, "song_exists", values)
 
-    try:
-        cur.execute(statement, values)
-        conn.commit()
-        stream_id = cur.fetchone()[0]
-        response = {"results": f"Song streamed and stored in history with ID {stream_id}!"}
+            if not cur.fetchone()[0]:
+                flask.abort(utils.StatusCodes["bad_request"], f"No song with ID {song_id} found!")
+            try:
+                stream_buffer.put(song_id, consumer_id)
+            except ingest.BufferFullError:
+                if stream_spool is None:
+                    flask.abort(utils.StatusCodes["service_unavailable"], "Too many streams being stored, please try again later!")
+                stream_spool.append([play])
+            response = {"results": "Song streamed and queued to be stored in history!"}
+        else:
+            values = (song_id, consumer_id)
+            statements.execute(cur, "add_stream", values)
+
+            stream_id = cur.fetchone()[0]
+            response = {"results": f"Song streamed and stored in history with ID {stream_id}!"}
+
+    except utils.TransientErrors:
+        raise
+    except werkzeug.exceptions.HTTPException:
+        raise
     except psycopg2.errors.ForeignKeyViolation:
-        conn.rollback()
         flask.abort(utils.StatusCodes["bad_request"], f"No song with ID {song_id} found!")
+    except (utils.PoolTimeoutError, psycopg2.OperationalError, psycopg2.InterfaceError):
+        if stream_spool is None:
+            flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+        # The database is degraded, keep the play on disk instead of losing it, it is replayed once the database recovers
+        utils.db_request_discard()
+        try:
+            stream_spool.append([play])
+        except OSError:
+            flask.abort(utils.StatusCodes["internal_error"], "Could not store the stream, please try again later!")
+        response = {"results": "Song streamed and queued to be stored in history!"}
+    except OSError:
+        flask.abort(utils.StatusCodes["internal_error"], "Could not store the stream, please try again later!")
     except psycopg2.DatabaseError:
-        conn.rollback()
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response)), utils.StatusCodes["success"]
 
 @app.route("/dbproj/card", methods=["POST"])
@@ -936,33 +1083,24 @@ def add_prepaid_card(user_id, user_role):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid credit! Expected integer with value: 15, 25, or 50")
 
     try:
-        conn, cur = utils.db_connect()
+        cur = utils.get_request_cursor()
 
-        statement = """
-                    INSERT INTO prepaid_cards (number, credit, expiration, administrators_users_id)
-                    VALUES (%s, %s, CURRENT_DATE + INTERVAL %s, %s)
-                    RETURNING id
-                    """
         values = (number, credit, expiration, admin_id)
 
-        cur.execute(statement, values)
+        statements.execute(cur, "add_prepaid_card", values)
         card_id = cur.fetchone()[0]
 
-        conn.commit()
         response = {"results": f"Card added with ID {card_id}!"}
 
+    except utils.TransientErrors:
+        raise
     except psycopg2.errors.UniqueViolation:
         flask.abort(utils.StatusCodes["bad_request"], f"Card with this number already exists!")
     except psycopg2.DatabaseError:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
     except werkzeug.exceptions.HTTPException:
-        conn.rollback()
-        utils.db_disconnect(conn, cur)
         raise
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/comment/<song_id>", methods=["POST"])
@@ -976,33 +1114,25 @@ def add_comment(user_id, user_role, song_id):
     except ValueError:
         flask.abort(utils.StatusCodes["bad_request"], "Invalid song ID!")
 
-    conn, cur = utils.db_connect()
+    cur = utils.get_request_cursor()
 
     consumer_id = user_id
     # Endpoint has no content field in this demo, add dummy text
     content = "Look at my nice comment!"
 
-    statement = """
-                INSERT INTO comments (content, post_time, comments_id, songs_id, consumers_users_id)
-                VALUES (%s, CURRENT_TIMESTAMP, %s, %s, %s)
-                RETURNING id
-                """
     values = (content, None, song_id, consumer_id)
 
     try:
-        cur.execute(statement, values)
-        conn.commit()
+        statements.execute(cur, "add_comment", values)
         comment_id = cur.fetchone()[0]
         response = {"results": f"Comment added with ID {comment_id}!"}
+    except utils.TransientErrors:
+        raise
     except psycopg2.errors.ForeignKeyViolation:
-        conn.rollback()
         flask.abort(utils.StatusCodes["bad_request"], f"No song with ID {song_id} found!")
     except psycopg2.DatabaseError:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/comment/<song_id>/<parent_comment_id>", methods=["POST"])
@@ -1023,70 +1153,46 @@ def add_comment_reply(user_id, user_role, song_id, parent_comment_id):
     except ValueError:
         flask.abort(utils.StatusCodes["bad_request"], "Invalid parent comment ID!")
 
-    conn, cur = utils.db_connect()
+    cur = utils.get_request_cursor()
 
     # Endpoint has no content field in this demo, add dummy text
     content = f"Look at my nice reply to number {parent_comment_id}!"
     consumer_id = user_id
 
-    statement = """
-                INSERT INTO comments (content, post_time, comments_id, songs_id, consumers_users_id)
-                VALUES (%s, CURRENT_TIMESTAMP, %s, %s, %s)
-                RETURNING id
-                """
     values = (content, parent_comment_id, song_id, consumer_id)
 
     try:
-        cur.execute(statement, values)
+        statements.execute(cur, "add_comment", values)
         comment_id = cur.fetchone()[0]
         # Check if user is replying to the newly generated ID for this very same reply by the DBMS (prevent infinite recursion)
         if int(comment_id) == parent_comment_id:
             raise psycopg2.errors.ForeignKeyViolation
-        conn.commit()
         response = {"results": f"Comment added with ID {comment_id}!"}
+    except utils.TransientErrors:
+        raise
     except psycopg2.errors.ForeignKeyViolation:
-        conn.rollback()
         flask.abort(utils.StatusCodes["bad_request"], f"No parent comment with ID {parent_comment_id} found for song with ID {song_id}!")
     except psycopg2.DatabaseError:
-        conn.rollback()
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/report/<year_month>", methods=["GET"])
-@requires_authentication(restrict = ["consumer"])
+@requires_authentication(restrict = ["consumer"], read_only = True)
 def get_report(user_id, user_role, year_month):
     if not utils.datetime_validate(year_month, "%Y-%m", past = True):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid year and month combination! Expected past date in format: YYYY-MM")
 
-    year_month = datetime.datetime.strptime(year_month, "%Y-%m")
-
-    # Subtract 12 months from the date
-    start_date = year_month - datetime.timedelta(days=365)
-    # Conver to timestamp
-    start_date = year_month.timestamp()
-    start_date = datetime.datetime.fromtimestamp(start_date)
+    year_month = datetime.datetime.strptime(year_month, "%Y-%m").date()
 
     consumer_id = user_id
 
-    conn, cur = utils.db_connect()
+    cur = utils.get_request_cursor()
 
-    statement = """
-                SELECT EXTRACT(YEAR FROM streams.stream_time) AS year,
-                       EXTRACT(MONTH FROM streams.stream_time) AS month, songs.genre, COUNT(*) AS playbacks
-                FROM streams
-                JOIN songs ON streams.songs_id = songs.id
-                WHERE streams.consumers_users_id = %s AND streams.stream_time >= %s
-                GROUP BY year, month, songs.genre
-                ORDER BY year DESC, month DESC, playbacks DESC;
-                """
-    values = (consumer_id, start_date)
+    values = (consumer_id, year_month, year_month)
 
     try:
-        cur.execute(statement, values)
+        statements.execute(cur, "genre_report", values)
         rows = cur.fetchall()
         if not rows:
             response = {"results": f"No stream history found for the 12 months before {year_month.strftime('%Y-%m')}!"}
@@ -1099,9 +1205,6 @@ def get_report(user_id, user_role, year_month):
     except psycopg2.DatabaseError:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 # All endpoints under here are extra (not required for project)
@@ -1125,32 +1228,23 @@ def add_publisher(user_id, user_role):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid email!")
 
     try:
-        conn, cur = utils.db_connect()
+        cur = utils.get_request_cursor()
 
-        statement = """
-                    INSERT INTO publishers (name, email)
-                    VALUES (%s, %s)
-                    RETURNING id
-                    """
         values = (name, email)
 
-        cur.execute(statement, values)
-        conn.commit()
+        statements.execute(cur, "add_publisher", values)
         publisher_id = cur.fetchone()[0]
         response = {"results": f"Publisher added with ID {publisher_id}!"}
 
+    except utils.TransientErrors:
+        raise
     except psycopg2.errors.UniqueViolation:
         flask.abort(utils.StatusCodes["bad_request"], "Email already in use!")
     except psycopg2.DatabaseError:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
     except werkzeug.exceptions.HTTPException:
-        conn.rollback()
-        utils.db_disconnect(conn, cur)
         raise
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/playlist/<playlist_id>", methods=["DELETE"])
@@ -1161,24 +1255,15 @@ def delete_playlist(user_id, user_role, playlist_id):
 
     consumer_id = user_id
 
-    conn, cur = utils.db_connect()
+    cur = utils.get_request_cursor()
 
-    statement = """
-                DELETE FROM playlists
-                WHERE id = %s AND consumers_users_id = %s AND (private = FALSE
-                """
     # Add extra condition to allow interaction with private playlists if user is a premium consumer
-    if user_role == "premium consumer":
-        statement += "OR playlists.private = TRUE)"
-    else:
-        statement += ")"
-    statement += "RETURNING id"
+    name = "delete_playlist_premium" if user_role == "premium consumer" else "delete_playlist"
     values = (playlist_id, consumer_id)
 
     try:
-        cur.execute(statement, values)
+        statements.execute(cur, name, values)
         rows = cur.fetchone()
-        conn.commit()
         if not rows:
             if user_role == "premium consumer":
                 response = {"results": f"No playlist of your authorship found with ID {playlist_id}!"}
@@ -1186,14 +1271,16 @@ def delete_playlist(user_id, user_role, playlist_id):
                 response = {"results":
                 f"No playlist of your authorship found with ID {playlist_id}, remember that your private playlists are only avaliable with premium!"}
         else:
+            invalidate("response", ("playlist", rows[0]))
+            if not rows[1]:
+                # Public playlists were listed in the info of the artists of their songs
+                invalidate("response", *(("artist", song_artist_id) for song_artist_id in rows[2]))
             response = {"results": f"Playlist deleted with ID {playlist_id}!"}
+    except utils.TransientErrors:
+        raise
     except psycopg2.DatabaseError:
-        conn.rollback()
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/ban", methods=["POST"])
@@ -1218,29 +1305,18 @@ def ban_user(user_id, user_role):
         "Invalid end time! Expected null (permanent) or future time string in ISO 8601 format: YYYY-MM-DDTHH:MM:SS")
 
     try:
-        conn, cur = utils.db_connect()
+        cur = utils.get_request_cursor()
 
-        statement = """
-                    SELECT end_time
-                    FROM bans
-                    WHERE users_id = %s AND (end_time > CURRENT_TIMESTAMP OR end_time IS NULL)
-                    """
         values = (user_id,)
-        cur.execute(statement, values)
+        statements.execute(cur, "active_ban", values)
 
         row = cur.fetchone()
         if row:
             end_time = row[0].strftime("%Y-%m-%d %H:%M:%S") if row[0] else "he is manually unbanned"
             flask.abort(utils.StatusCodes["bad_request"], f"User with ID {user_id} already has an active ban until {end_time}!")
 
-        statement = """
-                    INSERT INTO bans (administrators_users_id, users_id, reason, start_time, end_time, manual_unban)
-                    SELECT %s, %s, %s, CURRENT_TIMESTAMP, %s, FALSE
-                    WHERE NOT EXISTS (SELECT 1 FROM administrators WHERE users_id = %s)
-                    RETURNING id
-                    """
         values = (admin_id, user_id, reason, end_time, user_id)
-        cur.execute(statement, values)
+        statements.execute(cur, "add_ban", values)
 
         row = cur.fetchone()
         if not row:
@@ -1248,8 +1324,11 @@ def ban_user(user_id, user_role):
         else:
             response = {"results": f"Ban added with ID {row[0]}!"}
 
-        conn.commit()
+        # Every worker adds the ban to its ban list with when it ends, without waiting for its next refresh
+        invalidate("ban", (user_id, time.time() + float(row[1]) if row[1] is not None else None))
 
+    except utils.TransientErrors:
+        raise
     except werkzeug.exceptions.HTTPException:
         raise
     except psycopg2.errors.ForeignKeyViolation:
@@ -1257,8 +1336,6 @@ def ban_user(user_id, user_role):
     except Exception as e:
         print(e)
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-    finally:
-        utils.db_disconnect(conn, cur)
 
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
@@ -1269,92 +1346,71 @@ def unban_user(request_user_id, request_user_role, user_id):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid user ID! Expected integer in range: 1 to 9223372036854775807")
 
     try:
-        conn, cur = utils.db_connect()
-
-        # Only set end time to current time for unban instead of delete so we keep a record of the ban
-        statement = """
-                    UPDATE bans
-                    SET end_time = CURRENT_TIMESTAMP, manual_unban = TRUE
-                    WHERE users_id = %s AND (end_time > CURRENT_TIMESTAMP OR end_time IS NULL)
-                    RETURNING id
-                    """
+        cur = utils.get_request_cursor()
+
         values = (user_id,)
-        cur.execute(statement, values)
+        statements.execute(cur, "unban_user", values)
 
         row = cur.fetchone()
         if not row:
             response = {"results": f"No active ban found for user with ID {user_id}!"}
         else:
             response = {"results": f"User with ID {row[0]} unbanned!"}
+            invalidate("unban", int(user_id))
 
-        conn.commit()
-
+    except utils.TransientErrors:
+        raise
     except werkzeug.exceptions.HTTPException:
         raise
     except Exception:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-    finally:
-        utils.db_disconnect(conn, cur)
 
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/comment/<song_id>", methods=["GET"])
-@requires_authentication(restrict = ["consumer", "administrator"])
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
 def get_song_comments(user_id, user_role, song_id):
     if not utils.integer_validate(utils.string_to_int(song_id), min_val = 1, max_val = 9223372036854775807):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid song ID! Expected integer in range: 1 to 9223372036854775807")
 
+    limit, after = page_arguments((int,))
+
     try:
-        conn, cur = utils.db_connect()
+        cur = utils.get_request_cursor()
 
-        statement = """
-                    SELECT ARRAY_AGG(id)
-                    FROM comments
-                    WHERE songs_id = %s AND comments_id IS NULL
-                    """
-        values = (song_id,)
-        cur.execute(statement, values)
+        values = (song_id, after[0] if after is not None else 0, limit + 1)
+        statements.execute(cur, "song_comments", values)
 
-        row = cur.fetchone()
-        if not row:
+        rows, next_cursor = page_rows(cur.fetchall(), limit, lambda row: (row[0],))
+        if not rows:
             response = {"results": f"Song with ID {song_id} has no comments!"}
         else:
-            comment_ids = [comment_id for comment_id in row if comment_id]
             response = {"results":
                             {
-                                "comments_id": comment_ids if comment_ids else None,
-                            }
+                                "comments_id": [row[0] for row in rows],
+                            },
+                        "next": next_cursor
                         }
 
     except werkzeug.exceptions.HTTPException:
         raise
     except psycopg2.DatabaseError:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-    finally:
-        utils.db_disconnect(conn, cur)
 
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/comment_info/<comment_id>", methods=["GET"])
-@requires_authentication(restrict = ["consumer", "administrator"])
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
 def get_comment_info(user_id, user_role, comment_id):
     if not utils.integer_validate(utils.string_to_int(comment_id), min_val = 1, max_val = 9223372036854775807):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid comment ID! Expected integer in range: 1 to 9223372036854775807")
 
     try:
-        conn, cur = utils.db_connect()
-
-        statement = """
-                    SELECT comments.content, comments.post_time, consumers.display_name, ARRAY_AGG(replies.id)
-                    FROM comments
-                    LEFT JOIN consumers ON comments.consumers_users_id = consumers.users_id
-                    LEFT JOIN comments AS replies ON comments.id = replies.comments_id
-                    WHERE comments.id = %s
-                    GROUP BY comments.content, comments.post_time, consumers.display_name
-                    """
+        cur = utils.get_request_cursor()
+
         values = (comment_id,)
 
-        cur.execute(statement, values)
+        statements.execute(cur, "comment_info", values)
         row = cur.fetchone()
         if not row:
             response = {"results": f"No comment found with ID {comment_id}!"}
@@ -1374,8 +1430,6 @@ def get_comment_info(user_id, user_role, comment_id):
         raise
     except psycopg2.DatabaseError:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-    finally:
-        utils.db_disconnect(conn, cur)
 
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
@@ -1389,149 +1443,134 @@ def get_album(user_id, user_role, keyword):
 def get_album_info(user_id, user_role, album_id):
     flask.abort(utils.StatusCodes["not_implemented"], "This endpoint is not implemented yet!")
 
-@app.route("/dbproj/playlist/<keyword>", methods=["GET"])
-@requires_authentication(restrict = ["consumer", "administrator"])
-def get_playlist(user_id, user_role, keyword):
-    keyword = keyword.replace("+", " ")
-    keyword = f"%{keyword}%"
+def playlist_search_query(keyword, limit, after, user_id, user_role):
+    # Premium consumers also find their own private playlists
+    if user_role == "premium consumer":
+        name = "playlist_search_premium"
+        values = (keyword, f"%{keyword}%", user_id)
+    else:
+        name = "playlist_search"
+        values = (keyword, f"%{keyword}%")
 
-    consumer_id = user_id
+    # Start after the last row of the previous page among the closest matches up to the search depth, whatever the cursor says
+    if after is not None:
+        name += "_after"
+        values += (app.config["SEARCH_MAX_DEPTH"], after[0], after[1], limit + 1)
+    else:
+        values += (keyword, limit + 1)
+    return name, values
 
-    try:
-        conn, cur = utils.db_connect()
-
-        statement = """
-                    SELECT id, name, consumers.display_name
-                    FROM playlists
-                    LEFT JOIN consumers ON playlists.consumers_users_id = consumers.users_id
-                    WHERE name ILIKE %s AND (private = FALSE
-                    """
-        # Add extra condition to allow interaction with private playlists if user is a premium consumer
+def playlist_search_response(keyword, rows, limit, after, user_role):
+    found_playlists, next_cursor = search_page_rows(rows, limit, after, lambda playlist: (playlist[3], playlist[0]))
+    if not found_playlists:
         if user_role == "premium consumer":
-            statement += "OR (private = TRUE AND consumers_users_id = %s))"
-            values = (keyword, consumer_id)
-        else:
-            statement += ")"
-            values = (keyword,)
-
-        keyword = keyword.replace("%", "")
+            return {"results": f"No playlists found with keyword {keyword}!"}
+        return {"results": f"No playlists found with keyword {keyword}, remember that your private playlists are only avaliable with premium!"}
+    return {"results":
+                [
+                    {
+                        "playlist_id": playlist[0],
+                        "name": playlist[1],
+                        "author_name": playlist[2]
+                    }
+                for playlist in found_playlists
+                ],
+            "next": next_cursor
+            }
 
-        cur.execute(statement, values)
-        found_playlists  = cur.fetchall()
-        if not found_playlists:
-            if user_role == "premium consumer":
-                response = {"results": f"No playlists found with keyword {keyword}!"}
-            else:
-                response = {"results": f"No playlists found with keyword {keyword}, remember that your private playlists are only avaliable with premium!"}
-        else:
-            response = {"results":
-                            [
-                                {
-                                    "playlist_id": playlist[0],
-                                    "name": playlist[1],
-                                    "author_name": playlist[2]
-                                }
-                            for playlist in found_playlists
-                            ]
-                        }
+@app.route("/dbproj/playlist/<keyword>", methods=["GET"])
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
+def get_playlist(user_id, user_role, keyword):
+    keyword = keyword.replace("+", " ")
+    limit, after = page_arguments((float, int, int))
 
+    try:
+        cur = utils.get_request_cursor()
+        statements.execute(cur, *playlist_search_query(keyword, limit, after, user_id, user_role))
+        response = playlist_search_response(keyword, cur.fetchall(), limit, after, user_role)
     except werkzeug.exceptions.HTTPException:
         raise
     except Exception:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-    finally:
-        utils.db_disconnect(conn, cur)
 
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
-@app.route("/dbproj/playlist_info/<playlist_id>", methods=["GET"])
-@requires_authentication(restrict = ["consumer", "administrator"])
-def get_playlist_info(user_id, user_role, playlist_id):
-    if not utils.integer_validate(utils.string_to_int(playlist_id), min_val = 1, max_val = 9223372036854775807):
-        flask.abort(utils.StatusCodes["bad_request"], "Invalid playlist ID! Expected integer in range: 1 to 9223372036854775807")
-
-    conn, cur = utils.db_connect()
-
-    statement = """
-                SELECT name, consumers.display_name, private, ARRAY_AGG(songs.title)
-                FROM playlists
-                LEFT JOIN consumers ON playlists.consumers_users_id = consumers.users_id
-                LEFT JOIN playlist_orders ON playlists.id = playlist_orders.playlists_id
-                LEFT JOIN songs ON playlist_orders.songs_id = songs.id
-                WHERE playlists.id = %s AND (playlists.private = FALSE
-                """
+def playlist_info_query(playlist_id, user_id, user_role):
     # Add extra condition to allow interaction with private playlists if user is a premium consumer
     if user_role == "premium consumer":
-        statement += "OR (playlists.private = TRUE AND consumers_users_id = %s))"
-        values = (playlist_id, user_id)
-    else:
-        statement += ")"
-        values = (playlist_id,)
+        return "playlist_info_premium", (playlist_id, user_id)
+    return "playlist_info", (playlist_id,)
 
-    statement += "\nGROUP BY name, consumers.display_name, playlists.private"
-
-    try:
-        cur.execute(statement, values)
-        row = cur.fetchone()
-        if not row:
-            if user_role == "premium consumer":
-                response = {"results": f"No playlist found with ID {playlist_id}!"}
-            else:
-                response = {"results": f"No playlist found with ID {playlist_id}, remember that your private playlists are only avaliable with premium!"}
-        else:
-            playlist_name, creator_name, private = row[0:3]
-            song_names = [song_name for song_name in row[3] if song_name]
-            response = {"results":
-                            {
-                                "playlist_name": playlist_name,
-                                "creator_name": creator_name,
-                                "private": private,
-                                "song_names": song_names if song_names else None,
-                            }
-                        }
-    except psycopg2.DatabaseError as e:
-        print(e)
-        flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+def playlist_info_response(playlist_id, row, user_role):
+    if not row:
+        if user_role == "premium consumer":
+            return {"results": f"No playlist found with ID {playlist_id}!"}
+        return {"results": f"No playlist found with ID {playlist_id}, remember that your private playlists are only avaliable with premium!"}
+    playlist_name, creator_name, private = row[0:3]
+    song_names = [song_name for song_name in row[3] if song_name]
+    return {"results":
+                {
+                    "playlist_name": playlist_name,
+                    "creator_name": creator_name,
+                    "private": private,
+                    "song_names": song_names if song_names else None,
+                }
+            }
 
-    finally:
-        utils.db_disconnect(conn, cur)
+@app.route("/dbproj/playlist_info/<playlist_id>", methods=["GET"])
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
+def get_playlist_info(user_id, user_role, playlist_id):
+    if not utils.integer_validate(utils.string_to_int(playlist_id), min_val = 1, max_val = 9223372036854775807):
+        flask.abort(utils.StatusCodes["bad_request"], "Invalid playlist ID! Expected integer in range: 1 to 9223372036854775807")
 
-    return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
+    playlist_id = int(playlist_id)
+    variant = playlist_info_variant(user_id, user_role)
+
+    entry = cached_response(("playlist", playlist_id), variant)
+    if entry is None:
+        generation = response_cache.generation()
+        cur = utils.get_request_cursor()
+
+        try:
+            statements.execute(cur, *playlist_info_query(playlist_id, user_id, user_role))
+            entry = cache_response(("playlist", playlist_id), variant, playlist_info_response(playlist_id, cur.fetchone(), user_role), generation)
+        except psycopg2.DatabaseError as e:
+            print(e)
+            flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+
+    return conditional_response(entry)
+
+def artist_search_query(keyword, limit, after):
+    # The trigram index on the stage name serves the substring match and hands out the closest names first
+    if after is None:
+        return "artist_search", (keyword, f"%{keyword}%", keyword, limit + 1)
+    # Start after the last row of the previous page among the closest matches up to the search depth, whatever the cursor says
+    values = (keyword, f"%{keyword}%", app.config["SEARCH_MAX_DEPTH"], after[0], after[1], limit + 1)
+    return "artist_search_after", values
+
+def artist_search_response(keyword, rows, limit, after):
+    rows, next_cursor = search_page_rows(rows, limit, after, lambda row: (row[2], row[0]))
+    if not rows:
+        return {"results": f"No artists found with keyword {keyword}!"}
+    results = []
+    for row in rows:
+        results.append({"artist_id": row[0], "stage_name": row[1]})
+    return {"results": results, "next": next_cursor}
 
 @app.route("/dbproj/artist/<keyword>", methods=["GET"])
-@requires_authentication(restrict = ["consumer", "administrator"])
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
 def get_artist(user_id, user_role, keyword):
     keyword = keyword.replace("+", " ")
-    keyword = f"%{keyword}%"
-
-    conn, cur = utils.db_connect()
-
-    statement = """
-                SELECT users_id, stage_name
-                FROM artists
-                WHERE stage_name ILIKE %s
-                ORDER BY stage_name ASC
-                """
-    values = (keyword,)
+    limit, after = page_arguments((float, int, int))
 
-    keyword = keyword.replace("%", "")
+    cur = utils.get_request_cursor()
 
     try:
-        cur.execute(statement, values)
-        rows = cur.fetchall()
-        if not rows:
-            response = {"results": f"No artists found with keyword {keyword}!"}
-        else:
-            results = []
-            for row in rows:
-                results.append({"artist_id": row[0], "stage_name": row[1]})
-            response = {"results": results}
+        statements.execute(cur, *artist_search_query(keyword, limit, after))
+        response = artist_search_response(keyword, cur.fetchall(), limit, after)
     except psycopg2.DatabaseError:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
 
-    finally:
-        utils.db_disconnect(conn, cur)
-
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/comment/<starting_comment_id>", methods=["DELETE"])
@@ -1541,24 +1580,16 @@ def delete_comment_thread(user_id, user_role, starting_comment_id):
         flask.abort(utils.StatusCodes["bad_request"], "Invalid comment ID! Expected integer in range: 1 to 9223372036854775807")
 
     try:
-        conn, cur = utils.db_connect()
+        cur = utils.get_request_cursor()
 
         # User can only delete threads they started, administrators can delete any thread as part of moderation
         if user_role == "administrator":
-            statement = """
-                        DELETE FROM comments
-                        WHERE id = %s
-                        RETURNING id
-                        """
+            name = "delete_comment_thread"
             values = (starting_comment_id,)
         if user_role == "consumer" or user_role == "premium consumer":
-            statement = """
-                        DELETE FROM comments
-                        WHERE id = %s AND consumers_users_id = %s
-                        RETURNING id
-                        """
+            name = "delete_own_comment_thread"
             values = (starting_comment_id, user_id)
-        cur.execute(statement, values)
+        statements.execute(cur, name, values)
 
         comment_id = cur.fetchone()
         if not comment_id:
@@ -1569,36 +1600,25 @@ def delete_comment_thread(user_id, user_role, starting_comment_id):
         else:
             response = {"results": f"Thread deleted starting with comment ID {starting_comment_id}!"}
 
-        conn.commit()
-
+    except utils.TransientErrors:
+        raise
     except werkzeug.exceptions.HTTPException:
         raise
     except Exception:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-    finally:
-        utils.db_disconnect(conn, cur)
 
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/top10", methods=["GET"])
-@requires_authentication(restrict = ["consumer"])
+@requires_authentication(restrict = ["consumer"], read_only = True)
 def get_my_top10(user_id, user_role):
     consumer_id = user_id
 
     try:
-        conn, cur = utils.db_connect()
-
-        statement = """
-                    SELECT last_updated, top_10_orders.position, top_10_orders.stream_count, songs.title, artists.stage_name
-                    FROM top_10s
-                    LEFT JOIN top_10_orders ON top_10_orders.top_10s_consumers_users_id = top_10s.consumers_users_id
-                    LEFT JOIN songs ON songs.id = top_10_orders.songs_id
-                    LEFT JOIN artists ON artists.users_id = songs.artists_users_id
-                    WHERE top_10s.consumers_users_id = %s
-                    ORDER BY top_10_orders.position ASC
-                    """
+        cur = utils.get_request_cursor()
+
         values = (consumer_id,)
-        cur.execute(statement, values)
+        statements.execute(cur, "top10", values)
 
         rows = cur.fetchall()
         if not rows:
@@ -1619,43 +1639,65 @@ def get_my_top10(user_id, user_role):
         raise
     except Exception:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-    finally:
-        utils.db_disconnect(conn, cur)
 
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
 @app.route("/dbproj/subscription_info", methods=["GET"])
-@requires_authentication(restrict = ["consumer"])
+@requires_authentication(restrict = ["consumer"], read_only = True)
 def get_my_subscription_info(user_id, user_role):
     consumer_id = user_id
+    limit, after = page_arguments((datetime.datetime.fromisoformat, int))
 
     try:
-        conn, cur = utils.db_connect()
-
-        statement = """
-                    SELECT id, start_time, end_time
-                    FROM subscriptions
-                    WHERE consumers_users_id = %s AND end_time > CURRENT_TIMESTAMP
-                    ORDER BY end_time DESC
-                    """
-        values = (consumer_id,)
-        cur.execute(statement, values)
+        cur = utils.get_request_cursor()
 
-        rows = cur.fetchall()
+        # Seek past the last row of the previous page instead of skipping over every earlier page
+        if after is None:
+            name = "subscription_info"
+            values = (consumer_id, consumer_id, limit + 1)
+        else:
+            name = "subscription_info_after"
+            values = (consumer_id, consumer_id) + after + (limit + 1,)
+        statements.execute(cur, name, values)
+
+        rows, next_cursor = page_rows(cur.fetchall(), limit, lambda row: (row[2], row[0]))
         if not rows:
             response = {"results": "You have no active subscriptions!"}
         else:
             results = []
             for row in rows:
                 results.append({"subscription_id": row[0], "start_time": row[1], "end_time": row[2]})
-            response = {"results": {"acquired_subscriptions": results}}
+            response = {"results": {"acquired_subscriptions": results}, "next": next_cursor}
 
     except werkzeug.exceptions.HTTPException:
         raise
     except Exception:
         flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
-    finally:
-        utils.db_disconnect(conn, cur)
+
+    return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
+
+@app.route("/dbproj/stats", methods=["GET"])
+@requires_authentication(restrict = ["administrator"])
+def get_server_stats(user_id, user_role):
+    # Statistics are per worker process, each process keeps its own pool
+    response = {"results":
+                    {
+                        "pid": os.getpid(),
+                        "db_pool": utils.db_pool_stats(),
+                        "db_replica": utils.db_replica_stats(),
+                        "async_db_pool": asyncdb.db_pool_stats(),
+                        "async_db_replica": asyncdb.db_replica_stats(),
+                        "role_cache": role_cache.stats(),
+                        "response_cache": response_cache.stats(),
+                        "invalidation": invalidation_bus.stats(),
+                        "transaction_retries": transaction_runner.stats(),
+                        "banned_users": banned_users.stats(),
+                        "statements": statements.stats(),
+                        "stream_buffer": stream_buffer.stats() if stream_buffer is not None else None,
+                        "stream_spool": stream_spool.stats() if stream_spool is not None else None,
+                        "rate_limits": limiter.storage.stats() if isinstance(limiter.storage, ratelimit.SharedMemoryStorage) else None,
+                    }
+                }
 
     return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
 
@@ -1699,16 +1741,25 @@ def not_implemented(e):
     response = {"errors": e.description}
     return flask.make_response(flask.jsonify(response), e.code)
 
-if __name__ == "__main__":
-    # Load environment variables
-    dotenv.load_dotenv()
+@app.errorhandler(503)
+def service_unavailable(e):
+    response = {"errors": e.description}
+    return flask.make_response(flask.jsonify(response), e.code)
+
+def create_app():
+    # Checks the environment and finishes configuring the app, run once by each process before it serves requests
     required_environment = ["DB_HOST", "DB_PORT", "DB_NAME", "DB_USER", "DB_PASSWORD", "SERVER_HOST", "SERVER_PORT", "SECRET_KEY"]
     for variable in required_environment:
         if variable not in os.environ:
             raise Exception(f"Missing environment variable: {variable}, make sure to place it in your .env file!")
 
-    # Setup server
     app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")
+    preload_banned_users()
+    return app
+
+if __name__ == "__main__":
+    # Development server, use server.py to serve with several worker processes
+    create_app()
     host = os.environ.get("SERVER_HOST")
     port = os.environ.get("SERVER_PORT")
 
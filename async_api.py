@@ -0,0 +1,243 @@
+import functools
+import psycopg2
+import asyncio
+import flask
+import time
+import api
+import asyncdb
+import statements
+import utils
+import werkzeug # werkzeug.exceptions.HTTPException is raised when flask.abort() is called
+
+# Coroutine versions of the endpoints by Flask endpoint name, requests to any other endpoint run the WSGI app in a thread
+views = {}
+
+def async_view(function):
+    views[function.__name__] = function
+    return function
+
+async def load_banned_users(watermark):
+    cur = await asyncdb.get_request_cursor(abort_unavailable = False)
+    await statements.execute_async(cur, *api.banned_users_query(watermark))
+    return api.banned_users_changes(cur.fetchall())
+
+async def refresh_banned_users():
+    if api.banned_users.needs_refresh():
+        try:
+            await api.banned_users.refresh_async(load_banned_users)
+        except (utils.PoolTimeoutError, psycopg2.Error):
+            await asyncdb.db_request_discard()
+    if not api.banned_users.loaded():
+        flask.abort(utils.StatusCodes["service_unavailable"], "Database is unavailable, please try again later!")
+
+async def get_user_role(user_id):
+    cached = api.role_cache.get(user_id)
+    if cached is not None:
+        return cached
+    return await fetch_user_role(user_id)
+
+async def fetch_user_role(user_id):
+    generation = api.role_cache.generation()
+    try:
+        cur = await asyncdb.get_request_cursor()
+        await statements.execute_async(cur, *api.user_role_query(user_id))
+
+        user_role, role_expires_in = cur.fetchone()
+        if not user_role:
+            raise Exception
+
+    except werkzeug.exceptions.HTTPException:
+        raise
+    except Exception:
+        flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+
+    return api.cache_user_role(user_id, user_role, role_expires_in, generation)
+
+def requires_authentication(restrict = None, read_only = False):
+    # Same checks as api.requires_authentication, the role lookup and ban list refresh wait on the event loop
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            token_info = api.decode_request_token()
+            user_id = token_info["user_id"]
+            flask.g.user_id = user_id
+            if read_only:
+                utils.set_request_read_only(not api.pinned_to_primary(user_id))
+
+            await refresh_banned_users()
+            if user_id in api.banned_users:
+                user_role = "banned"
+            elif api.app.config["AUTH_ROLE_CLAIMS"] and "role" in token_info:
+                user_role = token_info["role"]
+                premium_until = token_info.get("premium_until")
+                if user_role == "premium consumer" and premium_until is not None and premium_until <= time.time():
+                    user_role, role_until = await get_user_role(user_id)
+                    flask.g.refreshed_token = api.encode_token(user_id, user_role, role_until)
+            else:
+                user_role, _ = await get_user_role(user_id)
+
+            api.check_user_role(user_role, restrict)
+            return await function(user_id, user_role, *args, **kwargs)
+        return wrapper
+    return decorator
+
+@async_view
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
+async def get_song(user_id, user_role, keyword):
+    keyword = keyword.replace("+", " ")
+    limit, after = api.page_arguments((float, int, int))
+
+    cur = await asyncdb.get_request_cursor()
+
+    try:
+        await statements.execute_async(cur, *api.song_search_query(keyword, limit, after))
+        response = api.song_search_response(keyword, cur.fetchall(), limit, after)
+    except psycopg2.DatabaseError:
+        flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+
+    return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
+
+@async_view
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
+async def get_song_info(user_id, user_role, song_id):
+    if not utils.integer_validate(utils.string_to_int(song_id), min_val = 1, max_val = 9223372036854775807):
+        flask.abort(utils.StatusCodes["bad_request"], "Invalid song ID! Expected integer in range: 1 to 9223372036854775807")
+
+    song_id = int(song_id)
+
+    entry = api.cached_response(("song", song_id), None)
+    if entry is None:
+        generation = api.response_cache.generation()
+        cur = await asyncdb.get_request_cursor()
+
+        try:
+            await statements.execute_async(cur, *api.song_info_query(song_id))
+            entry = api.cache_response(("song", song_id), None, api.song_info_response(song_id, cur.fetchone()), generation)
+        except psycopg2.DatabaseError:
+            flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+
+    return api.conditional_response(entry)
+
+@async_view
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
+async def get_artist_info(user_id, user_role, artist_id):
+    if not utils.integer_validate(utils.string_to_int(artist_id), min_val = 1, max_val = 9223372036854775807):
+        flask.abort(utils.StatusCodes["bad_request"], "Invalid artist ID! Expected integer in range: 1 to 9223372036854775807")
+
+    artist_id = int(artist_id)
+
+    entry = api.cached_response(("artist", artist_id), None)
+    if entry is None:
+        generation = api.response_cache.generation()
+        cur = await asyncdb.get_request_cursor()
+
+        try:
+            await statements.execute_async(cur, *api.artist_info_query(artist_id))
+            entry = api.cache_response(("artist", artist_id), None, api.artist_info_response(artist_id, cur.fetchone()), generation)
+        except psycopg2.DatabaseError:
+            flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+
+    return api.conditional_response(entry)
+
+@async_view
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
+async def get_playlist(user_id, user_role, keyword):
+    keyword = keyword.replace("+", " ")
+    limit, after = api.page_arguments((float, int, int))
+
+    cur = await asyncdb.get_request_cursor()
+
+    try:
+        await statements.execute_async(cur, *api.playlist_search_query(keyword, limit, after, user_id, user_role))
+        response = api.playlist_search_response(keyword, cur.fetchall(), limit, after, user_role)
+    except psycopg2.DatabaseError:
+        flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+
+    return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
+
+@async_view
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
+async def get_playlist_info(user_id, user_role, playlist_id):
+    if not utils.integer_validate(utils.string_to_int(playlist_id), min_val = 1, max_val = 9223372036854775807):
+        flask.abort(utils.StatusCodes["bad_request"], "Invalid playlist ID! Expected integer in range: 1 to 9223372036854775807")
+
+    playlist_id = int(playlist_id)
+    variant = api.playlist_info_variant(user_id, user_role)
+
+    entry = api.cached_response(("playlist", playlist_id), variant)
+    if entry is None:
+        generation = api.response_cache.generation()
+        cur = await asyncdb.get_request_cursor()
+
+        try:
+            await statements.execute_async(cur, *api.playlist_info_query(playlist_id, user_id, user_role))
+            entry = api.cache_response(("playlist", playlist_id), variant, api.playlist_info_response(playlist_id, cur.fetchone(), user_role), generation)
+        except psycopg2.DatabaseError:
+            flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+
+    return api.conditional_response(entry)
+
+@async_view
+@requires_authentication(restrict = ["consumer", "administrator"], read_only = True)
+async def get_artist(user_id, user_role, keyword):
+    keyword = keyword.replace("+", " ")
+    limit, after = api.page_arguments((float, int, int))
+
+    cur = await asyncdb.get_request_cursor()
+
+    try:
+        await statements.execute_async(cur, *api.artist_search_query(keyword, limit, after))
+        response = api.artist_search_response(keyword, cur.fetchall(), limit, after)
+    except psycopg2.DatabaseError:
+        flask.abort(utils.StatusCodes["internal_error"], "Database failed to execute query!")
+
+    return flask.make_response(flask.jsonify(response), utils.StatusCodes["success"])
+
+def call_wsgi(environ):
+    # Runs a request through the WSGI app in a worker thread and returns (status, headers, body)
+    started = {}
+    def start_response(status, headers, exc_info = None):
+        started["status"] = status
+        started["headers"] = headers
+    iterable = api.app(environ, start_response)
+    try:
+        body = b"".join(iterable)
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+    return started["status"], started["headers"], body
+
+async def dispatch(environ, executor):
+    # Routes with the app's URL map, so both kinds of endpoint answer the same paths with the same errors
+    app = api.app
+    try:
+        endpoint, _ = app.url_map.bind_to_environ(environ).match()
+    except werkzeug.exceptions.HTTPException:
+        endpoint = None
+    if endpoint not in views:
+        return await asyncio.get_running_loop().run_in_executor(executor, call_wsgi, environ)
+
+    # Mirrors Flask's own dispatch, so the rate limits, error handlers and after request hooks apply as usual
+    context = app.request_context(environ)
+    error = None
+    try:
+        context.push()
+        try:
+            result = app.preprocess_request()
+            if result is None:
+                result = await views[endpoint](**flask.request.view_args)
+        except Exception as exception:
+            result = app.handle_user_exception(exception)
+        response = app.make_response(result)
+        try:
+            await asyncdb.db_request_finish(commit = response.status_code < 400)
+        except psycopg2.DatabaseError:
+            response = flask.make_response(flask.jsonify({"errors": "Database failed to commit transaction!"}), utils.StatusCodes["internal_error"])
+        response = app.finalize_request(response)
+    except Exception as exception:
+        error = exception
+        response = app.handle_exception(exception)
+    finally:
+        await asyncdb.db_request_teardown()
+        context.pop(error)
+    return response.status, response.headers.to_wsgi_list(), response.get_data()
@@ -0,0 +1,345 @@
+import collections
+import psycopg2
+import psycopg2.extensions
+import asyncio
+import flask
+import time
+import os
+import utils
+
+async def wait(conn):
+    # Polls an asynchronous psycopg2 connection until the pending operation finishes, waiting on the event loop in between
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f"Unexpected connection poll state {state}")
+        fd = conn.fileno()
+        future = loop.create_future()
+        add(fd, lambda: future.done() or future.set_result(None))
+        try:
+            await future
+        finally:
+            remove(fd)
+
+async def connect(**connect_kwargs):
+    conn = psycopg2.connect(async_ = True, **connect_kwargs)
+    try:
+        await wait(conn)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+class AsyncCursor:
+    # Cursor of an asynchronous connection, execute() must be awaited before fetching the results
+    def __init__(self, conn):
+        self.connection = conn
+        self._cursor = conn.cursor()
+
+    async def execute(self, statement, values = None):
+        self._cursor.execute(statement, values)
+        try:
+            await wait(self.connection)
+        except asyncio.CancelledError:
+            # The query is still running, the connection can't be used again
+            self.connection.close()
+            raise
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        if not self._cursor.closed:
+            self._cursor.close()
+
+class AsyncConnectionPool:
+    # Pool of asynchronous psycopg2 connections for a single event loop, same policy as utils.ConnectionPool
+    # Asynchronous connections are always in autocommit mode, transactions are started and ended with explicit statements
+    def __init__(self, min_size, max_size, timeout, max_age, ping_after, **connect_kwargs):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.ping_after = ping_after
+        self.connect_kwargs = connect_kwargs
+
+        self._condition = asyncio.Condition()
+        # Idle entries are (connection, created_at, released_at), in use entries map id(connection) -> created_at
+        self._idle = collections.deque()
+        self._idle_ids = set()
+        self._in_use = {}
+        self._size = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._waiting = 0
+        self._waiting_max = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    async def _release_slot(self):
+        async with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    async def _take(self, deadline):
+        # Returns an idle connection entry, or None if a slot was reserved to open a new connection
+        async with self._condition:
+            while True:
+                if self._closed:
+                    raise utils.PoolTimeoutError("Connection pool is closed")
+                if self._idle:
+                    entry = self._idle.pop()
+                    self._idle_ids.discard(id(entry[0]))
+                    return entry
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise utils.PoolTimeoutError(f"No database connection available after {self.timeout} seconds")
+                self._waiting += 1
+                self._waiting_max = max(self._waiting_max, self._waiting)
+                try:
+                    await asyncio.wait_for(self._condition.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self._waiting -= 1
+
+    async def _is_alive(self, conn, created_at, released_at):
+        now = time.monotonic()
+        if conn.closed:
+            return False
+        if self.max_age is not None and now - created_at > self.max_age:
+            return False
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        # Only ping connections that sat idle for a while, recently used ones are assumed to be alive
+        if now - released_at > self.ping_after:
+            try:
+                cur = AsyncCursor(conn)
+                await cur.execute("SELECT 1")
+                cur.close()
+            except psycopg2.Error:
+                return False
+        return True
+
+    async def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self._discarded += 1
+        await self._release_slot()
+
+    async def open(self):
+        # Opens the minimum number of connections up front
+        while self._size < self.min_size:
+            self._size += 1
+            try:
+                conn = await connect(**self.connect_kwargs)
+            except BaseException:
+                await self._release_slot()
+                raise
+            async with self._condition:
+                self._idle.append((conn, time.monotonic(), time.monotonic()))
+                self._idle_ids.add(id(conn))
+                self._condition.notify()
+
+    async def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            entry = await self._take(deadline)
+            if entry is None:
+                try:
+                    conn = await connect(**self.connect_kwargs)
+                except BaseException:
+                    await self._release_slot()
+                    raise
+                created_at = time.monotonic()
+            else:
+                conn, created_at, released_at = entry
+                try:
+                    alive = await self._is_alive(conn, created_at, released_at)
+                except BaseException:
+                    await self._discard(conn)
+                    raise
+                if not alive:
+                    await self._discard(conn)
+                    continue
+
+            waited = time.monotonic() - start
+            self._in_use[id(conn)] = created_at
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            return conn
+
+    async def putconn(self, conn):
+        # Returns False if the connection does not belong to this pool, releasing twice is harmless
+        if id(conn) in self._idle_ids:
+            return True
+        created_at = self._in_use.pop(id(conn), None)
+        if created_at is None:
+            return False
+
+        if not conn.closed and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                await AsyncCursor(conn).execute("ROLLBACK")
+            except psycopg2.Error:
+                conn.close()
+        expired = self.max_age is not None and time.monotonic() - created_at > self.max_age
+        if self._closed or conn.closed or expired:
+            await self._discard(conn)
+        else:
+            async with self._condition:
+                self._idle.append((conn, created_at, time.monotonic()))
+                self._idle_ids.add(id(conn))
+                self._condition.notify()
+        return True
+
+    async def closeall(self):
+        async with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._idle_ids.clear()
+            self._condition.notify_all()
+        for conn, _, _ in idle:
+            await self._discard(conn)
+
+    def stats(self):
+        return {
+            "size": self._size,
+            "in_use": len(self._in_use),
+            "idle": len(self._idle),
+            "waiting": self._waiting,
+            "waiting_max": self._waiting_max,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "checkouts": self._checkouts,
+            "timeouts": self._timeouts,
+            "discarded": self._discarded,
+            "wait_time_total": round(self._wait_total, 6),
+            "wait_time_max": round(self._wait_max, 6),
+            "wait_time_avg": round(self._wait_total / self._checkouts, 6) if self._checkouts else 0.0,
+        }
+
+_db_pool = None
+_db_pool_pid = None
+_db_replica_pool = None
+
+def db_pool():
+    global _db_pool, _db_pool_pid, _db_replica_pool
+    # Only used from the event loop thread, so there is no lock around the lazy creation
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        _db_pool = AsyncConnectionPool(
+            min_size = int(os.environ.get("DB_POOL_MIN_SIZE", 1)),
+            max_size = int(os.environ.get("DB_ASYNC_POOL_MAX_SIZE", os.environ.get("DB_POOL_MAX_SIZE", 20))),
+            timeout = float(os.environ.get("DB_POOL_TIMEOUT", 5)),
+            max_age = float(os.environ.get("DB_POOL_MAX_AGE", 1800)),
+            ping_after = float(os.environ.get("DB_POOL_PING_AFTER", 10)),
+            connection_factory = utils.db_connection_factory(),
+            **utils.db_settings()
+        )
+        _db_replica_pool = None
+        _db_pool_pid = os.getpid()
+    return _db_pool
+
+def db_replica_pool():
+    # Same settings as utils.db_replica_pool, None if no replica is configured
+    global _db_replica_pool
+    settings = utils.db_replica_settings()
+    if settings is None:
+        return None
+    db_pool()
+    if _db_replica_pool is None:
+        _db_replica_pool = AsyncConnectionPool(
+            min_size = 0,
+            max_size = int(os.environ.get("DB_ASYNC_POOL_MAX_SIZE", os.environ.get("DB_POOL_MAX_SIZE", 20))),
+            timeout = float(os.environ.get("DB_REPLICA_POOL_TIMEOUT", 1)),
+            max_age = float(os.environ.get("DB_POOL_MAX_AGE", 1800)),
+            ping_after = float(os.environ.get("DB_POOL_PING_AFTER", 10)),
+            connection_factory = utils.db_connection_factory(),
+            **settings
+        )
+    return _db_replica_pool
+
+def db_pool_stats():
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        return None
+    return _db_pool.stats()
+
+def db_replica_stats():
+    if _db_pool_pid != os.getpid() or _db_replica_pool is None:
+        return None
+    return _db_replica_pool.stats()
+
+async def close_db_pool():
+    if _db_pool_pid == os.getpid():
+        for pool in (_db_pool, _db_replica_pool):
+            if pool is not None:
+                await pool.closeall()
+
+async def _connect(abort_unavailable, read_only):
+    replica = db_replica_pool() if read_only else None
+    if replica is not None:
+        try:
+            conn = await replica.getconn()
+            utils.record_read_routing("replica")
+            return replica, conn
+        except (utils.PoolTimeoutError, psycopg2.OperationalError):
+            utils.record_read_routing("primary_fallback")
+    try:
+        return db_pool(), await db_pool().getconn()
+    except utils.PoolTimeoutError:
+        if not abort_unavailable:
+            raise
+        flask.abort(utils.StatusCodes["service_unavailable"], "Database is busy, please try again later!")
+    except psycopg2.OperationalError:
+        if not abort_unavailable:
+            raise
+        flask.abort(utils.StatusCodes["internal_error"], "Could not connect to the database!")
+
+async def get_request_cursor(abort_unavailable = True):
+    # One connection and one transaction per request like utils.get_request_cursor, kept apart from the synchronous one
+    if "async_db" not in flask.g:
+        pool, conn = await _connect(abort_unavailable, flask.g.get("db_read_only", False))
+        cur = AsyncCursor(conn)
+        flask.g.async_db = (pool, conn, cur)
+        await cur.execute("BEGIN")
+    return flask.g.async_db[2]
+
+async def db_request_discard():
+    db = flask.g.pop("async_db", None)
+    if db is not None:
+        pool, conn, cur = db
+        cur.close()
+        await pool.putconn(conn)
+
+async def db_request_finish(commit):
+    db = flask.g.get("async_db")
+    if db is not None and not db[1].closed:
+        await db[2].execute("COMMIT" if commit else "ROLLBACK")
+
+async def db_request_teardown():
+    await db_request_discard()
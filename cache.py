@@ -0,0 +1,230 @@
+import collections
+import threading
+import asyncio
+import time
+
+class LRUCache:
+    # Thread-safe bounded mapping with least recently used eviction and a time to live per entry
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # Maps key -> (value, expires_at) in least to most recently used order
+        self._entries = collections.OrderedDict()
+        # Bumped on every invalidation so values read from the database before a write can't be cached after it
+        self._generation = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def get(self, key, default = None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self._removed(key)
+                self._misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def set(self, key, value, ttl = None, generation = None):
+        # The entry lives for the cache ttl, or less if the caller knows the value expires sooner
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return False
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            self._added(key)
+            while len(self._entries) > self.max_size:
+                evicted, _ = self._entries.popitem(last = False)
+                self._removed(evicted)
+                self._evictions += 1
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(key, None) is not None:
+                self._removed(key)
+                self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+            self._cleared()
+
+    # Called with the lock held as keys come and go, for subclasses that index the keys
+    def _added(self, key):
+        pass
+
+    def _removed(self, key):
+        pass
+
+    def _cleared(self):
+        pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
+
+class ResponseCache(LRUCache):
+    # Rendered responses keyed by (resource, variant), the variant being what the viewer is allowed to see
+    # A write to a resource invalidates every variant of it at once
+    def __init__(self, max_size, ttl):
+        super().__init__(max_size, ttl)
+        # Maps resource -> variants of it currently cached
+        self._variants = collections.defaultdict(set)
+
+    def _added(self, key):
+        self._variants[key[0]].add(key[1])
+
+    def _removed(self, key):
+        variants = self._variants.get(key[0])
+        if variants is not None:
+            variants.discard(key[1])
+            if not variants:
+                del self._variants[key[0]]
+
+    def _cleared(self):
+        self._variants.clear()
+
+    def invalidate_resource(self, resource):
+        with self._lock:
+            self._generation += 1
+            for variant in self._variants.pop(resource, ()):
+                if self._entries.pop((resource, variant), None) is not None:
+                    self._invalidations += 1
+
+class RevocationList:
+    # Revoked ids kept in memory with the unix time each revocation ends, refreshed incrementally through a loader at most once per interval
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        # Threads and coroutines refresh one at a time among themselves, a thread lock can't be held across an await
+        self._refresh_lock = threading.Lock()
+        self._async_refresh_lock = asyncio.Lock()
+        # Maps id -> end of the revocation, or None if it doesn't end, replaced instead of changed so lookups need no lock
+        self._revoked = {}
+        # Where the loader left off, None until the first load, which reads every current revocation
+        self._watermark = None
+        self._refreshed_at = None
+        # A thread and a coroutine can refresh at the same time, only a load started after the last applied one is applied
+        self._loads_started = 0
+        self._load_applied = 0
+
+        self._refreshes = 0
+
+    def loaded(self):
+        with self._lock:
+            return self._watermark is not None
+
+    def needs_refresh(self):
+        with self._lock:
+            return self._refreshed_at is None or time.monotonic() - self._refreshed_at >= self.refresh_interval
+
+    def refresh(self, loader):
+        # Only one thread refreshes at a time, the others keep using the current set, or wait for it until the first load
+        if not self._refresh_lock.acquire(blocking = not self.loaded()):
+            return False
+        try:
+            if not self.needs_refresh():
+                return True
+            load, watermark = self._start_load()
+            # The loader returns the new watermark, the ids revoked since the last one with when they end and the ids no longer revoked
+            self._apply(load, *loader(watermark))
+            return True
+        finally:
+            self._refresh_lock.release()
+
+    async def refresh_async(self, loader):
+        # Same as refresh for a coroutine loader, used when serving on an event loop, it never waits for another refresh
+        if self._async_refresh_lock.locked():
+            return False
+        async with self._async_refresh_lock:
+            if not self.needs_refresh():
+                return True
+            load, watermark = self._start_load()
+            self._apply(load, *await loader(watermark))
+            return True
+
+    def _start_load(self):
+        with self._lock:
+            self._loads_started += 1
+            return self._loads_started, self._watermark
+
+    def _apply(self, load, watermark, revoked, cleared):
+        now = time.time()
+        with self._lock:
+            if load < self._load_applied:
+                # A load that started later was already applied, this one would bring back older state
+                return
+            self._load_applied = load
+            current = dict(self._revoked)
+            for key in cleared:
+                current.pop(key, None)
+            current.update(revoked)
+            # Revocations that ended are dropped here, lookups already ignore them in between
+            self._revoked = {key: until for key, until in current.items() if until is None or until > now}
+            self._watermark = watermark
+            self._refreshed_at = time.monotonic()
+            self._refreshes += 1
+
+    def expire(self):
+        # The next check refreshes the list again, used when changes to it may have been missed
+        with self._lock:
+            self._refreshed_at = None
+
+    def add(self, key, until = None):
+        with self._lock:
+            self._revoked = {**self._revoked, key: until}
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._revoked:
+                self._revoked = {other: until for other, until in self._revoked.items() if other != key}
+
+    def __contains__(self, key):
+        revoked = self._revoked
+        if key not in revoked:
+            return False
+        until = revoked[key]
+        return until is None or until > time.time()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._revoked),
+                "loaded": self._watermark is not None,
+                "refreshes": self._refreshes,
+                "refresh_interval": self.refresh_interval,
+            }
@@ -0,0 +1,197 @@
+import collections
+import threading
+import psycopg2
+import psycopg2.extras
+import time
+import os
+import utils
+
+class BufferFullError(Exception):
+    pass
+
+def insert_streams(cur, plays):
+    # Plays keep the time they were received, the age is applied to the database clock to avoid clock skew
+    now = time.time()
+    statement = "INSERT INTO streams (songs_id, consumers_users_id, stream_time) VALUES %s"
+    template = "(%s, %s, CURRENT_TIMESTAMP - %s * INTERVAL '1 second')"
+    values = [(song_id, consumer_id, max(now - played_at, 0)) for song_id, consumer_id, played_at in plays]
+    psycopg2.extras.execute_values(cur, statement, values, template = template, page_size = len(values))
+
+def insert_streams_skipping_invalid(conn, cur, plays, before_commit = None):
+    # One bad row fails the whole batch, in that case the rows are inserted one by one and only the invalid ones dropped
+    # Returns how many plays were dropped, before_commit runs inside every transaction that gets committed
+    try:
+        insert_streams(cur, plays)
+        if before_commit:
+            before_commit(cur)
+        conn.commit()
+        return 0
+    except (psycopg2.IntegrityError, psycopg2.DataError):
+        conn.rollback()
+
+    dropped = 0
+    for play in plays:
+        cur.execute("SAVEPOINT play")
+        try:
+            insert_streams(cur, [play])
+        except (psycopg2.IntegrityError, psycopg2.DataError):
+            cur.execute("ROLLBACK TO SAVEPOINT play")
+            dropped += 1
+    if before_commit:
+        before_commit(cur)
+    conn.commit()
+    return dropped
+
+class StreamBuffer:
+    # Collects stream plays in memory and writes them to the streams table in batches from a background thread
+    def __init__(self, max_batch, flush_interval, max_size, put_timeout, spool = None):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.put_timeout = put_timeout
+        # Batches that can't be written because the database is unavailable go to the spool if there is one
+        self.spool = spool
+
+        self._condition = threading.Condition()
+        # Entries are (song_id, consumer_id, played_at) in arrival order
+        self._queue = collections.deque()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+
+        self._accepted = 0
+        self._rejected = 0
+        self._batches = 0
+        self._rows = 0
+        self._dropped = 0
+        self._spooled = 0
+        self._spool_failures = 0
+        self._failures = 0
+        self._batch_size_max = 0
+        self._flush_time_total = 0.0
+        self._flush_time_max = 0.0
+
+    def _ensure_started(self):
+        # The flusher thread is started on first use so forked workers each get their own
+        if self._thread is None or self._pid != os.getpid():
+            self._queue.clear()
+            self._stopping = False
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target = self._run, name = "stream-buffer", daemon = True)
+            self._thread.start()
+
+    def put(self, song_id, consumer_id):
+        deadline = time.monotonic() + self.put_timeout
+        with self._condition:
+            self._ensure_started()
+            # Backpressure, wait for the flusher to make room and give up after the timeout
+            while len(self._queue) >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stopping:
+                    self._rejected += 1
+                    raise BufferFullError("Stream buffer is full")
+                self._condition.wait(remaining)
+            self._queue.append((song_id, consumer_id, time.time()))
+            self._accepted += 1
+            if len(self._queue) >= self.max_batch:
+                self._condition.notify_all()
+
+    def _next_batch(self):
+        with self._condition:
+            while True:
+                if self._queue:
+                    oldest = self._queue[0][2]
+                    wait = oldest + self.flush_interval - time.time()
+                    if len(self._queue) >= self.max_batch or wait <= 0 or self._stopping:
+                        break
+                elif self._stopping:
+                    return None
+                else:
+                    wait = None
+                self._condition.wait(wait)
+            batch = [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+            # Wake up producers waiting for room
+            self._condition.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            while not self._flush(batch):
+                if self.spool is not None:
+                    try:
+                        self.spool.append(batch)
+                    except OSError:
+                        # The disk is full or failing, the plays are kept like when there is no spool
+                        with self._condition:
+                            self._spool_failures += 1
+                    else:
+                        with self._condition:
+                            self._spooled += len(batch)
+                        break
+                # The database is unavailable, keep the plays and retry after a pause
+                if self._stopping:
+                    with self._condition:
+                        self._dropped += len(batch)
+                    return
+                time.sleep(self.flush_interval)
+
+    def _flush(self, batch):
+        start = time.monotonic()
+        try:
+            conn = utils.db_pool().getconn()
+        except (utils.PoolTimeoutError, psycopg2.OperationalError):
+            with self._condition:
+                self._failures += 1
+            return False
+
+        try:
+            cur = conn.cursor()
+            dropped = insert_streams_skipping_invalid(conn, cur, batch)
+            cur.close()
+        except psycopg2.Error:
+            with self._condition:
+                self._failures += 1
+            return False
+        finally:
+            utils.db_pool().putconn(conn)
+
+        elapsed = time.monotonic() - start
+        with self._condition:
+            self._batches += 1
+            self._rows += len(batch) - dropped
+            self._dropped += dropped
+            self._batch_size_max = max(self._batch_size_max, len(batch))
+            self._flush_time_total += elapsed
+            self._flush_time_max = max(self._flush_time_max, elapsed)
+        return True
+
+    def stop(self, timeout = None):
+        # Flushes everything still buffered before returning, used on shutdown
+        with self._condition:
+            if self._thread is None or self._pid != os.getpid():
+                return
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "buffered": len(self._queue),
+                "max_size": self.max_size,
+                "accepted": self._accepted,
+                "rejected": self._rejected,
+                "batches": self._batches,
+                "rows": self._rows,
+                "dropped": self._dropped,
+                "spooled": self._spooled,
+                "spool_failures": self._spool_failures,
+                "failures": self._failures,
+                "batch_size_avg": round(self._rows / self._batches, 2) if self._batches else 0.0,
+                "batch_size_max": self._batch_size_max,
+                "flush_time_avg": round(self._flush_time_total / self._batches, 6) if self._batches else 0.0,
+                "flush_time_max": round(self._flush_time_max, 6),
+            }
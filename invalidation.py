@@ -0,0 +1,204 @@
+import psycopg2
+import psycopg2.sql
+import threading
+import select
+import json
+import time
+import os
+import sys
+import uuid
+import traceback
+import statements
+
+# NOTIFY payloads must stay under 8000 bytes, events of a write are split over as many notifications as needed
+MAX_PAYLOAD_BYTES = 7000
+
+statements.register("notify_invalidations", """
+    SELECT pg_notify(%s, payload) FROM UNNEST(%s::text[]) AS payload
+    """, prepare = True)
+
+class InvalidationBus:
+    # Cache invalidations of the writes, published with NOTIFY in the writing transaction and applied by a listener in every worker
+    # Events are (kind, key) pairs, each kind has a handler that evicts the key from the caches of the process
+    def __init__(self, channel, connect_kwargs, ping_interval, reconnect_delay):
+        self.channel = channel
+        self.connect_kwargs = connect_kwargs
+        self.ping_interval = ping_interval
+        self.reconnect_delay = reconnect_delay
+
+        self._handlers = {}
+        self._flush_handlers = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self._connected = False
+        self._token = None
+        self._token_pid = None
+
+        self._published = 0
+        self._notifications = 0
+        self._received = 0
+        self._applied = 0
+        self._flushes = 0
+        self._reconnects = 0
+        self._errors = 0
+        self._handler_errors = 0
+        self._delay_last = None
+        self._delay_total = 0.0
+        self._delay_max = 0.0
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def handler(self, kind):
+        return self._handlers[kind]
+
+    def register_flush(self, handler):
+        # Called after the listener reconnects, the events sent while it was disconnected are lost so the caches are emptied
+        self._flush_handlers.append(handler)
+
+    def token(self):
+        # Identifies the publishing process across hosts and containers, where pids repeat, a forked worker draws its own
+        if self._token_pid != os.getpid():
+            with self._lock:
+                if self._token_pid != os.getpid():
+                    self._token = uuid.uuid4().hex
+                    self._token_pid = os.getpid()
+        return self._token
+
+    def payloads(self, events):
+        # The token lets the publishing process skip its own notifications, it already applies its events when the write commits
+        payloads = []
+        batch = []
+        size = 0
+        for event in events:
+            encoded = json.dumps(event, separators = (",", ":"))
+            if batch and size + len(encoded) + 1 > MAX_PAYLOAD_BYTES:
+                payloads.append(batch)
+                batch = []
+                size = 0
+            batch.append(encoded)
+            size += len(encoded) + 1
+        if batch:
+            payloads.append(batch)
+        sent_at = time.time()
+        return [f'{{"from":"{self.token()}","at":{sent_at!r},"events":[{",".join(encoded_events)}]}}' for encoded_events in payloads]
+
+    def publish(self, cur, events):
+        # Listeners only get the notifications once the transaction commits, and never if it rolls back
+        if self.channel is None:
+            return
+        payloads = self.payloads(events)
+        if payloads:
+            statements.execute(cur, "notify_invalidations", (self.channel, payloads))
+            cur.fetchall()
+            with self._lock:
+                self._published += len(events)
+
+    def ensure_started(self):
+        # The listener thread is started lazily so forked workers each get their own, there is none without a channel
+        if self.channel is None:
+            return
+        if self._thread is None or self._thread_pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._thread_pid != os.getpid():
+                    self._thread_pid = os.getpid()
+                    self._connected = False
+                    self._thread = threading.Thread(target = self._listen_loop, name = "invalidation-listener", daemon = True)
+                    self._thread.start()
+
+    def _listen_loop(self):
+        listened = False
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.connect_kwargs)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(psycopg2.sql.SQL("LISTEN {}").format(psycopg2.sql.Identifier(self.channel)))
+                with self._lock:
+                    self._connected = True
+                    self._reconnects += listened
+                if listened:
+                    self._flush()
+                listened = True
+                self._listen(conn, cur)
+            except Exception:
+                # Whatever broke the connection, the thread keeps reconnecting instead of leaving the workers without invalidations
+                with self._lock:
+                    self._errors += 1
+                traceback.print_exc(file = sys.stderr)
+            finally:
+                with self._lock:
+                    self._connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+            time.sleep(self.reconnect_delay)
+
+    def _listen(self, conn, cur):
+        while True:
+            if select.select([conn], [], [], self.ping_interval) == ([], [], []):
+                # Nothing for a while, make sure the connection wasn't dropped without the socket noticing
+                cur.execute("SELECT 1")
+            conn.poll()
+            while conn.notifies:
+                self._apply(conn.notifies.pop(0).payload)
+
+    def _apply(self, payload):
+        try:
+            message = json.loads(payload)
+            sender, sent_at, events = message["from"], message["at"], message["events"]
+        except (ValueError, KeyError, TypeError):
+            return
+        if sender == self.token():
+            return
+        applied = 0
+        failed = 0
+        for kind, key in events:
+            handler = self._handlers.get(kind)
+            if handler is None:
+                continue
+            # A failing handler only loses its own event, the rest of the notification is still applied
+            try:
+                handler(key)
+                applied += 1
+            except Exception:
+                failed += 1
+                print(f"Invalidation handler for {kind!r} failed on {key!r}:", file = sys.stderr)
+                traceback.print_exc(file = sys.stderr)
+        # Measured from the publishing statement, so it includes the rest of the writing transaction and its commit
+        delay = max(time.time() - sent_at, 0.0)
+        with self._lock:
+            self._notifications += 1
+            self._received += len(events)
+            self._applied += applied
+            self._handler_errors += failed
+            self._delay_last = delay
+            self._delay_total += delay
+            self._delay_max = max(self._delay_max, delay)
+
+    def _flush(self):
+        for handler in self._flush_handlers:
+            handler()
+        with self._lock:
+            self._flushes += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "channel": self.channel,
+                "listening": self._connected and self._thread_pid == os.getpid(),
+                "published": self._published,
+                "received": self._received,
+                "applied": self._applied,
+                "flushes": self._flushes,
+                "reconnects": self._reconnects,
+                "errors": self._errors,
+                "handler_errors": self._handler_errors,
+                "delay_last": round(self._delay_last, 6) if self._delay_last is not None else None,
+                "delay_avg": round(self._delay_total / self._notifications, 6) if self._notifications else 0.0,
+                "delay_max": round(self._delay_max, 6),
+            }
@@ -0,0 +1,212 @@
+import psycopg2
+import psycopg2.sql
+import argparse
+import dotenv
+import os
+import invalidation # Registers the notify_invalidations statement, check-plans covers it with the others
+import statements
+import utils
+
+def backfill_top10(cur, args):
+    cur.execute("SELECT backfill_stream_counts()")
+    consumers = cur.fetchone()[0]
+    print(f"Stream counters rebuilt from the streams table for {consumers} consumers!")
+
+def rebuild_report_rollups(cur, args):
+    cur.execute("SELECT rebuild_genre_rollups()")
+    rollups = cur.fetchone()[0]
+    print(f"Monthly genre rollups rebuilt from the streams table, {rollups} rollups written!")
+
+def check_report_rollups(cur, args):
+    cur.execute("SELECT * FROM check_genre_rollups()")
+    rows = cur.fetchall()
+    for consumer_id, month, genre, rollup_playbacks, stream_playbacks in rows:
+        print(f"Consumer {consumer_id}, {month.strftime('%Y-%m')}, {genre}: {rollup_playbacks} playbacks in the rollups, {stream_playbacks} in the streams")
+    if rows:
+        raise Exception(f"{len(rows)} monthly genre rollups don't match the streams table, run rebuild-report-rollups to fix them!")
+    print("Monthly genre rollups match the streams table!")
+
+def reconcile_premium(cur, args):
+    cur.execute("SELECT reconcile_premium_until()")
+    reconciled = cur.fetchone()[0]
+    print(f"Premium end times recomputed from the subscriptions table, {reconciled} consumers corrected!")
+
+def create_stream_partitions(cur, args):
+    cur.execute("SELECT create_stream_partitions(%s)", (args.months_ahead,))
+    created = cur.fetchone()[0]
+    print(f"Created {created} stream partitions, every month up to {args.months_ahead} months ahead has one!")
+
+def archive_streams(cur, args):
+    # Monthly partitions that ended more than the kept months ago, oldest first
+    statement = """
+                SELECT partitions.relname, TO_DATE(SUBSTRING(partitions.relname FROM 9), 'YYYY_MM') AS month
+                FROM pg_inherits
+                JOIN pg_class AS partitions ON pg_inherits.inhrelid = partitions.oid
+                JOIN pg_class AS parents ON pg_inherits.inhparent = parents.oid
+                WHERE parents.relname = 'streams' AND partitions.relname ~ '^streams_[0-9]{4}_[0-9]{2}$'
+                AND TO_DATE(SUBSTRING(partitions.relname FROM 9), 'YYYY_MM') < DATE_TRUNC('month', CURRENT_DATE) - MAKE_INTERVAL(months => %s)
+                ORDER BY month ASC
+                """
+    values = (args.keep_months,)
+    cur.execute(statement, values)
+    partitions = cur.fetchall()
+
+    os.makedirs(args.directory, exist_ok = True)
+    for partition, month in partitions:
+        table = psycopg2.sql.Identifier(partition)
+        path = os.path.abspath(os.path.join(args.directory, f"{partition}.csv"))
+
+        cur.execute(psycopg2.sql.SQL("ALTER TABLE streams DETACH PARTITION {}").format(table))
+        cur.execute(psycopg2.sql.SQL("SELECT COUNT(*) FROM {}").format(table))
+        stream_count = cur.fetchone()[0]
+        # The export must be durable before the partition is dropped
+        with open(path, "w") as file:
+            cur.copy_expert(psycopg2.sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(table).as_string(cur), file)
+            file.flush()
+            os.fsync(file.fileno())
+
+        statement = """
+                    INSERT INTO stream_archives (month, stream_count, file, archived_at)
+                    VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+                    """
+        values = (month, stream_count, path)
+        cur.execute(statement, values)
+        if not args.keep_tables:
+            cur.execute(psycopg2.sql.SQL("DROP TABLE {}").format(table))
+        # Each partition is archived in its own transaction so an interrupted run keeps what it already did
+        cur.connection.commit()
+        print(f"Archived {stream_count} streams from {month.strftime('%Y-%m')} to {path}!")
+
+    print(f"Archived {len(partitions)} stream partitions older than {args.keep_months} months!")
+
+def full_scans(plan):
+    # Yields (table, sequential) for every scan reading a whole table, sequential or through an index without a condition
+    if plan["Node Type"] == "Seq Scan":
+        yield plan["Relation Name"], True
+    elif plan["Node Type"] in ("Index Scan", "Index Only Scan") and "Index Cond" not in plan:
+        yield plan["Relation Name"], False
+    for child in plan.get("Plans", []):
+        yield from full_scans(child)
+
+def plan_full_scans(cur, min_rows, allow = ()):
+    # Explains the generic plan of every statement in the registry, returns the tables each one reads whole,
+    # the errors of the statements that can't be prepared and the tables with too few rows for full index scans to count
+    # Small tables are read whole through an index when that is cheaper, that only counts once they hold enough rows
+    cur.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r' AND relnamespace = current_schema()::regnamespace")
+    rows = dict(cur.fetchall())
+
+    # With sequential scans turned off the planner only picks one when no index can serve the statement at all,
+    # so those are found the same way on an empty database as on a full one
+    cur.execute("SET LOCAL enable_seqscan = off")
+    # Plans for any parameter values, like the ones the endpoints reuse once a prepared statement is executed a few times
+    cur.execute("SET LOCAL plan_cache_mode = force_generic_plan")
+
+    scans = {}
+    errors = {}
+    for name, statement in sorted(statements.registry.items()):
+        cur.execute("SAVEPOINT check_plan")
+        try:
+            cur.execute(statement.prepare_sql)
+        except psycopg2.Error as error:
+            cur.execute("ROLLBACK TO SAVEPOINT check_plan")
+            errors[name] = error.diag.message_primary
+            continue
+        parameters = f" ({', '.join(['NULL'] * statement.parameters)})" if statement.parameters else ""
+        cur.execute(f"EXPLAIN (FORMAT JSON) EXECUTE {name}{parameters}")
+        plan = cur.fetchone()[0][0]["Plan"]
+        cur.execute(f"DEALLOCATE {name}")
+
+        scans[name] = sorted(set(table for table, sequential in full_scans(plan)
+                                 if table not in allow and (sequential or rows.get(table, 0) >= min_rows)))
+
+    small = sorted(table for table, count in rows.items() if count < min_rows and table not in allow)
+    return scans, errors, small
+
+def check_plans(cur, args):
+    # The same check as tests/test_plans.py, which seeds a scratch database first, run against the configured database as it is
+    scans, errors, small = plan_full_scans(cur, args.min_rows, args.allow)
+
+    failures = 0
+    for name in sorted(set(scans) | set(errors)):
+        if name in errors:
+            print(f"{name}: skipped, it can't be prepared: {errors[name]}")
+        elif scans[name]:
+            failures += 1
+            print(f"{name}: reads all of {', '.join(scans[name])}")
+        elif args.verbose:
+            print(f"{name}: ok")
+
+    # On a database without enough data the check only finds the statements no index can serve at all
+    if small:
+        print(f"Only checked for sequential scans, fewer than {args.min_rows} rows: {', '.join(small)}")
+
+    if failures:
+        raise Exception(f"{failures} of {len(statements.registry)} statements read whole tables, add indexes that serve them!")
+    print(f"None of the {len(statements.registry)} statements read whole tables!")
+
+if __name__ == "__main__":
+
+    # Load environment variables
+    dotenv.load_dotenv()
+
+    parser = argparse.ArgumentParser(description = "Database maintenance commands")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    command = commands.add_parser("backfill-top10", help = "Build the per consumer stream counters and top 10s from the existing streams")
+    command.set_defaults(function = backfill_top10)
+
+    command = commands.add_parser("rebuild-report-rollups", help = "Rebuild the monthly genre rollups used by the reports from the existing streams")
+    command.set_defaults(function = rebuild_report_rollups)
+
+    command = commands.add_parser("check-report-rollups", help = "Compare the monthly genre rollups with the streams table")
+    command.set_defaults(function = check_report_rollups)
+
+    command = commands.add_parser("reconcile-premium", help = "Recompute when the premium of every consumer ends from their subscriptions")
+    command.set_defaults(function = reconcile_premium)
+
+    command = commands.add_parser("create-stream-partitions", help = "Create the monthly stream partitions ahead of time, meant to run periodically")
+    command.add_argument("--months-ahead", type = int, default = 3, help = "Number of months after the current one to create partitions for")
+    command.set_defaults(function = create_stream_partitions)
+
+    command = commands.add_parser("archive-streams", help = "Detach the stream partitions past the retention period and export them to CSV files")
+    command.add_argument("--keep-months", type = int, default = 24, help = "Number of months before the current one to keep in the database")
+    command.add_argument("--directory", required = True, help = "Directory the exported partitions are written to")
+    command.add_argument("--keep-tables", action = "store_true", help = "Keep the detached partitions as standalone tables instead of dropping them")
+    command.set_defaults(function = archive_streams)
+
+    command = commands.add_parser("check-plans", help = "Fail if any statement the endpoints run has no index to read from",
+        description = "Fail if any statement the endpoints run has no index to read from. Statements that no index serves at all are found on any database, "
+        "full index scans only on tables holding at least --min-rows rows, so run it against an analyzed copy with production sized tables. "
+        "tests/test_plans.py runs the same check on a seeded scratch database")
+    command.add_argument("--allow", action = "append", default = [], metavar = "TABLE", help = "Table allowed to be scanned whole, can be given several times")
+    command.add_argument("--min-rows", type = int, default = 10000, help = "Rows a table needs before reading all of it through an index fails the check")
+    command.add_argument("--verbose", action = "store_true", help = "Also list the statements that don't read whole tables")
+    command.set_defaults(function = check_plans)
+
+    args = parser.parse_args()
+
+    # Connect to the database
+    conn = psycopg2.connect(
+        database = os.environ.get("DB_NAME"),
+        user = os.environ.get("DB_USER"),
+        password = os.environ.get("DB_PASSWORD"),
+        host = os.environ.get("DB_HOST"),
+        port = os.environ.get("DB_PORT")
+    )
+    if conn is None:
+        print("Could not connect to the database!")
+        exit(1)
+    cur = conn.cursor()
+
+    try:
+        args.function(cur, args)
+        conn.commit()
+    except (Exception, psycopg2.DatabaseError) as error:
+        conn.rollback()
+        print(error)
+        utils.db_disconnect(conn, cur)
+        exit(1)
+
+    utils.db_disconnect(conn, cur)
+
+    exit(0)
@@ -0,0 +1,208 @@
+import limits.storage
+import urllib.parse
+import functools
+import threading
+import tempfile
+import hashlib
+import struct
+import fcntl
+import mmap
+import math
+import time
+import os
+
+# File layout, a header with the number of slots followed by an open addressing table of (key hash, expires_at, count)
+HEADER = struct.Struct("<8sQ")
+SLOT = struct.Struct("<QdQ")
+MAGIC = b"DBPRLIM1"
+# Keys live within this many slots of their home slot, lookups never scan further
+MAX_PROBES = 32
+
+@functools.lru_cache(maxsize = 65536)
+def key_hash(key):
+    # Stable across processes, unlike hash(), zero marks a slot that was never used
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size = 8).digest(), "little") | 1
+
+def window_hash(key, expiry, at):
+    # Identifies the window of the key the time falls in, without formatting and hashing a key per window like other storages
+    return (key_hash(key) ^ (int(at / expiry) * 0x9E3779B97F4A7C15)) & 0xFFFFFFFFFFFFFFFF | 1
+
+class SharedMemoryStorage(limits.storage.Storage, limits.storage.SlidingWindowCounterSupport):
+    # Rate limit counters in a memory mapped file shared by every worker process on the host, selected with shm:///path?slots=N
+    # Every operation runs under a thread lock and a file lock, so checking and incrementing a sliding window is atomic
+    STORAGE_SCHEME = ["shm"]
+
+    def __init__(self, uri = None, wrap_exceptions = False, **options):
+        super().__init__(uri, wrap_exceptions = wrap_exceptions, **options)
+        parsed = urllib.parse.urlparse(uri or "shm://")
+        self.path = parsed.path or os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "dbproj-ratelimit")
+        self.slots = int(urllib.parse.parse_qs(parsed.query).get("slots", [65536])[0])
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+        self._checks = 0
+        self._rejections = 0
+        self._evictions = 0
+
+    @property
+    def base_exceptions(self):
+        return OSError
+
+    def _open(self):
+        # Called with the thread lock held, the mapping is opened again in forked workers so each has its own descriptor
+        if self._pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            # The first process creates the table, the others use the size it was created with
+            if os.fstat(fd).st_size < HEADER.size:
+                os.ftruncate(fd, HEADER.size + self.slots * SLOT.size)
+                os.pwrite(fd, HEADER.pack(MAGIC, self.slots), 0)
+            magic, slots = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+            if magic != MAGIC:
+                raise OSError(f"{self.path} is not a rate limit table")
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.slots = slots
+        self._map = mmap.mmap(fd, HEADER.size + slots * SLOT.size)
+        self._fd = fd
+        self._pid = os.getpid()
+
+    def _locked(self, function, *args):
+        # flock only excludes other processes, threads sharing the descriptor are serialized by the thread lock
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                return function(time.time(), *args)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _find(self, now, key_hash, create = False):
+        # Returns (offset, expires_at, count) of the live slot of the key, or of a free one to create it in if asked
+        home = key_hash % self.slots
+        free = None
+        oldest = None
+        for probe in range(MAX_PROBES):
+            offset = HEADER.size + (home + probe) % self.slots * SLOT.size
+            slot_hash, expires_at, count = SLOT.unpack_from(self._map, offset)
+            if slot_hash == key_hash and expires_at > now:
+                return offset, expires_at, count
+            if slot_hash == 0:
+                # Never used, so the key can't be any further
+                free = offset if free is None else free
+                break
+            if expires_at <= now:
+                free = offset if free is None else free
+            elif oldest is None or expires_at < oldest[1]:
+                oldest = (offset, expires_at)
+        if not create:
+            return None
+        if free is None:
+            # Every slot around the key is live, the counter closest to expiring is dropped
+            self._evictions += 1
+            free = oldest[0]
+        return free, 0.0, 0
+
+    def _get(self, now, slot_hash):
+        slot = self._find(now, slot_hash)
+        return slot[2] if slot else 0
+
+    def _incr(self, now, slot_hash, expiry, amount):
+        offset, expires_at, count = self._find(now, slot_hash, create = True)
+        if count == 0:
+            expires_at = now + expiry
+        SLOT.pack_into(self._map, offset, slot_hash, expires_at, count + amount)
+        return count + amount
+
+    def _clear(self, now, slot_hash):
+        slot = self._find(now, slot_hash)
+        if slot:
+            # The hash stays so the slot doesn't end the probe sequence of the keys after it
+            SLOT.pack_into(self._map, slot[0], slot_hash, 0.0, 0)
+
+    def _sliding_window(self, now, key, expiry):
+        previous_count = self._get(now, window_hash(key, expiry, now - expiry))
+        current_count = self._get(now, window_hash(key, expiry, now))
+        previous_ttl = (1 - (((now - expiry) / expiry) % 1)) * expiry if previous_count else 0
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_count, previous_ttl, current_count, current_ttl
+
+    def _acquire_sliding_window(self, now, key, limit, expiry, amount):
+        current_hash = window_hash(key, expiry, now)
+        previous_count = self._get(now, window_hash(key, expiry, now - expiry))
+        current_count = self._get(now, current_hash)
+        self._checks += 1
+        # The previous window counts for the part of it still inside the sliding window
+        weighted_count = current_count
+        if previous_count:
+            weighted_count += previous_count * (1 - (((now - expiry) / expiry) % 1))
+        if math.floor(weighted_count) + amount > limit:
+            self._rejections += 1
+            return False
+        # The current window is still read as the previous one during the next window
+        self._incr(now, current_hash, 2 * expiry, amount)
+        return True
+
+    def _reset(self, now):
+        live = sum(1 for _, expires_at, _ in SLOT.iter_unpack(self._map[HEADER.size:]) if expires_at > now)
+        self._map[HEADER.size:] = bytes(self.slots * SLOT.size)
+        return live
+
+    def incr(self, key, expiry, amount = 1):
+        return self._locked(self._incr, key_hash(key), expiry, amount)
+
+    def get(self, key):
+        return self._locked(self._get, key_hash(key))
+
+    def get_expiry(self, key):
+        def get_expiry(now, slot_hash):
+            slot = self._find(now, slot_hash)
+            return slot[1] if slot else now
+        return self._locked(get_expiry, key_hash(key))
+
+    def check(self):
+        try:
+            self._locked(lambda now: None)
+            return True
+        except OSError:
+            return False
+
+    def reset(self):
+        return self._locked(self._reset)
+
+    def clear(self, key):
+        self._locked(self._clear, key_hash(key))
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount = 1):
+        if amount > limit:
+            return False
+        return self._locked(self._acquire_sliding_window, key, limit, expiry, amount)
+
+    def get_sliding_window(self, key, expiry):
+        return self._locked(self._sliding_window, key, expiry)
+
+    def clear_sliding_window(self, key, expiry):
+        def clear_sliding_window(now, key, expiry):
+            self._clear(now, window_hash(key, expiry, now - expiry))
+            self._clear(now, window_hash(key, expiry, now))
+        self._locked(clear_sliding_window, key, expiry)
+
+    def stats(self):
+        # Counted without the file lock, the live counters are only an estimate and the other numbers are for this process
+        with self._lock:
+            self._open()
+            now = time.time()
+            live = sum(1 for _, expires_at, _ in SLOT.iter_unpack(self._map[HEADER.size:]) if expires_at > now)
+            return {
+                "path": self.path,
+                "slots": self.slots,
+                "live_counters": live,
+                "checks": self._checks,
+                "rejections": self._rejections,
+                "evictions": self._evictions,
+            }
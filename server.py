@@ -0,0 +1,438 @@
+import werkzeug.serving
+import concurrent.futures
+import urllib.parse
+import traceback
+import threading
+import asyncio
+import io
+import selectors
+import signal
+import socket
+import dotenv
+import time
+import sys
+import os
+
+# Exit code of a worker that could not load the app, the master doesn't restart those
+WORKER_BOOT_ERROR = 3
+# Largest request body the asynchronous server reads into memory
+MAX_BODY_BYTES = 16777216
+
+class DrainingWSGIServer(werkzeug.serving.ThreadedWSGIServer):
+    # Threaded server that counts the connections being served so a stopping worker can wait for them to finish
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._active_condition = threading.Condition()
+        self._active = 0
+
+    def process_request(self, request, client_address):
+        # Counted before the connection thread starts so a shutdown right after accepting still waits for it
+        with self._active_condition:
+            self._active += 1
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._finished()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._finished()
+
+    def _finished(self):
+        with self._active_condition:
+            self._active -= 1
+            self._active_condition.notify_all()
+
+    def drain(self, timeout):
+        # Returns false if connections were still open when the timeout ran out
+        deadline = time.monotonic() + timeout
+        with self._active_condition:
+            while self._active > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._active_condition.wait(remaining)
+        return True
+
+class AsyncHTTPServer:
+    # HTTP/1.1 server on an asyncio event loop, every request is answered by a coroutine taking a WSGI environ
+    # and returning (status, headers, body), so a worker holds as many requests as it has sockets while they wait
+    def __init__(self, dispatch, host, port, keepalive):
+        self.dispatch = dispatch
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self._server = None
+        # Maps the task of every open connection to whether it is waiting for the next request
+        self._connections = {}
+        self._stopping = False
+
+        self._requests = 0
+        self._in_flight = 0
+        self._in_flight_max = 0
+
+    async def start(self, listener):
+        self._server = await asyncio.start_server(self._serve_connection, sock = listener)
+
+    def _environ(self, method, target, version, headers, body, peer):
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peer[0] if peer else "",
+            "REMOTE_PORT": str(peer[1]) if peer else "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers:
+            key = name.upper().replace("-", "_")
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[key] = value
+            else:
+                key = f"HTTP_{key}"
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def _write(self, writer, status, headers, body, keep_alive):
+        lines = [f"HTTP/1.1 {status}"]
+        lines += [f"{name}: {value}" for name, value in headers if name.lower() not in ("content-length", "connection")]
+        lines.append(f"Content-Length: {len(body)}")
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def _serve_connection(self, reader, writer):
+        task = asyncio.current_task()
+        peer = writer.get_extra_info("peername")
+        try:
+            while not self._stopping:
+                self._connections[task] = True
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keepalive)
+                except asyncio.TimeoutError:
+                    return
+                if not request_line.strip():
+                    return
+                self._connections[task] = False
+
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                    headers = []
+                    while True:
+                        line = await reader.readline()
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                        name, _, value = line.decode("latin-1").partition(":")
+                        headers.append((name.strip(), value.strip()))
+                    fields = {name.lower(): value for name, value in headers}
+                    length = int(fields.get("content-length", 0))
+                except ValueError:
+                    await self._write(writer, "400 Bad Request", [], b"", False)
+                    return
+                if "transfer-encoding" in fields:
+                    await self._write(writer, "501 Not Implemented", [], b"", False)
+                    return
+                if length > MAX_BODY_BYTES:
+                    await self._write(writer, "413 Request Entity Too Large", [], b"", False)
+                    return
+                if length and fields.get("expect", "").lower() == "100-continue":
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                body = await reader.readexactly(length)
+
+                connection = fields.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+                self._requests += 1
+                self._in_flight += 1
+                self._in_flight_max = max(self._in_flight_max, self._in_flight)
+                try:
+                    status, response_headers, response_body = await self.dispatch(self._environ(method, target, version, headers, body, peer))
+                finally:
+                    self._in_flight -= 1
+                await self._write(writer, status, response_headers, response_body, keep_alive and not self._stopping)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    async def stop(self, timeout):
+        # Stops accepting, closes idle keep-alive connections and waits for the requests being answered
+        # Returns false if requests were still running when the timeout ran out
+        self._stopping = True
+        self._server.close()
+        for task, idle in list(self._connections.items()):
+            if idle:
+                task.cancel()
+        if not self._connections:
+            return True
+        _, pending = await asyncio.wait(list(self._connections), timeout = timeout)
+        return not pending
+
+    def stats(self):
+        return {
+            "connections": len(self._connections),
+            "requests": self._requests,
+            "in_flight": self._in_flight,
+            "in_flight_max": self._in_flight_max,
+        }
+
+def serve_async(app, listener, ready_fd, config):
+    # Serves the coroutine endpoints on the event loop, the others run through the WSGI app on a thread pool
+    import psycopg2
+    import async_api
+    import asyncdb
+    import utils
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = config["sync_threads"], thread_name_prefix = "sync-endpoint")
+        server = AsyncHTTPServer(lambda environ: async_api.dispatch(environ, executor), config["host"], config["port"], config["keepalive"])
+        try:
+            await asyncdb.db_pool().open()
+        except (utils.PoolTimeoutError, psycopg2.OperationalError) as error:
+            print(f"Worker {os.getpid()} could not open its asynchronous database connections yet: {error}", file = sys.stderr)
+        # The server accepts from the listener itself, so unlike the threaded worker it stays open
+        await server.start(listener)
+        os.write(ready_fd, f"{os.getpid()}\n".encode("ascii"))
+        os.close(ready_fd)
+
+        await stop.wait()
+        drained = await server.stop(config["drain_timeout"])
+        # Requests already handed to the thread pool finish before the worker exits
+        await loop.run_in_executor(None, executor.shutdown)
+        await asyncdb.close_db_pool()
+        return drained
+
+    if not asyncio.run(main()):
+        print(f"Worker {os.getpid()} stopped with connections still open after {config['drain_timeout']}s", file = sys.stderr)
+
+def run_worker(listener, ready_fd, config):
+    # The terminal sends interrupts to the whole process group, only the master decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+
+    # The app is imported after the fork so a reload picks up new code and a new .env file
+    try:
+        import psycopg2
+        import utils
+        import api
+        app = api.create_app()
+    except Exception:
+        traceback.print_exc()
+        os._exit(WORKER_BOOT_ERROR)
+
+    # Each worker opens its own connections, sharing the ones of a parent process would corrupt them
+    try:
+        utils.db_pool()
+    except (utils.PoolTimeoutError, psycopg2.OperationalError) as error:
+        print(f"Worker {os.getpid()} could not open its database connections yet: {error}", file = sys.stderr)
+
+    if config["mode"] == "async":
+        serve_async(app, listener, ready_fd, config)
+        sys.exit(0)
+
+    # Idle keep-alive connections are closed after the timeout so they don't hold up a drain
+    handler = type("WorkerRequestHandler", (werkzeug.serving.WSGIRequestHandler,), {"timeout": config["keepalive"]})
+    server = DrainingWSGIServer(config["host"], config["port"], app, handler = handler, fd = listener.fileno())
+    # Workers race to accept from the shared socket, the ones that lose must go back to waiting instead of blocking
+    server.socket.setblocking(False)
+    listener.close()
+
+    # shutdown() waits for the serving loop, so it can't be called from the signal handler running inside it
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target = server.shutdown, daemon = True).start())
+    os.write(ready_fd, f"{os.getpid()}\n".encode("ascii"))
+    os.close(ready_fd)
+
+    server.serve_forever()
+    server.server_close()
+    if not server.drain(config["drain_timeout"]):
+        print(f"Worker {os.getpid()} stopped with connections still open after {config['drain_timeout']}s", file = sys.stderr)
+    # Exits through the interpreter so the app's exit handlers, like the stream buffer flush, still run
+    sys.exit(0)
+
+class Master:
+    # Pre-fork master, binds the socket once and keeps a generation of worker processes serving from it
+    # SIGHUP starts a new generation and drains the old one once the new one is ready, SIGTERM and SIGINT drain all and stop
+    def __init__(self, config):
+        self.config = config
+        self.generation = 0
+        # Maps pid -> generation for every running worker
+        self.workers = {}
+        self.ready = set()
+        # Workers already told to stop, so they aren't signalled again while draining
+        self.terminating = set()
+        self.stopping = False
+        self.reload_requested = False
+        self.failed = False
+        self.stop_deadline = None
+
+    def spawn(self, listener, ready_fd):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(listener, ready_fd, self.config)
+            except SystemExit:
+                raise
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+        self.workers[pid] = self.generation
+
+    def signal_generation(self, generation, signum):
+        for pid, worker_generation in list(self.workers.items()):
+            if worker_generation == generation and (pid not in self.terminating or signum != signal.SIGTERM):
+                self.terminating.add(pid)
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def reap(self, listener, ready_fd):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.workers.pop(pid, None)
+            self.ready.discard(pid)
+            self.terminating.discard(pid)
+            if generation is None or self.stopping:
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+            if code == WORKER_BOOT_ERROR:
+                older = [worker_generation for worker_generation in self.workers.values() if worker_generation < generation]
+                serving = [worker_pid for worker_pid in self.ready if self.workers.get(worker_pid) == generation]
+                if older:
+                    # A reload that fails to boot leaves the previous generation serving
+                    print(f"Worker {pid} failed to boot, keeping the previous workers", file = sys.stderr)
+                    self.signal_generation(generation, signal.SIGTERM)
+                    self.generation = max(older)
+                elif serving:
+                    print(f"Worker {pid} failed to boot, continuing with {len(serving)} workers", file = sys.stderr)
+                else:
+                    print(f"Worker {pid} failed to boot, stopping", file = sys.stderr)
+                    self.failed = True
+                    self.stop()
+            elif generation == self.generation:
+                print(f"Worker {pid} exited with code {code}, starting a new one", file = sys.stderr)
+                # Avoid a tight loop when workers keep crashing
+                time.sleep(0.5)
+                self.spawn(listener, ready_fd)
+
+    def stop(self):
+        if not self.stopping:
+            self.stopping = True
+            for pid in list(self.workers):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            self.stop_deadline = time.monotonic() + self.config["drain_timeout"] + 5
+
+    def run(self):
+        listener = socket.create_server((self.config["host"], self.config["port"]), backlog = self.config["backlog"])
+        listener.setblocking(False)
+        ready_read, ready_write = os.pipe()
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_write, False)
+        signal.set_wakeup_fd(wakeup_write)
+
+        def request_reload(signum, frame):
+            self.reload_requested = True
+        def request_stop(signum, frame):
+            self.stop()
+        signal.signal(signal.SIGHUP, request_reload)
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        # Only used to wake up the loop, exited workers are reaped below
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        print(f"Serving on {self.config['host']}:{self.config['port']} with {self.config['workers']} workers (master {os.getpid()})")
+        for _ in range(self.config["workers"]):
+            self.spawn(listener, ready_write)
+
+        selector = selectors.DefaultSelector()
+        selector.register(ready_read, selectors.EVENT_READ)
+        selector.register(wakeup_read, selectors.EVENT_READ)
+        buffer = b""
+        while self.workers:
+            for key, _ in selector.select(timeout = 1):
+                data = os.read(key.fd, 4096)
+                if key.fd == ready_read:
+                    buffer += data
+                    *lines, buffer = buffer.split(b"\n")
+                    self.ready.update(int(line) for line in lines)
+
+            self.reap(listener, ready_write)
+
+            if self.stopping:
+                if time.monotonic() >= self.stop_deadline:
+                    for pid in list(self.workers):
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except ProcessLookupError:
+                            pass
+                continue
+
+            if self.reload_requested:
+                self.reload_requested = False
+                self.generation += 1
+                print(f"Reloading, starting worker generation {self.generation}")
+                for _ in range(self.config["workers"]):
+                    self.spawn(listener, ready_write)
+
+            # Retire older generations only once every worker of the current one is serving
+            current = [pid for pid, generation in self.workers.items() if generation == self.generation]
+            if len(current) == self.config["workers"] and all(pid in self.ready for pid in current):
+                for generation in set(self.workers.values()):
+                    if generation < self.generation:
+                        self.signal_generation(generation, signal.SIGTERM)
+
+        listener.close()
+        return 1 if self.failed else 0
+
+if __name__ == "__main__":
+
+    # Read without loading into the environment, so the workers of every generation load the current .env file themselves
+    environment = {**dotenv.dotenv_values(), **os.environ}
+
+    config = {
+        "host": environment.get("SERVER_HOST", "127.0.0.1"),
+        "port": int(environment.get("SERVER_PORT", 8080)),
+        "workers": int(environment.get("SERVER_WORKERS") or os.cpu_count() or 1),
+        "backlog": int(environment.get("SERVER_BACKLOG", 1024)),
+        "keepalive": float(environment.get("SERVER_KEEPALIVE", 5)),
+        "drain_timeout": float(environment.get("SERVER_DRAIN_TIMEOUT", 30)),
+        # Threads serve one request at a time each, async serves the read endpoints on an event loop
+        "mode": environment.get("SERVER_MODE", "threads"),
+        "sync_threads": int(environment.get("SERVER_SYNC_THREADS", 32)),
+    }
+    if config["mode"] not in ("threads", "async"):
+        print(f"Invalid SERVER_MODE {config['mode']}, expected threads or async!", file = sys.stderr)
+        exit(1)
+
+    exit(Master(config).run())
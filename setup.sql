@@ -1,8 +1,12 @@
+-- Trigram indexes for the keyword searches
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 DROP TABLE IF EXISTS card_payments CASCADE;
 DROP TABLE IF EXISTS collaborations CASCADE;
 DROP TABLE IF EXISTS playlist_orders CASCADE;
 DROP TABLE IF EXISTS album_orders CASCADE;
 DROP TABLE IF EXISTS streams CASCADE;
+DROP TABLE IF EXISTS stream_archives CASCADE;
 DROP TABLE IF EXISTS albums CASCADE;
 DROP TABLE IF EXISTS comments CASCADE;
 DROP TABLE IF EXISTS subscriptions CASCADE;
@@ -17,6 +21,9 @@ DROP TABLE IF EXISTS users CASCADE;
 DROP TABLE IF EXISTS bans CASCADE;
 DROP TABLE IF EXISTS top_10_orders CASCADE;
 DROP TABLE IF EXISTS top_10s CASCADE;
+DROP TABLE IF EXISTS stream_counts CASCADE;
+DROP TABLE IF EXISTS genre_rollups CASCADE;
+DROP TABLE IF EXISTS spool_checkpoints CASCADE;
 DROP TABLE IF EXISTS logins CASCADE;
 
 CREATE TABLE users (
@@ -32,6 +39,7 @@ CREATE TABLE consumers (
 	display_name	 TEXT NOT NULL,
 	birthday	 DATE NOT NULL,
 	register_date DATE NOT NULL,
+	premium_until TIMESTAMP,
 	users_id	 BIGINT,
 	PRIMARY KEY(users_id)
 );
@@ -108,16 +116,29 @@ CREATE TABLE publishers (
 CREATE TABLE albums (
 	id		 BIGSERIAL,
 	title		 TEXT NOT NULL,
+	release_date	 DATE NOT NULL,
 	artists_users_id BIGINT NOT NULL,
 	PRIMARY KEY(id)
 );
 
+-- Partitioned by month so queries on a time range only read the months in it and old months can be archived whole
 CREATE TABLE streams (
 	id		 BIGSERIAL,
 	stream_time	 TIMESTAMP NOT NULL,
-	songs_id		 BIGINT,
-	consumers_users_id BIGINT,
-	PRIMARY KEY(id,songs_id,consumers_users_id)
+	songs_id		 BIGINT NOT NULL,
+	consumers_users_id BIGINT NOT NULL,
+	PRIMARY KEY(id,stream_time)
+) PARTITION BY RANGE (stream_time);
+
+-- Catches streams for months without a partition yet, they are moved out when that month's partition is created
+CREATE TABLE streams_default PARTITION OF streams DEFAULT;
+
+CREATE TABLE stream_archives (
+	month	 DATE,
+	stream_count BIGINT NOT NULL,
+	file	 TEXT NOT NULL,
+	archived_at TIMESTAMP NOT NULL,
+	PRIMARY KEY(month)
 );
 
 CREATE TABLE album_orders (
@@ -159,6 +180,28 @@ CREATE TABLE top_10s (
 	PRIMARY KEY(consumers_users_id)
 );
 
+CREATE TABLE stream_counts (
+	stream_count	 BIGINT NOT NULL,
+	consumers_users_id BIGINT,
+	songs_id		 BIGINT,
+	PRIMARY KEY(consumers_users_id,songs_id)
+);
+
+CREATE TABLE genre_rollups (
+	playbacks	 BIGINT NOT NULL,
+	consumers_users_id BIGINT,
+	month	 DATE,
+	genre	 TEXT,
+	PRIMARY KEY(consumers_users_id,month,genre)
+);
+
+CREATE TABLE spool_checkpoints (
+	spool	 TEXT,
+	segment	 BIGINT NOT NULL,
+	position BIGINT NOT NULL,
+	PRIMARY KEY(spool)
+);
+
 CREATE TABLE logins (
 	id	 BIGSERIAL,
 	login_time TIMESTAMP NOT NULL,
@@ -182,7 +225,9 @@ CREATE TABLE collaborations (
 	PRIMARY KEY(songs_id,artists_users_id)
 );
 
-ALTER TABLE users ADD UNIQUE (username, email);
+ALTER TABLE users ADD UNIQUE (username);
+-- Logins look up emails case-insensitively, so two accounts can't have emails differing only in case
+CREATE UNIQUE INDEX users_email_lower_idx ON users (LOWER(email));
 ALTER TABLE consumers ADD CONSTRAINT consumers_fk1 FOREIGN KEY (users_id) REFERENCES users(id);
 ALTER TABLE artists ADD CONSTRAINT artists_fk1 FOREIGN KEY (publishers_id) REFERENCES publishers(id);
 ALTER TABLE artists ADD CONSTRAINT artists_fk2 FOREIGN KEY (administrators_users_id) REFERENCES administrators(users_id);
@@ -217,43 +262,94 @@ ALTER TABLE top_10_orders  ADD UNIQUE (position, top_10s_consumers_users_id);
 ALTER TABLE top_10_orders ADD CONSTRAINT top_10_orders_fk1 FOREIGN KEY (songs_id) REFERENCES songs(id);
 ALTER TABLE top_10_orders ADD CONSTRAINT top_10_orders_fk2 FOREIGN KEY (top_10s_consumers_users_id) REFERENCES top_10s(consumers_users_id) ON DELETE CASCADE;
 ALTER TABLE top_10s ADD CONSTRAINT top_10s_fk1 FOREIGN KEY (consumers_users_id) REFERENCES consumers(users_id);
+ALTER TABLE stream_counts ADD CONSTRAINT stream_counts_fk1 FOREIGN KEY (consumers_users_id) REFERENCES consumers(users_id);
+ALTER TABLE stream_counts ADD CONSTRAINT stream_counts_fk2 FOREIGN KEY (songs_id) REFERENCES songs(id);
+ALTER TABLE genre_rollups ADD CONSTRAINT genre_rollups_fk1 FOREIGN KEY (consumers_users_id) REFERENCES consumers(users_id);
 ALTER TABLE logins ADD CONSTRAINT logins_fk1 FOREIGN KEY (users_id) REFERENCES users(id);
 ALTER TABLE card_payments ADD CONSTRAINT card_payments_fk1 FOREIGN KEY (subscriptions_id) REFERENCES subscriptions(id);
 ALTER TABLE card_payments ADD CONSTRAINT card_payments_fk2 FOREIGN KEY (prepaid_cards_id) REFERENCES prepaid_cards(id);
 ALTER TABLE collaborations ADD CONSTRAINT collaborations_fk1 FOREIGN KEY (songs_id) REFERENCES songs(id);
 ALTER TABLE collaborations ADD CONSTRAINT collaborations_fk2 FOREIGN KEY (artists_users_id) REFERENCES artists(users_id);
 
+-- Keyword searches match substrings anywhere in the text, which only trigram indexes can serve
+-- GiST rather than GIN, it also returns the rows closest to the keyword first so a page stops after its rows instead of sorting every match
+CREATE INDEX songs_title_trgm_idx ON songs USING GIST (title gist_trgm_ops);
+CREATE INDEX artists_stage_name_trgm_idx ON artists USING GIST (stage_name gist_trgm_ops);
+CREATE INDEX playlists_name_trgm_idx ON playlists USING GIST (name gist_trgm_ops);
+
+-- Pages of a song's comment threads and a consumer's subscriptions are seeks on these indexes
+CREATE INDEX comments_threads_idx ON comments (songs_id, id) WHERE comments_id IS NULL;
+CREATE INDEX subscriptions_consumer_end_idx ON subscriptions (consumers_users_id, end_time DESC, id DESC);
+
+-- Time range reads of a consumer's streams, created on every partition
+CREATE INDEX streams_consumer_time_idx ON streams (consumers_users_id, stream_time);
+
+-- Lets the top 10 be read from the first 10 index entries of a consumer instead of sorting all their counters
+CREATE INDEX stream_counts_top_idx ON stream_counts (consumers_users_id, stream_count DESC);
+
+-- Joins and lookups of the endpoints on foreign keys that don't lead their primary key or a unique constraint
+CREATE INDEX songs_artist_idx ON songs (artists_users_id);
+CREATE INDEX albums_artist_idx ON albums (artists_users_id);
+CREATE INDEX album_orders_song_idx ON album_orders (songs_id);
+CREATE INDEX collaborations_artist_idx ON collaborations (artists_users_id);
+CREATE INDEX playlist_orders_playlist_idx ON playlist_orders (playlists_id, position);
+CREATE INDEX playlists_consumer_idx ON playlists (consumers_users_id);
+CREATE INDEX comments_replies_idx ON comments (comments_id);
+CREATE INDEX top_10_orders_consumer_idx ON top_10_orders (top_10s_consumers_users_id, position);
+
+-- A user's active ban, and the bans added or unbanned since the watermarks of the in-memory ban list
+CREATE INDEX bans_user_end_idx ON bans (users_id, end_time);
+CREATE INDEX bans_start_idx ON bans (start_time);
+CREATE INDEX bans_end_idx ON bans (end_time);
+
+-- The remaining foreign keys, so deleting or changing a referenced row doesn't scan the referencing table
+-- streams.songs_id, stream_counts.songs_id and comments.songs_id outside of threads are left out, songs are never deleted
+-- and every stream would pay for keeping the first two up to date
+CREATE INDEX artists_publisher_idx ON artists (publishers_id);
+CREATE INDEX artists_administrator_idx ON artists (administrators_users_id);
+CREATE INDEX songs_publisher_idx ON songs (publishers_id);
+CREATE INDEX prepaid_cards_administrator_idx ON prepaid_cards (administrators_users_id);
+CREATE INDEX comments_consumer_idx ON comments (consumers_users_id);
+CREATE INDEX bans_administrator_idx ON bans (administrators_users_id);
+CREATE INDEX logins_user_idx ON logins (users_id);
+CREATE INDEX card_payments_subscription_idx ON card_payments (subscriptions_id);
+CREATE INDEX card_payments_card_idx ON card_payments (prepaid_cards_id);
+
 DROP TRIGGER IF EXISTS top10_trigger ON streams;
 DROP FUNCTION IF EXISTS update_top10();
+DROP FUNCTION IF EXISTS rebuild_top10(BIGINT);
+DROP FUNCTION IF EXISTS backfill_stream_counts();
 
-CREATE FUNCTION update_top10() RETURNS TRIGGER
+CREATE FUNCTION rebuild_top10(consumer_id BIGINT) RETURNS VOID
 LANGUAGE plpgSQL
 AS $$
 DECLARE
     distinct_streamed INTEGER;
 BEGIN
-    SELECT COUNT(DISTINCT songs_id) INTO distinct_streamed
-    FROM streams
-    WHERE consumers_users_id = NEW.consumers_users_id;
+    -- Only up to 10 counters need to be read to know if the consumer streamed at least 10 distinct songs
+    SELECT COUNT(*) INTO distinct_streamed
+    FROM (SELECT 1 FROM stream_counts WHERE consumers_users_id = consumer_id LIMIT 10) AS first_songs;
 
     -- Check if the user has streamed at least 10 distinct songs
     IF distinct_streamed >= 10 THEN
 
-		-- Delete the old top 10 (the orders cascade delete)
-		DELETE FROM top_10s
-		WHERE consumers_users_id = NEW.consumers_users_id;
-
-		-- Create the new top 10
+		-- Create the top 10 or lock the existing one, a concurrent first top 10 of the consumer waits here instead of
+		-- failing on the primary key, and then replaces the orders the other one wrote
 		INSERT INTO top_10s(consumers_users_id, last_updated)
-		VALUES (NEW.consumers_users_id, current_timestamp);
+		VALUES (consumer_id, current_timestamp)
+		ON CONFLICT (consumers_users_id)
+		DO UPDATE SET last_updated = EXCLUDED.last_updated;
+
+		-- Delete the old top 10 order
+		DELETE FROM top_10_orders
+		WHERE top_10s_consumers_users_id = consumer_id;
 
-		-- Create the new top 10 order
+		-- Create the new top 10 order from the counters
 		WITH streamed_songs AS
 		(
-			SELECT songs_id, COUNT(*) AS stream_count
-			FROM streams
-			WHERE consumers_users_id = NEW.consumers_users_id
-			GROUP BY songs_id
+			SELECT songs_id, stream_count
+			FROM stream_counts
+			WHERE consumers_users_id = consumer_id
 			ORDER BY stream_count DESC
 			LIMIT 10
 		),
@@ -263,11 +359,66 @@ BEGIN
 			FROM streamed_songs
 		)
 		INSERT INTO top_10_orders (position, songs_id, stream_count, top_10s_consumers_users_id)
-		SELECT ordered_songs.position, ordered_songs.songs_id, streamed_songs.stream_count, NEW.consumers_users_id
+		SELECT ordered_songs.position, ordered_songs.songs_id, streamed_songs.stream_count, consumer_id
 		FROM streamed_songs
 		JOIN ordered_songs ON streamed_songs.songs_id = ordered_songs.songs_id;
 
+    END IF;
+END;
+$$;
 
+CREATE FUNCTION update_top10() RETURNS TRIGGER
+LANGUAGE plpgSQL
+AS $$
+DECLARE
+    new_count BIGINT;
+    song_position SMALLINT;
+    tenth_count BIGINT;
+BEGIN
+    -- Count the new stream instead of regrouping the consumer's whole history
+    INSERT INTO stream_counts (consumers_users_id, songs_id, stream_count)
+    VALUES (NEW.consumers_users_id, NEW.songs_id, 1)
+    ON CONFLICT (consumers_users_id, songs_id)
+    DO UPDATE SET stream_count = stream_counts.stream_count + 1
+    RETURNING stream_count INTO new_count;
+
+    -- Concurrent streams of the consumer wait here, so each one compares against the top 10 the previous one left
+    PERFORM 1 FROM top_10s WHERE consumers_users_id = NEW.consumers_users_id FOR UPDATE;
+
+    -- Consumers get their first top 10 once they streamed 10 distinct songs, rebuild_top10 serializes the concurrent ones
+    IF NOT FOUND THEN
+        PERFORM rebuild_top10(NEW.consumers_users_id);
+        RETURN NEW;
+    END IF;
+
+    SELECT position INTO song_position
+    FROM top_10_orders
+    WHERE top_10s_consumers_users_id = NEW.consumers_users_id AND songs_id = NEW.songs_id;
+
+    IF song_position IS NULL THEN
+        -- The song only enters the top 10 once it was streamed more than the 10th song, a tie keeps the current top 10
+        SELECT stream_count INTO tenth_count
+        FROM top_10_orders
+        WHERE top_10s_consumers_users_id = NEW.consumers_users_id AND position = 10;
+
+        IF new_count > tenth_count THEN
+            PERFORM rebuild_top10(NEW.consumers_users_id);
+        END IF;
+
+    ELSIF EXISTS (SELECT 1 FROM top_10_orders
+                  WHERE top_10s_consumers_users_id = NEW.consumers_users_id AND position < song_position AND stream_count < new_count) THEN
+        -- The song now has more streams than one ranked above it
+        PERFORM rebuild_top10(NEW.consumers_users_id);
+
+    ELSE
+        -- Same rank, only the song's count changes
+        UPDATE top_10_orders
+        SET stream_count = new_count
+        WHERE top_10s_consumers_users_id = NEW.consumers_users_id AND songs_id = NEW.songs_id;
+
+        UPDATE top_10s
+        SET last_updated = current_timestamp
+        WHERE consumers_users_id = NEW.consumers_users_id;
     END IF;
 
     RETURN NEW;
@@ -277,4 +428,246 @@ $$;
 CREATE TRIGGER top10_trigger
 AFTER INSERT ON streams
 FOR EACH ROW
-EXECUTE FUNCTION update_top10();
\ No newline at end of file
+EXECUTE FUNCTION update_top10();
+
+-- Builds the counters from the existing streams, for databases created before they existed
+-- Streams of archived months are no longer in the table and are left out of the rebuilt counters
+CREATE FUNCTION backfill_stream_counts() RETURNS BIGINT
+LANGUAGE plpgSQL
+AS $$
+DECLARE
+    consumer_id BIGINT;
+    rebuilt BIGINT := 0;
+BEGIN
+    -- Block new streams until the counters are rebuilt so none are counted twice or missed
+    LOCK TABLE streams IN SHARE MODE;
+
+    DELETE FROM stream_counts;
+
+    INSERT INTO stream_counts (consumers_users_id, songs_id, stream_count)
+    SELECT consumers_users_id, songs_id, COUNT(*)
+    FROM streams
+    GROUP BY consumers_users_id, songs_id;
+
+    FOR consumer_id IN SELECT DISTINCT consumers_users_id FROM stream_counts LOOP
+        PERFORM rebuild_top10(consumer_id);
+        rebuilt := rebuilt + 1;
+    END LOOP;
+
+    RETURN rebuilt;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS genre_rollup_trigger ON streams;
+DROP FUNCTION IF EXISTS update_genre_rollups();
+DROP FUNCTION IF EXISTS rebuild_genre_rollups();
+DROP FUNCTION IF EXISTS check_genre_rollups();
+
+CREATE FUNCTION update_genre_rollups() RETURNS TRIGGER
+LANGUAGE plpgSQL
+AS $$
+BEGIN
+    -- Statement level so a batch of streams is added with one upsert per consumer, month and genre
+    -- Rows are upserted in key order so concurrent batches lock them in the same order
+    INSERT INTO genre_rollups (consumers_users_id, month, genre, playbacks)
+    SELECT new_streams.consumers_users_id, DATE_TRUNC('month', new_streams.stream_time)::DATE AS month, songs.genre, COUNT(*)
+    FROM new_streams
+    JOIN songs ON new_streams.songs_id = songs.id
+    GROUP BY new_streams.consumers_users_id, month, songs.genre
+    ORDER BY new_streams.consumers_users_id, month, songs.genre
+    ON CONFLICT (consumers_users_id, month, genre)
+    DO UPDATE SET playbacks = genre_rollups.playbacks + EXCLUDED.playbacks;
+
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER genre_rollup_trigger
+AFTER INSERT ON streams
+REFERENCING NEW TABLE AS new_streams
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_genre_rollups();
+
+-- Builds the rollups from the existing streams, for databases created before they existed or after they drifted
+CREATE FUNCTION rebuild_genre_rollups() RETURNS BIGINT
+LANGUAGE plpgSQL
+AS $$
+DECLARE
+    rebuilt BIGINT;
+BEGIN
+    -- Block new streams until the rollups are rebuilt so none are counted twice or missed
+    LOCK TABLE streams IN SHARE MODE;
+
+    -- The rollups of archived months can't be rebuilt, their streams are no longer in the table
+    DELETE FROM genre_rollups
+    WHERE month NOT IN (SELECT month FROM stream_archives);
+
+    INSERT INTO genre_rollups (consumers_users_id, month, genre, playbacks)
+    SELECT streams.consumers_users_id, DATE_TRUNC('month', streams.stream_time)::DATE AS month, songs.genre, COUNT(*)
+    FROM streams
+    JOIN songs ON streams.songs_id = songs.id
+    GROUP BY streams.consumers_users_id, month, songs.genre;
+
+    GET DIAGNOSTICS rebuilt = ROW_COUNT;
+    RETURN rebuilt;
+END;
+$$;
+
+-- Lists the rollups that don't match the streams they were counted from
+CREATE FUNCTION check_genre_rollups()
+RETURNS TABLE (consumers_users_id BIGINT, month DATE, genre TEXT, rollup_playbacks BIGINT, stream_playbacks BIGINT)
+LANGUAGE SQL STABLE
+AS $$
+    WITH counted AS
+    (
+        SELECT streams.consumers_users_id, DATE_TRUNC('month', streams.stream_time)::DATE AS month, songs.genre, COUNT(*) AS playbacks
+        FROM streams
+        JOIN songs ON streams.songs_id = songs.id
+        GROUP BY streams.consumers_users_id, month, songs.genre
+    )
+    SELECT COALESCE(genre_rollups.consumers_users_id, counted.consumers_users_id),
+           COALESCE(genre_rollups.month, counted.month),
+           COALESCE(genre_rollups.genre, counted.genre),
+           COALESCE(genre_rollups.playbacks, 0), COALESCE(counted.playbacks, 0)
+    FROM genre_rollups
+    FULL JOIN counted ON genre_rollups.consumers_users_id = counted.consumers_users_id
+                     AND genre_rollups.month = counted.month
+                     AND genre_rollups.genre = counted.genre
+    WHERE genre_rollups.playbacks IS DISTINCT FROM counted.playbacks
+    AND COALESCE(genre_rollups.month, counted.month) NOT IN (SELECT month FROM stream_archives)
+    ORDER BY 1, 2, 3;
+$$;
+
+DROP FUNCTION IF EXISTS create_stream_partition(DATE);
+DROP FUNCTION IF EXISTS create_stream_partitions(INTEGER);
+
+-- Creates the partition of the month starting at the given date, returns false if it already exists
+CREATE FUNCTION create_stream_partition(month DATE) RETURNS BOOLEAN
+LANGUAGE plpgSQL
+AS $$
+DECLARE
+    partition TEXT := 'streams_' || TO_CHAR(month, 'YYYY_MM');
+BEGIN
+    IF TO_REGCLASS(partition) IS NOT NULL THEN
+        RETURN FALSE;
+    END IF;
+
+    -- The partition is filled before it is attached so the streams moved out of the default partition don't fire the triggers again
+    EXECUTE FORMAT('CREATE TABLE %I (LIKE streams INCLUDING DEFAULTS)', partition);
+    LOCK TABLE streams_default IN SHARE ROW EXCLUSIVE MODE;
+    EXECUTE FORMAT('WITH moved AS (DELETE FROM streams_default WHERE stream_time >= $1 AND stream_time < $2 RETURNING *)
+                    INSERT INTO %I SELECT * FROM moved', partition)
+    USING month, month + INTERVAL '1 month';
+    EXECUTE FORMAT('ALTER TABLE streams ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', partition, month, month + INTERVAL '1 month');
+
+    RETURN TRUE;
+END;
+$$;
+
+-- Creates the partitions from the current month up to the given number of months ahead, returns how many were created
+CREATE FUNCTION create_stream_partitions(months_ahead INTEGER) RETURNS INTEGER
+LANGUAGE plpgSQL
+AS $$
+DECLARE
+    month DATE;
+    created INTEGER := 0;
+BEGIN
+    FOR month IN SELECT GENERATE_SERIES(DATE_TRUNC('month', CURRENT_DATE), DATE_TRUNC('month', CURRENT_DATE) + MAKE_INTERVAL(months => months_ahead), INTERVAL '1 month')::DATE LOOP
+        IF create_stream_partition(month) THEN
+            created := created + 1;
+        END IF;
+    END LOOP;
+
+    RETURN created;
+END;
+$$;
+
+SELECT create_stream_partitions(3);
+
+DROP FUNCTION IF EXISTS purchase_subscription(BIGINT, INTERVAL, DOUBLE PRECISION, TEXT[]);
+DROP FUNCTION IF EXISTS reconcile_premium_until();
+
+-- Buys a subscription that starts now or when the consumer's current one ends, paid with the given prepaid cards
+-- Returns the shortfall instead of failing when the cards don't have enough credit, the caller rolls back in that case
+CREATE FUNCTION purchase_subscription(consumer_id BIGINT, subscription_period INTERVAL, subscription_price DOUBLE PRECISION, card_numbers TEXT[])
+RETURNS TABLE (subscription_id BIGINT, chained BOOLEAN, shortfall DOUBLE PRECISION, premium_expires_in DOUBLE PRECISION)
+LANGUAGE plpgSQL
+AS $$
+DECLARE
+    previous_end_time TIMESTAMP;
+    new_end_time TIMESTAMP;
+    card RECORD;
+    cards_found INTEGER := 0;
+    amount_used DOUBLE PRECISION;
+BEGIN
+    -- Serializes the purchases of a consumer so two of them can't chain onto the same subscription
+    SELECT premium_until INTO previous_end_time
+    FROM consumers
+    WHERE users_id = consumer_id
+    FOR UPDATE;
+    IF previous_end_time <= CURRENT_TIMESTAMP THEN
+        previous_end_time := NULL;
+    END IF;
+    chained := previous_end_time IS NOT NULL;
+
+    INSERT INTO subscriptions (start_time, end_time, price, consumers_users_id)
+    VALUES (COALESCE(previous_end_time, CURRENT_TIMESTAMP), COALESCE(previous_end_time, CURRENT_TIMESTAMP) + subscription_period, subscription_price, consumer_id)
+    RETURNING id, end_time INTO subscription_id, new_end_time;
+
+    -- The end of the last subscription is kept on the consumer so the role checks don't scan the subscriptions
+    UPDATE consumers SET premium_until = new_end_time WHERE users_id = consumer_id;
+
+    -- Cards are locked and drained in id order, so concurrent purchases sharing cards lock them in the same order
+    shortfall := subscription_price;
+    FOR card IN
+        SELECT id, credit
+        FROM prepaid_cards
+        WHERE number = ANY(card_numbers)
+        ORDER BY id
+        FOR UPDATE
+    LOOP
+        cards_found := cards_found + 1;
+        amount_used := LEAST(card.credit, shortfall);
+        IF amount_used > 0 THEN
+            INSERT INTO card_payments (amount_used, payment_time, prepaid_cards_id, subscriptions_id)
+            VALUES (amount_used, CURRENT_TIMESTAMP, card.id, subscription_id);
+
+            UPDATE prepaid_cards SET credit = credit - amount_used WHERE id = card.id;
+            shortfall := shortfall - amount_used;
+        END IF;
+    END LOOP;
+
+    IF cards_found != CARDINALITY(card_numbers) THEN
+        RAISE foreign_key_violation USING MESSAGE = 'No card was found with one of the numbers in the card list or there is a duplicate entry';
+    END IF;
+
+    premium_expires_in := EXTRACT(EPOCH FROM new_end_time + INTERVAL '1 minute' - CURRENT_TIMESTAMP);
+    RETURN NEXT;
+END;
+$$;
+
+-- Recomputes the end of the last subscription of every consumer, for databases created before it was kept or after it drifted
+CREATE FUNCTION reconcile_premium_until() RETURNS BIGINT
+LANGUAGE plpgSQL
+AS $$
+DECLARE
+    reconciled BIGINT;
+BEGIN
+    -- Purchases lock their consumer before adding the subscription, so this blocks them until the consumers are reconciled
+    LOCK TABLE consumers IN EXCLUSIVE MODE;
+
+    UPDATE consumers
+    SET premium_until = latest.end_time
+    FROM
+    (
+        SELECT consumers.users_id, MAX(subscriptions.end_time) AS end_time
+        FROM consumers
+        LEFT JOIN subscriptions ON subscriptions.consumers_users_id = consumers.users_id
+        GROUP BY consumers.users_id
+    ) AS latest
+    WHERE consumers.users_id = latest.users_id AND consumers.premium_until IS DISTINCT FROM latest.end_time;
+
+    GET DIAGNOSTICS reconciled = ROW_COUNT;
+    RETURN reconciled;
+END;
+$$;
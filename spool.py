@@ -0,0 +1,271 @@
+import threading
+import psycopg2
+import fcntl
+import zlib
+import time
+import os
+import ingest
+import utils
+
+class Spool:
+    # Append-only on-disk log of stream plays, used while the database is degraded and replayed into streams once it recovers
+    # Segments are shared by every worker process on the host, appends and segment rotation are serialized with a file lock
+    def __init__(self, directory, name, segment_bytes, fsync_interval, replay_interval, replay_batch):
+        self.directory = directory
+        # Identifies this spool in the checkpoints table, so several hosts can spool into the same database
+        self.name = name
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.replay_interval = replay_interval
+        self.replay_batch = replay_batch
+
+        os.makedirs(directory, exist_ok = True)
+
+        # Protects the open segment and the append counter of this process
+        self._lock = threading.Lock()
+        self._sync_condition = threading.Condition()
+        self._pid = None
+        self._fd = None
+        self._segment = None
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._thread = None
+        self._thread_pid = None
+        self._checkpoint = None
+        self._replay_lag = 0.0
+
+        self._appended = 0
+        self._fsyncs = 0
+        self._replayed = 0
+        self._dropped = 0
+        self._replay_failures = 0
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}.log")
+
+    def _segments(self):
+        return sorted(int(file[:-4]) for file in os.listdir(self.directory) if file.endswith(".log") and file[:-4].isdigit())
+
+    def _file_lock(self, name, blocking = True):
+        fd = os.open(os.path.join(self.directory, name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _file_unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _open_segment(self, segment):
+        if self._fd is not None:
+            # Everything written to the previous segment must be durable before writes move on
+            os.fsync(self._fd)
+            os.close(self._fd)
+        self._fd = os.open(self._path(segment), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._segment = segment
+        # A process that crashed mid write leaves a torn line, terminate it so it doesn't swallow the next play
+        size = os.fstat(self._fd).st_size
+        if size > 0 and os.pread(self._fd, 1, size - 1) != b"\n":
+            os.write(self._fd, b"\n")
+
+    def _prepare_segment(self):
+        # Called with both locks held, a segment stops receiving writes as soon as a newer one exists
+        if self._pid != os.getpid():
+            # Descriptors and counters inherited through fork belong to the parent
+            self._pid = os.getpid()
+            self._fd = None
+            self._written = 0
+            self._synced = 0
+        if self._fd is None or os.path.exists(self._path(self._segment + 1)):
+            segments = self._segments()
+            self._open_segment(segments[-1] if segments else 1)
+        if os.fstat(self._fd).st_size >= self.segment_bytes:
+            self._open_segment(self._segment + 1)
+
+    def _encode(self, song_id, consumer_id, played_at):
+        # Each line carries a checksum so a line torn by a crash is never replayed as a valid play
+        line = f"{song_id},{consumer_id},{played_at:.6f}".encode("utf-8")
+        return line + b",%08x\n" % zlib.crc32(line)
+
+    def _decode(self, line):
+        payload, _, checksum = line.rstrip(b"\n").rpartition(b",")
+        if int(checksum, 16) != zlib.crc32(payload):
+            raise ValueError("Spooled play checksum mismatch")
+        song_id, consumer_id, played_at = payload.decode("utf-8").split(",")
+        return int(song_id), int(consumer_id), float(played_at)
+
+    def append(self, plays):
+        # Returns once the plays are fsynced, concurrent appends share a single fsync
+        data = b"".join(self._encode(song_id, consumer_id, played_at) for song_id, consumer_id, played_at in plays)
+        with self._lock:
+            lock_fd = self._file_lock("spool.lock")
+            try:
+                self._prepare_segment()
+                os.write(self._fd, data)
+            finally:
+                self._file_unlock(lock_fd)
+            self._written += 1
+            ticket = self._written
+            self._appended += len(plays)
+        self._wait_synced(ticket)
+        self.ensure_started()
+
+    def _wait_synced(self, ticket):
+        with self._sync_condition:
+            while self._synced < ticket:
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._sync_condition.wait()
+            else:
+                return
+
+        # This append leads the group, wait briefly so concurrent appends join it and fsync once for all of them
+        try:
+            time.sleep(self.fsync_interval)
+            with self._lock:
+                target = self._written
+                os.fsync(self._fd)
+            with self._sync_condition:
+                self._synced = max(self._synced, target)
+                self._fsyncs += 1
+        finally:
+            with self._sync_condition:
+                self._syncing = False
+                self._sync_condition.notify_all()
+
+    def ensure_started(self):
+        # The replayer thread is started lazily so forked workers each get their own
+        if self._thread is None or self._thread_pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._thread_pid != os.getpid():
+                    self._thread_pid = os.getpid()
+                    self._thread = threading.Thread(target = self._replay_loop, name = "spool-replayer", daemon = True)
+                    self._thread.start()
+
+    def _replay_loop(self):
+        while True:
+            time.sleep(self.replay_interval)
+            try:
+                self.replay()
+            except (utils.PoolTimeoutError, psycopg2.Error, OSError):
+                # The database is still unavailable, try again on the next round
+                with self._lock:
+                    self._replay_failures += 1
+
+    def _read_plays(self, segment, position):
+        # Returns the complete lines after the position and where the read stopped, a torn last line is left for later
+        plays = []
+        with open(self._path(segment), "rb") as file:
+            file.seek(position)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                position += len(line)
+                try:
+                    plays.append(self._decode(line))
+                except ValueError:
+                    with self._lock:
+                        self._dropped += 1
+                if len(plays) >= self.replay_batch:
+                    break
+        return plays, position
+
+    def _save_checkpoint(self, cur, segment, position):
+        statement = """
+                    INSERT INTO spool_checkpoints (spool, segment, position)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (spool) DO UPDATE SET segment = EXCLUDED.segment, position = EXCLUDED.position
+                    """
+        values = (self.name, segment, position)
+        cur.execute(statement, values)
+
+    def replay(self):
+        # Only one process replays at a time, the checkpoint is committed with the inserted plays so none are replayed twice
+        lock_fd = self._file_lock("replay.lock", blocking = False)
+        if lock_fd is None:
+            return
+        try:
+            if not self._segments():
+                return
+            pool = utils.db_pool()
+            conn = pool.getconn()
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT segment, position FROM spool_checkpoints WHERE spool = %s", (self.name,))
+                row = cur.fetchone()
+                conn.rollback()
+                segment, position = row if row else (self._segments()[0], 0)
+
+                while True:
+                    segments = self._segments()
+                    newer = [existing for existing in segments if existing > segment]
+                    if segment not in segments:
+                        if not newer:
+                            break
+                        segment, position = newer[0], 0
+                        continue
+
+                    # Checked before reading, once a newer segment exists this one receives no more writes
+                    closed = len(newer) > 0
+                    plays, next_position = self._read_plays(segment, position)
+                    if plays:
+                        self._replay_lag = max(time.time() - plays[0][2], 0)
+                        dropped = ingest.insert_streams_skipping_invalid(conn, cur, plays,
+                                    before_commit = lambda cur: self._save_checkpoint(cur, segment, next_position))
+                        position = next_position
+                        with self._lock:
+                            self._replayed += len(plays) - dropped
+                            self._dropped += dropped
+                        self._checkpoint = (segment, position)
+                    elif next_position != position:
+                        # Only unreadable lines were left in this read
+                        self._save_checkpoint(cur, segment, next_position)
+                        conn.commit()
+                        position = next_position
+                    elif closed:
+                        # Fully replayed, anything left is a line torn by a crash
+                        self._save_checkpoint(cur, newer[0], 0)
+                        conn.commit()
+                        os.remove(self._path(segment))
+                        segment, position = newer[0], 0
+                        self._checkpoint = (segment, position)
+                    else:
+                        self._replay_lag = 0.0
+                        self._checkpoint = (segment, position)
+                        break
+                cur.close()
+            finally:
+                pool.putconn(conn)
+        finally:
+            self._file_unlock(lock_fd)
+
+    def stats(self):
+        # Depth is measured in bytes still to be replayed according to the last checkpoint this process saw
+        pending_bytes = 0
+        segments = self._segments()
+        for segment in segments:
+            try:
+                size = os.path.getsize(self._path(segment))
+            except FileNotFoundError:
+                # Replayed and removed in the meantime
+                continue
+            if self._checkpoint is None or segment > self._checkpoint[0]:
+                pending_bytes += size
+            elif segment == self._checkpoint[0]:
+                pending_bytes += max(size - self._checkpoint[1], 0)
+        with self._lock:
+            return {
+                "segments": len(segments),
+                "pending_bytes": pending_bytes,
+                "appended": self._appended,
+                "fsyncs": self._fsyncs,
+                "replayed": self._replayed,
+                "dropped": self._dropped,
+                "replay_failures": self._replay_failures,
+                "replay_lag": round(self._replay_lag, 3),
+            }
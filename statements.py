@@ -0,0 +1,536 @@
+import psycopg2
+import psycopg2.extensions
+import threading
+import time
+import re
+
+# Every SQL statement the endpoints run, by name, statements built from optional parts have a name per variant
+registry = {}
+_stats_lock = threading.Lock()
+
+class Statement:
+    # Hot statements are prepared once per connection and executed by name afterwards, the others are sent as text
+    def __init__(self, name, sql, prepare):
+        self.name = name
+        self.sql = sql
+        self.prepare = prepare
+
+        # PREPARE takes positional parameters, the psycopg2 placeholders are numbered in order
+        self.parameters = sql.count("%s")
+        numbers = iter(range(1, self.parameters + 1))
+        self.prepare_sql = f"PREPARE {name} AS " + re.sub(r"%(s|%)", lambda match: f"${next(numbers)}" if match.group(1) == "s" else "%", sql)
+        self.execute_sql = f"EXECUTE {name}" + (f" ({', '.join(['%s'] * self.parameters)})" if self.parameters else "")
+
+        self._calls = 0
+        self._prepares = 0
+        self._time_total = 0.0
+        self._time_max = 0.0
+
+    def record(self, elapsed, prepared):
+        with _stats_lock:
+            self._calls += 1
+            self._prepares += prepared
+            self._time_total += elapsed
+            self._time_max = max(self._time_max, elapsed)
+
+    def stats(self):
+        with _stats_lock:
+            return {
+                "prepared": self.prepare,
+                "calls": self._calls,
+                "prepares": self._prepares,
+                "time_total": round(self._time_total, 6),
+                "time_max": round(self._time_max, 6),
+                "time_avg": round(self._time_total / self._calls, 6) if self._calls else 0.0,
+            }
+
+class PreparingConnection(psycopg2.extensions.connection):
+    # Keeps track of the statements prepared in its session, prepared statements outlive rolled back transactions
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def register(name, sql, prepare = False):
+    if not re.fullmatch(r"[a-z_][a-z0-9_]*", name) or name in registry:
+        raise ValueError(f"Invalid or duplicate statement name: {name}")
+    registry[name] = Statement(name, sql, prepare)
+
+def _queries(conn, statement):
+    # The statements to send, preparing first if the connection doesn't have it yet, connections outside the pools only run text
+    prepared = getattr(conn, "prepared", None)
+    if not statement.prepare or prepared is None:
+        return [], statement.sql
+    if statement.name in prepared:
+        return [], statement.execute_sql
+    return [statement.prepare_sql], statement.execute_sql
+
+def execute(cur, name, values = None):
+    statement = registry[name]
+    prepare, query = _queries(cur.connection, statement)
+    start = time.perf_counter()
+    try:
+        for sql in prepare:
+            cur.execute(sql)
+            cur.connection.prepared.add(name)
+        cur.execute(query, values)
+    finally:
+        statement.record(time.perf_counter() - start, len(prepare))
+
+async def execute_async(cur, name, values = None):
+    # Same as execute for an asyncdb.AsyncCursor
+    statement = registry[name]
+    prepare, query = _queries(cur.connection, statement)
+    start = time.perf_counter()
+    try:
+        for sql in prepare:
+            await cur.execute(sql)
+            cur.connection.prepared.add(name)
+        await cur.execute(query, values)
+    finally:
+        statement.record(time.perf_counter() - start, len(prepare))
+
+def stats():
+    # Only statements that ran in this process, slowest in total first
+    results = dict((name, statement.stats()) for name, statement in registry.items())
+    return dict(sorted(((name, result) for name, result in results.items() if result["calls"]), key = lambda item: -item[1]["time_total"]))
+
+# Authentication
+
+# The active bans of every user, read once when a process starts, with the watermarks of the incremental loads
+register("active_bans", """
+    WITH banned AS
+    (
+        SELECT users_id,
+            CASE WHEN BOOL_OR(end_time IS NULL) THEN NULL
+                ELSE EXTRACT(EPOCH FROM MAX(end_time) - CURRENT_TIMESTAMP) END AS ban_expires_in
+        FROM bans
+        WHERE end_time IS NULL or end_time > CURRENT_TIMESTAMP
+        GROUP BY users_id
+    )
+    SELECT (SELECT COALESCE(MAX(id), 0) FROM bans), CURRENT_TIMESTAMP::timestamp - %s * INTERVAL '1 second',
+        banned.users_id, TRUE, banned.ban_expires_in
+    FROM (SELECT 1) AS watermarks LEFT JOIN banned ON TRUE
+    """, prepare = True)
+
+# Users with a ban added or manually unbanned since the watermarks, with whether they are still banned and for how long
+# The time watermark trails behind so bans of transactions that committed after a later one are still read
+register("ban_changes", """
+    WITH changed AS
+    (
+        SELECT user_bans.users_id, user_bans.banned, user_bans.ban_expires_in
+        FROM (SELECT DISTINCT users_id FROM bans
+            WHERE id > %s OR start_time >= %s::timestamp OR (manual_unban AND end_time >= %s::timestamp)) AS changed_users,
+        LATERAL
+        (
+            SELECT users_id,
+                BOOL_OR(end_time IS NULL or end_time > CURRENT_TIMESTAMP) AS banned,
+                CASE WHEN BOOL_OR(end_time IS NULL) THEN NULL
+                    ELSE EXTRACT(EPOCH FROM MAX(end_time) - CURRENT_TIMESTAMP) END AS ban_expires_in
+            FROM bans
+            WHERE bans.users_id = changed_users.users_id
+            GROUP BY users_id
+        ) AS user_bans
+    )
+    SELECT (SELECT COALESCE(MAX(id), 0) FROM bans), CURRENT_TIMESTAMP::timestamp - %s * INTERVAL '1 second',
+        changed.users_id, changed.banned, changed.ban_expires_in
+    FROM (SELECT 1) AS watermarks LEFT JOIN changed ON TRUE
+    """, prepare = True)
+
+# Besides the role, get how many seconds it stays valid so a subscription ending can't be served from the cache
+# Bans are not part of the role, they are checked against the in-memory ban list
+register("user_role", """
+    SELECT user_role,
+        CASE user_role
+            WHEN 'premium consumer' THEN EXTRACT(EPOCH FROM premium_until + INTERVAL '1 minute' - CURRENT_TIMESTAMP)
+        END AS role_expires_in
+    FROM
+    (
+        SELECT consumers.premium_until, CASE
+            WHEN consumers.premium_until + INTERVAL '1 minute' > CURRENT_TIMESTAMP THEN 'premium consumer'
+            WHEN consumers.users_id IS NOT NULL THEN 'consumer'
+            WHEN EXISTS (SELECT 1 FROM artists WHERE artists.users_id = users.id) THEN 'artist'
+            WHEN EXISTS (SELECT 1 FROM administrators WHERE administrators.users_id = users.id) THEN 'administrator'
+        END AS user_role
+        FROM users
+        LEFT JOIN consumers ON consumers.users_id = users.id
+        WHERE users.id = %s
+    ) AS user_roles;
+    """, prepare = True)
+
+# Logins by username and by email each seek their own unique index, usernames can't contain an @ so the input tells which one it is
+login_user = """
+    SELECT password_hash, password_salt, id
+    FROM users
+    WHERE {match}
+    """
+register("login_user", login_user.format(match = "username = %s"), prepare = True)
+register("login_user_email", login_user.format(match = "LOWER(email) = LOWER(%s)"), prepare = True)
+
+register("add_login", """
+    INSERT INTO logins (users_id, login_time, ip)
+    VALUES (%s, CURRENT_TIMESTAMP, %s)
+    RETURNING id
+    """, prepare = True)
+
+# Users
+
+register("register_consumer", """
+    WITH inserted_user AS
+    (
+        INSERT INTO users (username, password_hash, password_salt, email)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id
+    )
+    INSERT INTO consumers (users_id, birthday, display_name, register_date)
+    SELECT inserted_user.id, %s, %s, CURRENT_DATE
+    FROM inserted_user
+    RETURNING users_id
+    """)
+
+register("register_artist", """
+    WITH inserted_user AS
+    (
+        INSERT INTO users (username, password_hash, password_salt, email)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id
+    )
+    INSERT INTO artists (users_id, stage_name, publishers_id, administrators_users_id)
+    SELECT id, %s, %s, %s
+    FROM inserted_user
+    RETURNING users_id
+    """)
+
+register("active_ban", """
+    SELECT end_time
+    FROM bans
+    WHERE users_id = %s AND (end_time > CURRENT_TIMESTAMP OR end_time IS NULL)
+    """)
+
+register("add_ban", """
+    INSERT INTO bans (administrators_users_id, users_id, reason, start_time, end_time, manual_unban)
+    SELECT %s, %s, %s, CURRENT_TIMESTAMP, %s, FALSE
+    WHERE NOT EXISTS (SELECT 1 FROM administrators WHERE users_id = %s)
+    RETURNING id, EXTRACT(EPOCH FROM end_time - CURRENT_TIMESTAMP)
+    """)
+
+# Only set end time to current time for unban instead of delete so we keep a record of the ban
+register("unban_user", """
+    UPDATE bans
+    SET end_time = CURRENT_TIMESTAMP, manual_unban = TRUE
+    WHERE users_id = %s AND (end_time > CURRENT_TIMESTAMP OR end_time IS NULL)
+    RETURNING id
+    """)
+
+register("add_publisher", """
+    INSERT INTO publishers (name, email)
+    VALUES (%s, %s)
+    RETURNING id
+    """)
+
+register("add_prepaid_card", """
+    INSERT INTO prepaid_cards (number, credit, expiration, administrators_users_id)
+    VALUES (%s, %s, CURRENT_DATE + %s::interval, %s)
+    RETURNING id
+    """)
+
+# The purchase runs server side in one round trip, the cards stay locked only until the request commits
+register("purchase_subscription", """
+    SELECT subscription_id, chained, shortfall, premium_expires_in
+    FROM purchase_subscription(%s, %s::interval, %s, %s::text[])
+    """)
+
+# Songs and albums
+
+register("add_song", """
+    WITH inserted_song AS
+    (
+        INSERT INTO songs (ismn, title, genre, duration, release_date, explicit, artists_users_id, publishers_id)
+        SELECT %s, %s, %s, %s, %s, %s, %s, publishers_id
+        FROM artists WHERE users_id = %s
+        RETURNING id
+    ),
+    inserted_collab AS
+    (
+        INSERT INTO collaborations (artists_users_id, songs_id)
+        SELECT collaborator_id, inserted_song.id
+        FROM inserted_song, UNNEST(%s::int[]) AS collaborator_id
+    )
+    SELECT id FROM inserted_song;
+    """)
+
+register("album_foreign_songs", """
+    SELECT songs.id
+    FROM songs
+    WHERE songs.id = ANY(%s::bigint[]) AND songs.artists_users_id != %s;
+    """)
+
+# All new songs are inserted in one statement from column arrays, conflicting ones are skipped so they can be reported
+register("album_add_songs", """
+    INSERT INTO songs (ismn, title, genre, duration, release_date, explicit, artists_users_id, publishers_id)
+    SELECT new_songs.ismn, new_songs.title, new_songs.genre, new_songs.duration, new_songs.release_date,
+           new_songs.explicit, artists.users_id, artists.publishers_id
+    FROM UNNEST(%s::text[], %s::text[], %s::text[], %s::smallint[], %s::date[], %s::bool[])
+         WITH ORDINALITY AS new_songs(ismn, title, genre, duration, release_date, explicit, position)
+    JOIN artists ON artists.users_id = %s
+    ORDER BY new_songs.position
+    ON CONFLICT DO NOTHING
+    RETURNING id, ismn;
+    """)
+
+register("album_song_conflicts", """
+    SELECT ismn, title, artists_users_id
+    FROM songs
+    WHERE (ismn = ANY(%s::text[]) OR (title = ANY(%s::text[]) AND artists_users_id = %s)) AND NOT id = ANY(%s::bigint[]);
+    """)
+
+register("album_add_collaborations", """
+    INSERT INTO collaborations (songs_id, artists_users_id)
+    SELECT * FROM UNNEST(%s::bigint[], %s::bigint[]);
+    """)
+
+# Use ordinality to preserve the song order given by the user in the array
+register("add_album", """
+    WITH inserted_album AS
+    (
+        INSERT INTO albums (title, release_date, artists_users_id)
+        VALUES (%s, %s, %s)
+        RETURNING id
+    ),
+    inserted_album_song AS
+    (
+        INSERT INTO album_orders (position, albums_id, songs_id)
+        SELECT album_songs.position, inserted_album.id, album_songs.id
+        FROM inserted_album, UNNEST(%s::bigint[]) WITH ORDINALITY AS album_songs(id, position)
+    )
+    SELECT id FROM inserted_album;
+    """)
+
+# The trigram index on the title serves the substring match and hands out the closest titles first, by trigram distance
+# No index can seek to a distance, later pages walk every closer match again, so they only reach the closest matches up to the search depth
+song_search = """
+    SELECT songs.id, songs.title, artists.stage_name, songs.title <-> %s
+    FROM songs
+    LEFT JOIN artists ON artists.users_id = songs.artists_users_id
+    WHERE songs.title ILIKE %s
+    ORDER BY songs.title <-> %s, songs.id ASC
+    LIMIT %s
+    """
+register("song_search", song_search, prepare = True)
+register("song_search_after", """
+    SELECT reachable.id, reachable.title, artists.stage_name, reachable.distance
+    FROM
+    (
+        SELECT id, title, artists_users_id, title <-> %s AS distance
+        FROM songs
+        WHERE title ILIKE %s
+        ORDER BY distance, id ASC
+        LIMIT %s
+    ) AS reachable
+    LEFT JOIN artists ON artists.users_id = reachable.artists_users_id
+    WHERE (reachable.distance, reachable.id) > (%s::real, %s)
+    ORDER BY reachable.distance, reachable.id ASC
+    LIMIT %s
+    """, prepare = True)
+
+register("song_info", """
+    SELECT songs.title, artists.stage_name, songs.genre, songs.duration,
+    songs.explicit, songs.release_date, albums.title, ARRAY_AGG(collaborators.stage_name)
+    FROM songs
+    LEFT JOIN artists ON songs.artists_users_id = artists.users_id
+    LEFT JOIN album_orders ON album_orders.songs_id = songs.id
+    LEFT JOIN albums ON album_orders.albums_id = albums.id
+    LEFT JOIN collaborations ON songs.id = collaborations.songs_id
+    LEFT JOIN artists AS collaborators ON collaborations.artists_users_id = collaborators.users_id
+    WHERE songs.id = %s
+    GROUP BY songs.title, artists.stage_name, songs.genre, songs.duration, songs.explicit, songs.release_date, albums.title
+    """, prepare = True)
+
+register("song_exists", """
+    SELECT EXISTS (SELECT 1 FROM songs WHERE id = %s)
+    """, prepare = True)
+
+register("add_stream", """
+    INSERT INTO streams (songs_id, consumers_users_id, stream_time)
+    VALUES (%s, %s, CURRENT_TIMESTAMP)
+    RETURNING id
+    """, prepare = True)
+
+# Read from the rollups kept by the streams trigger, one row per month and genre of the 12 months up to the given one
+register("genre_report", """
+    SELECT EXTRACT(YEAR FROM month) AS year, EXTRACT(MONTH FROM month) AS month, genre, playbacks
+    FROM genre_rollups
+    WHERE consumers_users_id = %s AND month > %s::date - INTERVAL '12 months' AND month <= %s::date
+    ORDER BY genre_rollups.month DESC, playbacks DESC, genre ASC;
+    """, prepare = True)
+
+register("top10", """
+    SELECT last_updated, top_10_orders.position, top_10_orders.stream_count, songs.title, artists.stage_name
+    FROM top_10s
+    LEFT JOIN top_10_orders ON top_10_orders.top_10s_consumers_users_id = top_10s.consumers_users_id
+    LEFT JOIN songs ON songs.id = top_10_orders.songs_id
+    LEFT JOIN artists ON artists.users_id = songs.artists_users_id
+    WHERE top_10s.consumers_users_id = %s
+    ORDER BY top_10_orders.position ASC
+    """, prepare = True)
+
+# Consumers without a subscription ending in the future skip the subscriptions scan, the premium_until check runs once before it
+subscription_info = """
+    SELECT id, start_time, end_time
+    FROM subscriptions
+    WHERE consumers_users_id = %s AND end_time > CURRENT_TIMESTAMP
+    AND EXISTS (SELECT 1 FROM consumers WHERE users_id = %s AND premium_until > CURRENT_TIMESTAMP)
+    {after}ORDER BY end_time DESC, id DESC
+    LIMIT %s
+    """
+register("subscription_info", subscription_info.format(after = ""), prepare = True)
+register("subscription_info_after", subscription_info.format(after = "AND (end_time, id) < (%s::timestamp, %s::bigint)\n    "), prepare = True)
+
+# Artists
+
+register("artist_info", """
+    SELECT artists.stage_name, ARRAY_AGG(DISTINCT songs.title), ARRAY_AGG(DISTINCT collabs.title), ARRAY_AGG(DISTINCT albums.title), ARRAY_AGG(DISTINCT playlists.name), ARRAY_AGG(DISTINCT playlists_author.display_name)
+    FROM artists
+    JOIN users ON artists.users_id = users.id
+    LEFT JOIN collaborations ON artists.users_id = collaborations.artists_users_id
+    LEFT JOIN songs AS collabs ON collaborations.songs_id = collabs.id
+    LEFT JOIN songs ON artists.users_id = songs.artists_users_id
+    LEFT JOIN albums ON albums.artists_users_id = artists.users_id
+    LEFT JOIN playlist_orders ON songs.id = playlist_orders.songs_id
+    LEFT JOIN playlists ON playlist_orders.playlists_id = playlists.id AND playlists.private = FALSE
+    LEFT JOIN consumers AS playlists_author ON playlists.consumers_users_id = playlists_author.users_id
+    WHERE artists.users_id = %s
+    GROUP BY artists.stage_name
+    """, prepare = True)
+
+# The trigram index on the stage name serves the substring match and hands out the closest names first, later pages stop at the search depth
+artist_search = """
+    SELECT users_id, stage_name, stage_name <-> %s
+    FROM artists
+    WHERE stage_name ILIKE %s
+    ORDER BY stage_name <-> %s, users_id ASC
+    LIMIT %s
+    """
+register("artist_search", artist_search, prepare = True)
+register("artist_search_after", """
+    SELECT users_id, stage_name, distance
+    FROM
+    (
+        SELECT users_id, stage_name, stage_name <-> %s AS distance
+        FROM artists
+        WHERE stage_name ILIKE %s
+        ORDER BY distance, users_id ASC
+        LIMIT %s
+    ) AS reachable
+    WHERE (distance, users_id) > (%s::real, %s)
+    ORDER BY distance, users_id ASC
+    LIMIT %s
+    """, prepare = True)
+
+# Playlists, premium consumers can also interact with their own private playlists
+
+# Use ordinality to preserve the song order given by the user in the array
+# The artists of the songs are returned too, their info lists the public playlists their songs are in
+register("add_playlist", """
+    WITH inserted_playlist AS
+    (
+        INSERT INTO playlists (name, private, consumers_users_id)
+        VALUES (%s, %s, %s)
+        RETURNING id
+    ),
+    inserted_playlist_song AS
+    (
+        INSERT INTO playlist_orders (position, songs_id, playlists_id)
+        SELECT songs.ordinality, songs.id, inserted_playlist.id
+        FROM inserted_playlist, UNNEST(%s::int[]) WITH ORDINALITY AS songs(id, ordinality)
+    )
+    SELECT id, ARRAY(SELECT DISTINCT artists_users_id FROM songs WHERE id = ANY(%s::bigint[]))
+    FROM inserted_playlist;
+    """)
+
+delete_playlist = """
+    DELETE FROM playlists
+    WHERE id = %s AND consumers_users_id = %s AND (private = FALSE{private})
+    RETURNING id, private, ARRAY(SELECT DISTINCT songs.artists_users_id FROM playlist_orders
+        JOIN songs ON songs.id = playlist_orders.songs_id WHERE playlist_orders.playlists_id = playlists.id)
+    """
+register("delete_playlist", delete_playlist.format(private = ""))
+register("delete_playlist_premium", delete_playlist.format(private = " OR playlists.private = TRUE"))
+
+# The trigram index on the name serves the substring match and hands out the closest names first, later pages stop at the search depth
+playlist_search = """
+    SELECT playlists.id, name, consumers.display_name, name <-> %s
+    FROM playlists
+    LEFT JOIN consumers ON playlists.consumers_users_id = consumers.users_id
+    WHERE name ILIKE %s AND (private = FALSE{private})
+    ORDER BY name <-> %s, playlists.id ASC
+    LIMIT %s
+    """
+playlist_search_after = """
+    SELECT reachable.id, reachable.name, consumers.display_name, reachable.distance
+    FROM
+    (
+        SELECT id, name, consumers_users_id, name <-> %s AS distance
+        FROM playlists
+        WHERE name ILIKE %s AND (private = FALSE{private})
+        ORDER BY distance, id ASC
+        LIMIT %s
+    ) AS reachable
+    LEFT JOIN consumers ON reachable.consumers_users_id = consumers.users_id
+    WHERE (reachable.distance, reachable.id) > (%s::real, %s)
+    ORDER BY reachable.distance, reachable.id ASC
+    LIMIT %s
+    """
+register("playlist_search", playlist_search.format(private = ""), prepare = True)
+register("playlist_search_after", playlist_search_after.format(private = ""), prepare = True)
+register("playlist_search_premium", playlist_search.format(private = " OR (private = TRUE AND consumers_users_id = %s)"), prepare = True)
+register("playlist_search_premium_after", playlist_search_after.format(private = " OR (private = TRUE AND consumers_users_id = %s)"), prepare = True)
+
+playlist_info = """
+    SELECT name, consumers.display_name, private, ARRAY_AGG(songs.title)
+    FROM playlists
+    LEFT JOIN consumers ON playlists.consumers_users_id = consumers.users_id
+    LEFT JOIN playlist_orders ON playlists.id = playlist_orders.playlists_id
+    LEFT JOIN songs ON playlist_orders.songs_id = songs.id
+    WHERE playlists.id = %s AND (playlists.private = FALSE{private})
+    GROUP BY name, consumers.display_name, playlists.private
+    """
+register("playlist_info", playlist_info.format(private = ""), prepare = True)
+register("playlist_info_premium", playlist_info.format(private = " OR (playlists.private = TRUE AND consumers_users_id = %s)"), prepare = True)
+
+# Comments
+
+register("add_comment", """
+    INSERT INTO comments (content, post_time, comments_id, songs_id, consumers_users_id)
+    VALUES (%s, CURRENT_TIMESTAMP, %s, %s, %s)
+    RETURNING id
+    """, prepare = True)
+
+# Thread starting comments in posting order, read from the song's entries of the threads index
+register("song_comments", """
+    SELECT id
+    FROM comments
+    WHERE songs_id = %s AND comments_id IS NULL AND id > %s
+    ORDER BY id ASC
+    LIMIT %s
+    """, prepare = True)
+
+register("comment_info", """
+    SELECT comments.content, comments.post_time, consumers.display_name, ARRAY_AGG(replies.id)
+    FROM comments
+    LEFT JOIN consumers ON comments.consumers_users_id = consumers.users_id
+    LEFT JOIN comments AS replies ON comments.id = replies.comments_id
+    WHERE comments.id = %s
+    GROUP BY comments.content, comments.post_time, consumers.display_name
+    """, prepare = True)
+
+register("delete_comment_thread", """
+    DELETE FROM comments
+    WHERE id = %s
+    RETURNING id
+    """)
+
+register("delete_own_comment_thread", """
+    DELETE FROM comments
+    WHERE id = %s AND consumers_users_id = %s
+    RETURNING id
+    """)
@@ -0,0 +1,95 @@
+import os
+import psycopg2
+import pytest
+import maintenance
+import statements
+
+# Plan regression check, it needs a scratch database: setup.sql drops and recreates every table, the whole test runs
+# in one transaction that is rolled back at the end but holds locks on the tables of the database until then
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason = "DATABASE_URL is not set, plans are only checked against a database")
+
+SETUP_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "setup.sql")
+
+# Enough rows for full index scans of the large tables to fail the check, like maintenance.py check-plans does by default
+MIN_ROWS = 10000
+ROWS = 12000
+
+# Users 1 to 10 are administrators, the next ROWS consumers and the ROWS after them artists
+SEED_SQL = """
+    INSERT INTO users (id, username, password_hash, password_salt, email)
+    SELECT g, 'user' || g, 'hash', 'salt', 'user' || g || '@example.com' FROM generate_series(1, 2 * %(rows)s + 10) g;
+    INSERT INTO administrators (users_id) SELECT g FROM generate_series(1, 10) g;
+    INSERT INTO publishers (name, email) SELECT 'publisher' || g, 'publisher' || g || '@example.com' FROM generate_series(1, 10) g;
+    INSERT INTO consumers (users_id, display_name, birthday, register_date, premium_until)
+    SELECT 10 + g, 'consumer' || g, '2000-01-01', CURRENT_DATE, CASE WHEN g %% 3 = 0 THEN CURRENT_TIMESTAMP + INTERVAL '1 month' END
+    FROM generate_series(1, %(rows)s) g;
+    INSERT INTO artists (users_id, stage_name, publishers_id, administrators_users_id)
+    SELECT 10 + %(rows)s + g, 'artist' || g, 1 + g %% 10, 1 FROM generate_series(1, %(rows)s) g;
+
+    INSERT INTO songs (ismn, title, genre, duration, release_date, explicit, artists_users_id, publishers_id)
+    SELECT LPAD(g::text, 13, '0'), 'song' || g, 'genre' || g %% 20, 180, '2020-01-01', FALSE, 10 + %(rows)s + g, 1 + g %% 10
+    FROM generate_series(1, %(rows)s) g;
+    INSERT INTO collaborations (songs_id, artists_users_id) SELECT g, 10 + %(rows)s + 1 + g %% %(rows)s FROM generate_series(1, %(rows)s) g;
+    INSERT INTO albums (title, release_date, artists_users_id) SELECT 'album' || g, '2020-01-01', 10 + %(rows)s + g FROM generate_series(1, %(rows)s) g;
+    INSERT INTO album_orders (position, albums_id, songs_id) SELECT 1, g, g FROM generate_series(1, %(rows)s) g;
+    INSERT INTO playlists (name, private, consumers_users_id) SELECT 'playlist' || g, g %% 2 = 0, 10 + g FROM generate_series(1, %(rows)s) g;
+    INSERT INTO playlist_orders (position, songs_id, playlists_id)
+    SELECT position, 1 + (g + position) %% %(rows)s, g FROM generate_series(1, %(rows)s) g, generate_series(1, 2) position;
+    INSERT INTO comments (content, post_time, comments_id, songs_id, consumers_users_id)
+    SELECT 'comment', CURRENT_TIMESTAMP, CASE WHEN g > %(rows)s / 2 THEN g - %(rows)s / 2 END, 1 + g %% 1000, 10 + g
+    FROM generate_series(1, %(rows)s) g;
+
+    INSERT INTO prepaid_cards (number, credit, expiration, administrators_users_id)
+    SELECT LPAD(g::text, 16, '0'), 10, CURRENT_DATE + 365, 1 FROM generate_series(1, %(rows)s) g;
+    INSERT INTO subscriptions (start_time, end_time, price, consumers_users_id)
+    SELECT CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + INTERVAL '1 month', 7, 10 + g FROM generate_series(1, %(rows)s) g;
+    INSERT INTO card_payments (amount_used, payment_time, subscriptions_id, prepaid_cards_id)
+    SELECT 7, CURRENT_TIMESTAMP, g, g FROM generate_series(1, %(rows)s) g;
+    INSERT INTO bans (reason, start_time, end_time, manual_unban, users_id, administrators_users_id)
+    SELECT 'reason', CURRENT_TIMESTAMP - INTERVAL '1 year', CURRENT_TIMESTAMP - INTERVAL '11 months', g %% 2 = 0, 10 + g, 1
+    FROM generate_series(1, %(rows)s) g;
+    INSERT INTO logins (login_time, ip, users_id) SELECT CURRENT_TIMESTAMP, '127.0.0.1', 10 + g FROM generate_series(1, %(rows)s) g;
+
+    -- The counters, top 10s and rollups are written directly instead of by the triggers of every stream
+    ALTER TABLE streams DISABLE TRIGGER USER;
+    INSERT INTO streams (stream_time, songs_id, consumers_users_id) SELECT CURRENT_TIMESTAMP, g, 10 + g FROM generate_series(1, %(rows)s) g;
+    INSERT INTO stream_counts (stream_count, consumers_users_id, songs_id) SELECT 1, 10 + g, g FROM generate_series(1, %(rows)s) g;
+    INSERT INTO top_10s (consumers_users_id, last_updated) SELECT 10 + g, CURRENT_TIMESTAMP FROM generate_series(1, %(rows)s) g;
+    INSERT INTO top_10_orders (position, stream_count, songs_id, top_10s_consumers_users_id) SELECT 1, 1, g, 10 + g FROM generate_series(1, %(rows)s) g;
+    INSERT INTO genre_rollups (playbacks, consumers_users_id, month, genre)
+    SELECT 1, 10 + g, DATE_TRUNC('month', CURRENT_DATE), 'genre' || g %% 20 FROM generate_series(1, %(rows)s) g;
+    """
+
+SEEDED_TABLES = ["users", "administrators", "publishers", "consumers", "artists", "songs", "collaborations", "albums", "album_orders",
+                 "playlists", "playlist_orders", "comments", "prepaid_cards", "subscriptions", "card_payments", "bans", "logins",
+                 "streams", "stream_counts", "top_10s", "top_10_orders", "genre_rollups"]
+
+@pytest.fixture
+def seeded_cursor():
+    conn = psycopg2.connect(DATABASE_URL)
+    cur = conn.cursor()
+    try:
+        # setup.sql creates the trigram indexes of the searches, without them those would rightly fail the check
+        cur.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cur.fetchone() is None:
+            pytest.skip("The pg_trgm extension is not available in the database, setup.sql can't be loaded")
+        with open(SETUP_SQL) as setup:
+            cur.execute(setup.read())
+        cur.execute(SEED_SQL, {"rows": ROWS})
+        # Only the seeded tables, the statistics of anything else in the database aren't rolled back
+        cur.execute(f"ANALYZE {', '.join(SEEDED_TABLES)}")
+        yield cur
+    finally:
+        conn.rollback()
+        conn.close()
+
+def test_statements_read_no_whole_tables(seeded_cursor):
+    scans, errors, small = maintenance.plan_full_scans(seeded_cursor, MIN_ROWS)
+
+    assert errors == {}
+    assert {name: tables for name, tables in scans.items() if tables} == {}
+    assert set(scans) == set(statements.registry)
+    # The seed must keep the large tables above the threshold, or their full index scans go unchecked
+    assert not set(small) & {"songs", "artists", "playlists", "playlist_orders", "comments", "subscriptions", "bans", "stream_counts"}
@@ -0,0 +1,40 @@
+import tempfile
+import os
+
+# The app is configured from the environment when it is imported, the database points at a port nothing listens on
+spool_directory = tempfile.mkdtemp(prefix = "dbproj-spool-")
+os.environ.update({
+    "DB_HOST": "127.0.0.1",
+    "DB_PORT": "1",
+    "DB_NAME": "dbproj",
+    "DB_USER": "dbproj",
+    "DB_PASSWORD": "dbproj",
+    "DB_POOL_MIN_SIZE": "0",
+    "DB_POOL_TIMEOUT": "0.5",
+    "SERVER_HOST": "127.0.0.1",
+    "SERVER_PORT": "8080",
+    "SECRET_KEY": "test-secret-key-that-is-long-enough-for-hs256",
+    "SPOOL_DIR": spool_directory,
+    "SPOOL_NAME": "test",
+    "INVALIDATION_BUS": "false",
+    "AUTH_ROLE_CLAIMS": "false",
+    "RATELIMIT_STORAGE_URI": "memory://",
+})
+
+import api
+
+def test_play_is_spooled_with_the_database_unreachable():
+    app = api.create_app()
+    # The ban list was loaded before the database went down
+    api.banned_users.refresh(lambda watermark: ((0, 0.0), {}, []))
+    # The role of the consumer isn't cached either
+    api.role_cache.clear()
+
+    token = api.encode_token(42)
+    response = app.test_client().put("/dbproj/7", headers = {"Authorization": f"Bearer {token}"})
+
+    assert response.status_code == 200, response.get_json()
+    assert response.get_json() == {"results": "Song streamed and queued to be stored in history!"}
+    assert api.stream_spool.stats()["appended"] == 1
+    spooled = b"".join(open(os.path.join(spool_directory, file), "rb").read() for file in os.listdir(spool_directory) if file.endswith(".log"))
+    assert b"7" in spooled and b"42" in spooled
@@ -1,8 +1,17 @@
 import datetime
+import collections
+import threading
 import flask
+import time
+import random
+import base64
+import json
 import re
 import os
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import statements
 
 StatusCodes = {
                 "success": 200,
@@ -14,27 +23,449 @@ StatusCodes = {
                 "too_many_requests": 429,
                 "internal_error": 500,
                 "not_implemented": 501,
+                "service_unavailable": 503,
             }
 
-def db_connect():
-    conn = psycopg2.connect(
-        database = os.environ.get("DB_NAME"),
-        user = os.environ.get("DB_USER"),
-        password = os.environ.get("DB_PASSWORD"),
-        host = os.environ.get("DB_HOST"),
-        port = os.environ.get("DB_PORT")
-    )
-    if not conn:
+class PoolTimeoutError(Exception):
+    pass
+
+class ConnectionPool:
+    # Thread-safe pool of psycopg2 connections, idle connections are reused in LIFO order so the warmest ones are handed out first
+    def __init__(self, min_size, max_size, timeout, max_age, ping_after, **connect_kwargs):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.ping_after = ping_after
+        self.connect_kwargs = connect_kwargs
+
+        self._condition = threading.Condition()
+        # Idle entries are (connection, created_at, released_at), in use entries map id(connection) -> created_at
+        self._idle = collections.deque()
+        self._idle_ids = set()
+        self._in_use = {}
+        # Open connections, including the ones currently being opened outside the lock
+        self._size = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        for _ in range(min_size):
+            self._reserve_slot()
+            try:
+                conn = psycopg2.connect(**self.connect_kwargs)
+            except psycopg2.OperationalError:
+                self._release_slot()
+                raise
+            self._push_idle(conn, time.monotonic())
+
+    def _reserve_slot(self):
+        with self._condition:
+            self._size += 1
+
+    def _release_slot(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _push_idle(self, conn, created_at):
+        with self._condition:
+            self._idle.append((conn, created_at, time.monotonic()))
+            self._idle_ids.add(id(conn))
+            self._condition.notify()
+
+    def _take(self, deadline):
+        # Returns an idle connection entry, or None if a slot was reserved to open a new connection
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise PoolTimeoutError("Connection pool is closed")
+                if self._idle:
+                    entry = self._idle.pop()
+                    self._idle_ids.discard(id(entry[0]))
+                    return entry
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError(f"No database connection available after {self.timeout} seconds")
+                self._condition.wait(remaining)
+
+    def _is_alive(self, conn, created_at, released_at):
+        now = time.monotonic()
+        if conn.closed:
+            return False
+        if self.max_age is not None and now - created_at > self.max_age:
+            return False
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        # Only ping connections that sat idle for a while, recently used ones are assumed to be alive
+        if now - released_at > self.ping_after:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._condition:
+            self._discarded += 1
+        self._release_slot()
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            entry = self._take(deadline)
+            if entry is None:
+                try:
+                    conn = psycopg2.connect(**self.connect_kwargs)
+                except psycopg2.OperationalError:
+                    self._release_slot()
+                    raise
+                created_at = time.monotonic()
+            else:
+                conn, created_at, released_at = entry
+                if not self._is_alive(conn, created_at, released_at):
+                    self._discard(conn)
+                    continue
+
+            waited = time.monotonic() - start
+            with self._condition:
+                self._in_use[id(conn)] = created_at
+                self._checkouts += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            return conn
+
+    def putconn(self, conn):
+        # Returns False if the connection does not belong to this pool, releasing twice is harmless
+        with self._condition:
+            if id(conn) in self._idle_ids:
+                return True
+            created_at = self._in_use.pop(id(conn), None)
+            if created_at is None:
+                return False
+            closed = self._closed
+
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        expired = self.max_age is not None and time.monotonic() - created_at > self.max_age
+        if closed or conn.closed or expired:
+            self._discard(conn)
+        else:
+            self._push_idle(conn, created_at)
+        return True
+
+    def closeall(self):
+        with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._idle_ids.clear()
+            self._condition.notify_all()
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "size": self._size,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+                "wait_time_total": round(self._wait_total, 6),
+                "wait_time_max": round(self._wait_max, 6),
+                "wait_time_avg": round(self._wait_total / self._checkouts, 6) if self._checkouts else 0.0,
+            }
+
+# Errors raised only because of concurrent transactions, running the transaction again can succeed
+TransientErrors = (psycopg2.errors.DeadlockDetected, psycopg2.errors.SerializationFailure)
+
+class TransactionRunner:
+    # Runs a transaction and runs it again when it fails with a transient error, after a jittered exponential backoff
+    # Retries are limited per call and by a budget shared by all calls, so a database that keeps failing isn't hit with more load
+    def __init__(self, max_attempts, base_delay, max_delay, budget, budget_refill):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        # Budget earned back by every call that succeeds at the first attempt
+        self.budget_refill = budget_refill
+
+        self._lock = threading.Lock()
+        self._tokens = float(budget)
+
+        self._calls = 0
+        self._retries = 0
+        self._deadlocks = 0
+        self._serialization_failures = 0
+        self._recovered = 0
+        self._exhausted = 0
+        self._backoff_total = 0.0
+
+    def run(self, function, rollback, *args, **kwargs):
+        # The rollback callable ends the failed transaction before the function runs again, the last error is raised when giving up
+        with self._lock:
+            self._calls += 1
+        attempt = 1
+        while True:
+            try:
+                result = function(*args, **kwargs)
+            except TransientErrors as error:
+                rollback()
+                with self._lock:
+                    if isinstance(error, psycopg2.errors.DeadlockDetected):
+                        self._deadlocks += 1
+                    else:
+                        self._serialization_failures += 1
+                    if attempt >= self.max_attempts or self._tokens < 1:
+                        self._exhausted += 1
+                        raise
+                    self._tokens -= 1
+                    self._retries += 1
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                    self._backoff_total += delay
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            with self._lock:
+                if attempt == 1:
+                    self._tokens = min(self.budget, self._tokens + self.budget_refill)
+                else:
+                    self._recovered += 1
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self._calls,
+                "retries": self._retries,
+                "deadlocks": self._deadlocks,
+                "serialization_failures": self._serialization_failures,
+                "recovered": self._recovered,
+                "exhausted": self._exhausted,
+                "budget": round(self._tokens, 2),
+                "backoff_time_total": round(self._backoff_total, 6),
+            }
+
+_db_pool = None
+_db_pool_pid = None
+_db_replica_pool = None
+_db_pool_lock = threading.Lock()
+# Counts how the read-only requests of this process were routed
+_read_routing = collections.Counter()
+
+def db_pool():
+    global _db_pool, _db_pool_pid, _db_replica_pool
+    # The pool is created lazily so each process (including forked workers) opens its own connections
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != os.getpid():
+                _db_pool = ConnectionPool(
+                    min_size = int(os.environ.get("DB_POOL_MIN_SIZE", 1)),
+                    max_size = int(os.environ.get("DB_POOL_MAX_SIZE", 20)),
+                    timeout = float(os.environ.get("DB_POOL_TIMEOUT", 5)),
+                    max_age = float(os.environ.get("DB_POOL_MAX_AGE", 1800)),
+                    ping_after = float(os.environ.get("DB_POOL_PING_AFTER", 10)),
+                    connection_factory = db_connection_factory(),
+                    **db_settings()
+                )
+                _db_replica_pool = None
+                _read_routing.clear()
+                _db_pool_pid = os.getpid()
+    return _db_pool
+
+def db_settings():
+    # Connection settings of the primary
+    return {
+        "database": os.environ.get("DB_NAME"),
+        "user": os.environ.get("DB_USER"),
+        "password": os.environ.get("DB_PASSWORD"),
+        "host": os.environ.get("DB_HOST"),
+        "port": os.environ.get("DB_PORT"),
+    }
+
+def db_connection_factory():
+    # Pooled connections prepare the hot statements of the registry, turned off behind poolers that don't keep sessions
+    if env_flag("DB_PREPARED_STATEMENTS", True):
+        return statements.PreparingConnection
+    return psycopg2.extensions.connection
+
+def db_replica_settings():
+    # Connection settings of the read replica, or None if there is none, anything not set is the same as for the primary
+    if not os.environ.get("DB_REPLICA_HOST"):
+        return None
+    return {
+        "database": os.environ.get("DB_REPLICA_NAME", os.environ.get("DB_NAME")),
+        "user": os.environ.get("DB_REPLICA_USER", os.environ.get("DB_USER")),
+        "password": os.environ.get("DB_REPLICA_PASSWORD", os.environ.get("DB_PASSWORD")),
+        "host": os.environ.get("DB_REPLICA_HOST"),
+        "port": os.environ.get("DB_REPLICA_PORT", os.environ.get("DB_PORT")),
+        "connect_timeout": int(os.environ.get("DB_REPLICA_CONNECT_TIMEOUT", 2)),
+        # Refuses writes even if the host turns out to be a primary, so a misrouted write fails instead of going astray
+        "options": "-c default_transaction_read_only=on",
+    }
+
+def db_replica_pool():
+    # Pool of the read replica, created on first use like the primary one, None if no replica is configured
+    global _db_replica_pool
+    settings = db_replica_settings()
+    if settings is None:
+        return None
+    db_pool()
+    if _db_replica_pool is None:
+        with _db_pool_lock:
+            if _db_replica_pool is None:
+                _db_replica_pool = ConnectionPool(
+                    # Opened lazily, a replica that is down at startup must not keep the worker from serving
+                    min_size = 0,
+                    max_size = int(os.environ.get("DB_REPLICA_POOL_MAX_SIZE", os.environ.get("DB_POOL_MAX_SIZE", 20))),
+                    timeout = float(os.environ.get("DB_REPLICA_POOL_TIMEOUT", 1)),
+                    max_age = float(os.environ.get("DB_POOL_MAX_AGE", 1800)),
+                    ping_after = float(os.environ.get("DB_POOL_PING_AFTER", 10)),
+                    connection_factory = db_connection_factory(),
+                    **settings
+                )
+    return _db_replica_pool
+
+def db_pool_stats():
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        return None
+    return _db_pool.stats()
+
+def db_replica_stats():
+    if _db_pool_pid != os.getpid() or _db_replica_pool is None:
+        return None
+    with _db_pool_lock:
+        routing = dict(_read_routing)
+    return {**_db_replica_pool.stats(), "routing": routing}
+
+def record_read_routing(route):
+    with _db_pool_lock:
+        _read_routing[route] += 1
+
+def db_connect(abort_unavailable = True, read_only = False):
+    # Callers with a fallback for an unavailable database can get the original exception instead of an aborted request
+    # Read-only connections come from the replica if there is one, and from the primary while the replica is unavailable
+    replica = db_replica_pool() if read_only else None
+    if replica is not None:
+        try:
+            conn = replica.getconn()
+            record_read_routing("replica")
+            return conn, conn.cursor()
+        except (PoolTimeoutError, psycopg2.OperationalError):
+            record_read_routing("primary_fallback")
+    try:
+        conn = db_pool().getconn()
+    except PoolTimeoutError:
+        if not abort_unavailable:
+            raise
+        flask.abort(StatusCodes["service_unavailable"], "Database is busy, please try again later!")
+    except psycopg2.OperationalError:
+        if not abort_unavailable:
+            raise
         flask.abort(StatusCodes["internal_error"], "Could not connect to the database!")
-    else:
-        return conn, conn.cursor()
+    return conn, conn.cursor()
 
 def db_disconnect(conn, cur):
     if conn:
-        # Always rollback changes before disconnecting, if they are already committed or there is no transaction pending this will do nothing
-        conn.rollback()
-        cur.close()
-        conn.close()
+        if not cur.closed:
+            cur.close()
+        # The pool always rolls back changes before reusing a connection, if they are already committed or there is no transaction pending this will do nothing
+        pools = [_db_pool, _db_replica_pool] if _db_pool_pid == os.getpid() else []
+        if not any(pool is not None and pool.putconn(conn) for pool in pools):
+            # Connections opened outside the pool are closed like before
+            conn.rollback()
+            conn.close()
+
+def get_request_cursor(abort_unavailable = True):
+    # One connection and one transaction per request, shared by the authentication check and the endpoint
+    # Requests marked read-only with set_request_read_only() before their first query are served by the replica
+    if "db" not in flask.g:
+        flask.g.db = db_connect(abort_unavailable, read_only = flask.g.get("db_read_only", False))
+    return flask.g.db[1]
+
+def set_request_read_only(read_only = True):
+    flask.g.db_read_only = read_only
+
+def db_request_discard():
+    # Gives up on the request transaction, used when the connection failed and the endpoint can still answer without it
+    flask.g.pop("commit_callbacks", None)
+    db = flask.g.pop("db", None)
+    if db is not None:
+        db_disconnect(*db)
+
+def on_request_commit(callback):
+    # Runs the callback once the request transaction commits, used to invalidate caches only after writes are visible
+    flask.g.setdefault("commit_callbacks", []).append(callback)
+
+def db_request_rollback():
+    # Rolls back the request transaction so it can be run again, callbacks registered by the failed attempt are dropped
+    flask.g.pop("commit_callbacks", None)
+    db = flask.g.get("db")
+    if db is not None:
+        db[0].rollback()
+
+def db_request_finish(commit):
+    # Ends the request transaction, the connection itself is only released on teardown
+    callbacks = flask.g.pop("commit_callbacks", [])
+    db = flask.g.get("db")
+    if db is not None:
+        conn = db[0]
+        if commit:
+            conn.commit()
+        else:
+            conn.rollback()
+    if commit:
+        for callback in callbacks:
+            callback()
+
+def db_request_teardown(exception = None):
+    db = flask.g.pop("db", None)
+    if db is not None:
+        db_disconnect(*db)
+
+def env_flag(name, default = False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def encode_page_cursor(key):
+    # The cursor is the sort key of the last row of a page, opaque to clients
+    data = json.dumps(key, default = str, separators = (",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+def decode_page_cursor(cursor, converters):
+    # Returns the sort key converted by the converter of each column, or None if the cursor is invalid
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(key, list) or len(key) != len(converters):
+            return None
+        return tuple(convert(value) for convert, value in zip(converters, key))
+    except (TypeError, ValueError):
+        return None
 
 def payload_validate(payload, required):
     received = set(payload.keys())
@@ -103,6 +534,12 @@ def password_validate(password):
         return False
     return True
 
+def username_validate(username):
+    # Logins tell emails from usernames by the @
+    if "@" in username:
+        return False
+    return True
+
 def email_validate(email):
     if not re.match(r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$", email):
         return False